@@ -0,0 +1,308 @@
+"""
+Estimate a kernel's cycles from its instructions, without running it.
+
+    python analyze.py --forest-height 10 --rounds 16 --batch-size 1024
+    python analyze.py --param unroll_rounds=None --top 20
+
+The program is split into straight-line regions (basic blocks), and each
+region gets two lower bounds on the bundles it needs:
+- the dataflow critical path, the longest chain of slots where each reads
+  what the one before wrote;
+- the resource bound, the busiest engine's slots over its SLOT_LIMITS.
+
+Whichever is larger dominates the region. The gap between it and the
+region's actual bundles is what better scheduling could win back.
+
+How often each region runs comes from the annotations KernelBuilder leaves
+in debug slots (see annotate in perf_takehome.py):
+- trip counts on loops' backwards jumps;
+- how often forward conditional jumps are taken.
+
+A loop without a trip count is counted as running once, and an unannotated
+branch as taken half the time; both are reported as guesses. Memory
+addresses aren't known statically, so dependencies through memory are
+ignored, which keeps the critical path a lower bound.
+
+The tests stop calling Machine.run() at the pause after the last round, so
+the loop tests after it never run. The estimate counts them, so it comes
+out a few cycles above the simulated count.
+"""
+
+import argparse
+import math
+from collections import defaultdict
+from dataclasses import dataclass
+
+from autotune import parse_param
+from perf_takehome import (
+    BARRIER_OPS,
+    KernelBuilder,
+    jump_target,
+    resource_bound,
+    slot_reads_writes,
+)
+from problem import SLOT_LIMITS, Instruction
+
+
+@dataclass
+class Region:
+    """A straight-line region of a program, from start up to end"""
+
+    start: int
+    end: int
+    # Times the region runs, per core
+    count: float
+    critical_path: int
+    resource_bound: int
+    # The engine the resource bound comes from
+    engine: str | None
+
+    @property
+    def bundles(self) -> int:
+        return self.end - self.start
+
+    @property
+    def bound(self) -> int:
+        return max(self.critical_path, self.resource_bound)
+
+    @property
+    def dominant(self) -> str:
+        if self.engine is None or self.critical_path >= self.resource_bound:
+            return "latency"
+        return self.engine
+
+
+def annotation(instr: Instruction, kind: str):
+    for slot in instr.get("debug", []):
+        if slot[0] == kind:
+            return slot[1]
+    return None
+
+
+def region_starts(instrs: list[Instruction]) -> list[int]:
+    """Where each straight-line region starts: jump targets and after barriers"""
+    starts = {0}
+    for pc, instr in enumerate(instrs):
+        for slot in instr.get("flow", []):
+            if slot[0] in BARRIER_OPS:
+                starts.add(pc + 1)
+            target = jump_target(slot, pc)
+            if target is not None:
+                starts.add(target)
+    return sorted(s for s in starts if 0 <= s < len(instrs))
+
+
+def critical_path(bundles: list[Instruction]) -> int:
+    """
+    Most bundles any chain of dependent slots needs, where a slot can only
+    go after every slot whose result it reads
+    """
+    ready = {}
+    longest = 0
+    for instr in bundles:
+        written = []
+        for engine, slots in instr.items():
+            if engine == "debug":
+                continue
+            for slot in slots:
+                reads, writes = slot_reads_writes(engine, slot)
+                done = 1 + max((ready.get(a, 0) for a in reads if a >= 0), default=0)
+                written.extend((a, done) for a in writes if a >= 0)
+                longest = max(longest, done)
+        ready.update(written)
+    return longest
+
+
+def engine_bound(bundles: list[Instruction]) -> tuple[int, str | None]:
+    """Bundles needed for the busiest engine's slots, and that engine"""
+    slots = [(e, slot) for instr in bundles for e, ss in instr.items() for slot in ss]
+    counts = defaultdict(int)
+    for engine, _ in slots:
+        if engine != "debug":
+            counts[engine] += 1
+    if not counts:
+        return 0, None
+    engine = max(counts, key=lambda e: counts[e] / SLOT_LIMITS[e])
+    return math.ceil(resource_bound(slots)), engine
+
+
+def exec_counts(instrs: list[Instruction]) -> tuple[list[float], list[str]]:
+    """
+    How many times each bundle runs per core, following the trip_count and
+    taken annotations, and a note for everything that had to be guessed.
+
+    A loop is the code from a backwards jump's target to the jump. Each time
+    it's entered it runs trip_count times without taking any jump out of it,
+    then if it has such a jump it runs once more up to the first one, which
+    is how for_loop tests at the top. Otherwise it falls through the end.
+    """
+    heads = defaultdict(list)
+    for pc, instr in enumerate(instrs):
+        for slot in instr.get("flow", []):
+            target = jump_target(slot, pc)
+            if target is not None and target <= pc:
+                heads[target].append(pc)
+    counts = [0.0] * len(instrs)
+    guesses = []
+
+    def run(lo, hi, entry, scale, loop_end=None, leave=False):
+        """
+        Push entry runs through the code from lo to hi, adding them times
+        scale to counts. Returns the runs leaving it, by where they go.
+        Inside a loop ending at loop_end, jumps out of the loop are taken
+        only if leave is set.
+        """
+        inflow = defaultdict(float, {lo: entry})
+        exits = defaultdict(float)
+        pc = lo
+        while pc < hi:
+            f = inflow.pop(pc, 0.0)
+            inner = [b for b in heads.get(pc, []) if b < hi and b != loop_end]
+            if f and inner:
+                end = max(inner)
+                for target, g in loop(pc, end, f, scale).items():
+                    (inflow if pc <= target < hi else exits)[target] += g
+                pc = end + 1
+                continue
+            counts[pc] += f * scale
+            if f:
+                for target, g in successors(pc, f, loop_end, leave):
+                    (inflow if pc < target < hi else exits)[target] += g
+            pc += 1
+        for target, g in inflow.items():
+            exits[target] += g
+        return exits
+
+    def successors(pc, f, loop_end, leave):
+        flow = instrs[pc].get("flow", [])
+        slot = flow[0] if flow else ("",)
+        target = jump_target(slot, pc)
+        if slot[0] == "halt":
+            return []
+        if slot[0] == "jump_indirect":
+            guesses.append(f"bundle {pc}: indirect jump, assumed to stop")
+            return []
+        if target is None:
+            return [(pc + 1, f)]
+        if pc == loop_end:
+            return []
+        if slot[0] == "jump":
+            return [(target, f)]
+        if loop_end is not None and target > loop_end:
+            return [(target, f)] if leave else [(pc + 1, f)]
+        taken = annotation(instrs[pc], "taken")
+        if taken is None:
+            guesses.append(f"bundle {pc}: branch assumed taken half the time")
+            taken = 0.5
+        return [(target, f * taken), (pc + 1, f * (1 - taken))]
+
+    def loop(start, end, entry, scale):
+        trips = annotation(instrs[end], "trip_count")
+        if trips is None:
+            guesses.append(f"loop {start}-{end}: no trip count, assumed 1")
+            trips = 1
+        run(start, end + 1, entry, scale * trips, loop_end=end)
+        leaves = any(
+            (target := jump_target(slot, pc)) is not None and target > end
+            for pc in range(start, end)
+            for slot in instrs[pc].get("flow", [])
+        )
+        if leaves:
+            return run(start, end + 1, entry, scale, loop_end=end, leave=True)
+        return {end + 1: entry}
+
+    run(0, len(instrs), 1.0, 1.0)
+    return counts, guesses
+
+
+def regions(instrs: list[Instruction], counts: list[float]) -> list[Region]:
+    """The program's regions with their bounds, given exec_counts"""
+    starts = region_starts(instrs)
+    found = []
+    for start, end in zip(starts, starts[1:] + [len(instrs)]):
+        bundles = instrs[start:end]
+        rb, engine = engine_bound(bundles)
+        found.append(
+            Region(start, end, counts[start], critical_path(bundles), rb, engine)
+        )
+    return found
+
+
+def estimate(instrs: list[Instruction]) -> dict:
+    """
+    Cycles per core the program should take, the floor if every region were
+    scheduled as tightly as its bounds allow, and the floor from the engines'
+    slot counts over the whole run
+    """
+    counts, guesses = exec_counts(instrs)
+    found = regions(instrs, counts)
+    totals = defaultdict(float)
+    for instr, count in zip(instrs, counts):
+        for engine, slots in instr.items():
+            if engine != "debug":
+                totals[engine] += count * len(slots)
+    by_bound = defaultdict(float)
+    for r in found:
+        by_bound[r.dominant] += r.count * r.bound
+    return {
+        "cycles": sum(counts),
+        "region_floor": sum(r.count * r.bound for r in found),
+        "resource_floor": max(
+            (n / SLOT_LIMITS[e] for e, n in totals.items()), default=0
+        ),
+        "by_bound": dict(by_bound),
+        "regions": found,
+        "guesses": guesses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate the kernel's cycles.")
+    parser.add_argument("--forest-height", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="a KernelBuilder option, None for None",
+    )
+    parser.add_argument("--top", type=int, default=10, help="regions to list")
+    args = parser.parse_args()
+
+    params = {}
+    for arg in args.param:
+        name, (value,) = parse_param(arg)
+        params[name] = value
+    kb = KernelBuilder(**params)
+    n_nodes = 2 ** (args.forest_height + 1) - 1
+    kb.build_kernel(args.forest_height, n_nodes, args.batch_size, args.rounds)
+    result = estimate(kb.instrs)
+
+    print(f"{len(kb.instrs)} bundles, {len(result['regions'])} regions")
+    print(f"Estimated cycles:  {result['cycles']:.0f}")
+    print(f"Region floor:      {result['region_floor']:.0f}")
+    print(f"Resource floor:    {result['resource_floor']:.0f}")
+    bounds = sorted(result["by_bound"].items(), key=lambda kv: -kv[1])
+    print("Floor by bound:    " + ", ".join(f"{b}={n:.0f}" for b, n in bounds))
+    saved = ", ".join(f"{name}={n}" for name, n in kb.pass_savings.items())
+    print(f"Slots saved:       {saved or 'no passes'}")
+    print("\nTop regions by cycles:")
+    print(
+        f"{'region':>13} {'runs':>7} {'bundles':>7} {'critical':>8} "
+        f"{'resource':>8}  {'bound':<8} {'slack':>7}"
+    )
+    top = sorted(result["regions"], key=lambda r: -r.count * r.bundles)
+    for r in top[: args.top]:
+        print(
+            f"{r.start:>6}-{r.end - 1:<6} {r.count:>7.0f} {r.bundles:>7} "
+            f"{r.critical_path:>8} {r.resource_bound:>8}  {r.dominant:<8} "
+            f"{r.count * (r.bundles - r.bound):>7.0f}"
+        )
+    for note in result["guesses"]:
+        print(f"Guess: {note}")
+
+
+if __name__ == "__main__":
+    main()
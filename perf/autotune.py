@@ -0,0 +1,174 @@
+"""
+Search KernelBuilder's options for the fastest kernel on a problem shape.
+
+    python autotune.py --forest-height 10 --rounds 16 --batch-size 1024
+    python autotune.py --param unroll_rounds=1,None --param tree_cache_levels=0,1,2
+
+Every combination of the option values in PARAM_SPACE (or given with --param)
+runs through run_kernel in worker processes. Configs that give wrong
+results or fail to build are dropped. Results are cached by options, shape and
+seed, and thrown away whenever perf_takehome.py or problem.py change. The
+report lists the configs no other config beats on both cycles and program
+size, fastest first.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from perf_takehome import run_kernel
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Values to try for each KernelBuilder option
+PARAM_SPACE = {
+    "unroll_rounds": [1, 2, 4, None],
+    "unroll_batches": [1, 2, 4, 8, None],
+    "tree_cache_levels": [None, 0, 1, 2, 3],
+}
+
+CACHE_FILE = os.path.join(HERE, "autotune_cache.json")
+
+# Results are only valid for the code that produced them
+SOURCES = ["perf_takehome.py", "problem.py"]
+
+
+def sources_hash() -> str:
+    h = hashlib.sha256()
+    for name in SOURCES:
+        with open(os.path.join(HERE, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def evaluate(params: dict, shape: tuple[int, int, int], seed: int) -> dict:
+    """
+    Cycles, bundles and scratch words of the kernel built with params, or
+    the error if it's wrong or doesn't build
+    """
+    forest_height, rounds, batch_size = shape
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            kb, machine, _ = run_kernel(
+                forest_height, rounds, batch_size, seed=seed, builder_args=params
+            )
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    return {
+        "cycles": machine.cycle,
+        "bundles": len(kb.instrs),
+        "scratch": kb.scratch_ptr,
+    }
+
+
+def cache_key(params: dict, shape: tuple[int, int, int], seed: int) -> str:
+    return json.dumps({"params": params, "shape": shape, "seed": seed}, sort_keys=True)
+
+
+def load_cache(path: str) -> dict:
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    return cache["results"] if cache.get("sources") == sources_hash() else {}
+
+
+def save_cache(path: str, results: dict):
+    with open(path + ".tmp", "w") as f:
+        json.dump({"sources": sources_hash(), "results": results}, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def tune(
+    space: dict[str, list],
+    shape: tuple[int, int, int],
+    seed: int = 123,
+    workers: int | None = None,
+    cache_path: str = CACHE_FILE,
+) -> list[tuple[dict, dict]]:
+    """
+    (params, result) for every combination of option values in space, running
+    the ones missing from the cache on workers processes
+    """
+    names = sorted(space)
+    configs = [
+        dict(zip(names, values))
+        for values in itertools.product(*(space[n] for n in names))
+    ]
+    cache = load_cache(cache_path)
+    todo = [p for p in configs if cache_key(p, shape, seed) not in cache]
+    if todo:
+        print(f"Running {len(todo)} of {len(configs)} configs")
+        with ProcessPoolExecutor(workers) as pool:
+            futures = {pool.submit(evaluate, p, shape, seed): p for p in todo}
+            for n, future in enumerate(as_completed(futures), 1):
+                params, result = futures[future], future.result()
+                cache[cache_key(params, shape, seed)] = result
+                save_cache(cache_path, cache)
+                print(f"[{n}/{len(todo)}] {params}: {result}")
+    return [(p, cache[cache_key(p, shape, seed)]) for p in configs]
+
+
+def pareto_front(results: list[tuple[dict, dict]]) -> list[tuple[dict, dict]]:
+    """
+    The correct configs no other correct config beats on both cycles and
+    bundles, fastest first
+    """
+    ok = sorted(
+        (r for r in results if "error" not in r[1]),
+        key=lambda r: (r[1]["cycles"], r[1]["bundles"]),
+    )
+    front = []
+    for params, result in ok:
+        if not front or result["bundles"] < front[-1][1]["bundles"]:
+            front.append((params, result))
+    return front
+
+
+def parse_param(arg: str) -> tuple[str, list]:
+    name, values = arg.split("=", 1)
+    return name, [None if v == "None" else int(v) for v in values.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Autotune KernelBuilder options.")
+    parser.add_argument("--forest-height", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache", default=CACHE_FILE)
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        metavar="NAME=V1,V2,...",
+        help="values to try for an option instead of PARAM_SPACE's, None for None",
+    )
+    args = parser.parse_args()
+
+    space = dict(PARAM_SPACE)
+    space.update(parse_param(arg) for arg in args.param)
+    shape = (args.forest_height, args.rounds, args.batch_size)
+    results = tune(space, shape, args.seed, args.workers, args.cache)
+
+    failed = [r for r in results if "error" in r[1]]
+    for params, result in failed:
+        print(f"Dropped {params}: {result['error'][:200]}")
+    print(f"\nPareto front of {len(results) - len(failed)} correct configs, {shape=}:")
+    print(f"{'cycles':>8} {'bundles':>8} {'scratch':>8}  params")
+    for params, result in pareto_front(results):
+        print(
+            f"{result['cycles']:>8} {result['bundles']:>8} {result['scratch']:>8}  "
+            f"{params}"
+        )
+
+
+if __name__ == "__main__":
+    main()
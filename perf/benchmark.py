@@ -0,0 +1,228 @@
+"""
+Benchmark the kernel over a grid of problem shapes and seeds.
+
+    python benchmark.py                    # run the grid, compare to the baseline
+    python benchmark.py --save-baseline    # run the grid and store it as the baseline
+    python benchmark.py --out results.csv  # also write the results (.csv or .json)
+    python benchmark.py --forest-height 6 10 --rounds 16 --batch-size 512
+
+Each run records cycles, seconds spent in the simulator, program size, the
+scratch high-water mark and how full each engine's slots were. Against a
+stored baseline, any shape that got slower in cycles or stopped being correct
+is reported as a regression and the exit status is 1. Simulator time is noisy
+and machine dependent, so it's only checked when --time-tolerance is given.
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+
+from perf_takehome import run_kernel
+from problem import SLOT_LIMITS, N_CORES, VLEN
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Batch sizes must be multiples of VLEN * N_CORES
+FOREST_HEIGHTS = [4, 8, 10, 12]
+ROUNDS = [4, 16, 32]
+BATCH_SIZES = [4 * VLEN * N_CORES, 16 * VLEN * N_CORES, 32 * VLEN * N_CORES]
+SEEDS = [123, 7]
+
+BASELINE_FILE = os.path.join(HERE, "benchmark_baseline.json")
+
+SHAPE_FIELDS = ["forest_height", "rounds", "batch_size", "seed"]
+FIELDS = (
+    SHAPE_FIELDS
+    + ["cycles", "sim_seconds", "bundles", "scratch", "slots_per_bundle"]
+    + [f"{engine}_util" for engine in SLOT_LIMITS]
+    + ["error"]
+)
+
+
+def grid(
+    forest_heights: list[int],
+    rounds: list[int],
+    batch_sizes: list[int],
+    seeds: list[int],
+) -> list[tuple[int, int, int, int]]:
+    return list(itertools.product(forest_heights, rounds, batch_sizes, seeds))
+
+
+def measure(
+    forest_height: int,
+    rounds: int,
+    batch_size: int,
+    seed: int,
+    backend: str = "python",
+    builder_args: dict | None = None,
+    parallel: bool | int = False,
+) -> dict:
+    """One row of results for a shape and seed, with error set if it failed"""
+    row = dict.fromkeys(FIELDS)
+    row.update(zip(SHAPE_FIELDS, (forest_height, rounds, batch_size, seed)))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            kb, machine, sim_time = run_kernel(
+                forest_height,
+                rounds,
+                batch_size,
+                seed,
+                backend=backend,
+                builder_args=builder_args,
+                parallel=parallel,
+            )
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+        return row
+    stats = machine.stats()
+    row.update(
+        cycles=machine.cycle,
+        sim_seconds=round(sim_time, 4),
+        bundles=len(kb.instrs),
+        scratch=kb.scratch_ptr,
+        slots_per_bundle=round(
+            sum(stats.slots(e) for e in SLOT_LIMITS) / max(1, stats.bundles), 3
+        ),
+    )
+    for engine, util in stats.utilization().items():
+        row[f"{engine}_util"] = round(util, 4)
+    return row
+
+
+def shape_key(row: dict) -> tuple:
+    return tuple(row[f] for f in SHAPE_FIELDS)
+
+
+def compare(
+    results: list[dict],
+    baseline: list[dict],
+    tolerance: float = 0.0,
+    time_tolerance: float | None = None,
+) -> list[str]:
+    """
+    Descriptions of the results that are worse than the baseline run of the
+    same shape and seed. Cycles may grow by a fraction tolerance, simulator
+    time by time_tolerance if it's given.
+    """
+    base = {shape_key(row): row for row in baseline}
+    regressions = []
+    for row in results:
+        old = base.get(shape_key(row))
+        if old is None:
+            continue
+        shape = dict(zip(SHAPE_FIELDS, shape_key(row)))
+        if row["error"]:
+            if not old["error"]:
+                regressions.append(f"{shape}: now fails, {row['error'][:200]}")
+            continue
+        if old["error"]:
+            continue
+        if row["cycles"] > old["cycles"] * (1 + tolerance):
+            regressions.append(
+                f"{shape}: {old['cycles']} -> {row['cycles']} cycles "
+                f"({row['cycles'] / old['cycles'] - 1:+.1%})"
+            )
+        if time_tolerance is not None and row["sim_seconds"] > old["sim_seconds"] * (
+            1 + time_tolerance
+        ):
+            regressions.append(
+                f"{shape}: {old['sim_seconds']}s -> {row['sim_seconds']}s "
+                "in the simulator"
+            )
+    return regressions
+
+
+def load_results(path: str) -> list[dict]:
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def save_results(path: str, results: list[dict]):
+    """Write results as CSV if path ends in .csv, JSON otherwise"""
+    with open(path, "w", newline="") as f:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+        else:
+            json.dump({"results": results}, f, indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the kernel's cycles.")
+    parser.add_argument("--forest-height", type=int, nargs="+", default=FOREST_HEIGHTS)
+    parser.add_argument("--rounds", type=int, nargs="+", default=ROUNDS)
+    parser.add_argument("--batch-size", type=int, nargs="+", default=BATCH_SIZES)
+    parser.add_argument("--seed", type=int, nargs="+", default=SEEDS)
+    parser.add_argument("--backend", default="python")
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=0,
+        help="worker processes to simulate the cores on, 0 for lockstep",
+    )
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="store the results as the baseline instead of comparing to it",
+    )
+    parser.add_argument("--out", help="also write the results to this .csv or .json")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.0,
+        help="fraction cycles may grow before it counts as a regression",
+    )
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=None,
+        help="fraction simulator time may grow, unchecked if not given",
+    )
+    args = parser.parse_args()
+
+    shapes = grid(args.forest_height, args.rounds, args.batch_size, args.seed)
+    results = []
+    print(
+        f"{'height':>6} {'rounds':>6} {'batch':>6} {'seed':>6} {'cycles':>7} "
+        f"{'sim s':>7} {'bundles':>7} {'scratch':>7} {'slots/b':>7}"
+    )
+    for shape in shapes:
+        row = measure(*shape, backend=args.backend, parallel=args.parallel)
+        results.append(row)
+        if row["error"]:
+            print(" ".join(f"{v:>6}" for v in shape), row["error"][:200])
+            continue
+        print(
+            " ".join(f"{v:>6}" for v in shape),
+            f"{row['cycles']:>7} {row['sim_seconds']:>7.3f} {row['bundles']:>7} "
+            f"{row['scratch']:>7} {row['slots_per_bundle']:>7.2f}",
+        )
+
+    if args.out:
+        save_results(args.out, results)
+    if args.save_baseline:
+        save_results(args.baseline, results)
+        print(f"Saved {len(results)} results as the baseline in {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to make one")
+        return
+    regressions = compare(
+        results, load_results(args.baseline), args.tolerance, args.time_tolerance
+    )
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if regressions:
+        sys.exit(1)
+    print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
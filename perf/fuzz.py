@@ -0,0 +1,257 @@
+"""
+Fuzz the kernel against the reference on random shapes, inputs and
+KernelBuilder options.
+
+    python fuzz.py --cases 200
+    python fuzz.py --cases 50 --max-height 6 --workers 8 --seed 7
+    python fuzz.py --replay '{"forest_height": 2, "rounds": 3, ...}'
+
+Each case is a shape, KernelBuilder options and a few problems of that shape.
+The shape is a forest height, a number of rounds and a batch size that's a
+multiple of VLEN * N_CORES. The options are drawn from autotune.PARAM_SPACE,
+sometimes with only some of the optimization passes. The problems run
+together on a BatchMachine, each made in one of VALUE_MODES:
+- random: like Tree.generate and Input.generate;
+- even, odd: values whose hashes stay even (or odd) for the first rounds, so
+  every item walks the leftmost (or rightmost) path of the tree and wraps
+  around at its leaves together;
+- extreme: values and node values from the ends of the 32-bit range.
+
+Cases are checked in worker processes. Each failing case is shrunk to the
+smallest shape, fewest options and single problem that still fail, then
+printed as JSON for --replay.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+from autotune import PARAM_SPACE
+from perf_takehome import OPT_PASSES, KernelBuilder
+from problem import (
+    N_CORES,
+    REFERENCE_KERNELS,
+    VLEN,
+    BatchMachine,
+    Input,
+    Tree,
+    build_mem_image,
+    myhash_np,
+)
+
+VALUE_MODES = ["random", "even", "odd", "extreme"]
+
+# Words the extreme mode mostly picks from
+EXTREMES = [0, 1, 2, 2**31 - 1, 2**31, 2**32 - 2, 2**32 - 1]
+
+# Rounds the even and odd modes hold the hashes' parity for. Finding values
+# takes about 2**rounds random tries per item.
+PARITY_ROUNDS = 12
+
+
+@dataclass
+class Case:
+    forest_height: int
+    rounds: int
+    batch_size: int
+    params: dict
+    # (value mode, seed) of each problem, all run at once
+    problems: list[tuple[str, int]]
+
+
+def parity_values(
+    forest_values: list[int], rounds: int, batch_size: int, parity: int, seed: int
+) -> list[int]:
+    """
+    Input values whose hashes all have the given parity in each of the first
+    rounds, up to PARITY_ROUNDS, so every item takes the same path
+    """
+    nodes = []
+    idx = 0
+    for _ in range(min(rounds, PARITY_ROUNDS)):
+        nodes.append(forest_values[idx])
+        idx = 2 * idx + 1 + parity
+        idx = 0 if idx >= len(forest_values) else idx
+    rng = np.random.default_rng(seed)
+    found = []
+    while sum(map(len, found)) < batch_size:
+        candidates = rng.integers(
+            0, 2**30, min(batch_size << len(nodes), 1 << 22), dtype=np.uint32
+        )
+        vals = candidates
+        for node in nodes:
+            vals = myhash_np(vals ^ np.uint32(node))
+            keep = (vals & 1) == parity
+            candidates, vals = candidates[keep], vals[keep]
+        found.append(candidates)
+    return np.concatenate(found)[:batch_size].tolist()
+
+
+def make_problem(
+    forest_height: int, rounds: int, batch_size: int, mode: str, seed: int
+) -> list[int]:
+    """The memory image of a problem of this shape made in a value mode"""
+    rng = random.Random(seed)
+    n_nodes = 2 ** (forest_height + 1) - 1
+    if mode == "extreme":
+
+        def word():
+            return rng.choice(EXTREMES) if rng.random() < 0.75 else rng.getrandbits(32)
+
+        forest = Tree(forest_height, [word() for _ in range(n_nodes)])
+        values = [word() for _ in range(batch_size)]
+    else:
+        nodes = [rng.randint(0, 2**30 - 1) for _ in range(n_nodes)]
+        forest = Tree(forest_height, nodes)
+        if mode == "random":
+            values = [rng.randint(0, 2**30 - 1) for _ in range(batch_size)]
+        else:
+            parity = VALUE_MODES.index(mode) - 1
+            values = parity_values(nodes, rounds, batch_size, parity, seed)
+    return build_mem_image(forest, Input([0] * batch_size, values, rounds))
+
+
+def check(case: Case, reference: str = "numpy") -> str | None:
+    """What went wrong with the kernel on the case, or None if it's right"""
+    shape = (case.forest_height, case.rounds, case.batch_size)
+    mems = [make_problem(*shape, mode, seed) for mode, seed in case.problems]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            kb = KernelBuilder(**case.params)
+            n_nodes = 2 ** (case.forest_height + 1) - 1
+            kb.build_kernel(case.forest_height, n_nodes, case.batch_size, case.rounds)
+    except Exception as e:
+        return f"build failed, {type(e).__name__}: {e}"
+    machine = BatchMachine(mems, kb.instrs, kb.debug_info(), n_cores=N_CORES)
+    refs = [REFERENCE_KERNELS[reference](mem) for mem in mems]
+    try:
+        for i, ref_mems in enumerate(zip(*refs)):
+            machine.run()
+            for (mode, seed), mem, ref in zip(case.problems, machine.mem, ref_mems):
+                values = slice(ref[6], ref[6] + case.batch_size)
+                if list(mem[values]) != list(ref[values]):
+                    return f"wrong values after round {i} of the {mode} problem {seed}"
+    except Exception as e:
+        return f"{type(e).__name__} while running: {e}"
+    return None
+
+
+def random_case(
+    rng: random.Random,
+    max_height: int,
+    max_rounds: int,
+    max_batches: int,
+    problems: int,
+) -> Case:
+    params = {name: rng.choice(values) for name, values in PARAM_SPACE.items()}
+    if rng.random() < 0.5:
+        params["passes"] = [p for p in OPT_PASSES if rng.random() < 0.7]
+    return Case(
+        forest_height=rng.randint(0, max_height),
+        rounds=rng.randint(1, max_rounds),
+        batch_size=VLEN * N_CORES * rng.randint(1, max_batches),
+        params=params,
+        problems=[
+            (VALUE_MODES[i % len(VALUE_MODES)], rng.getrandbits(32))
+            for i in range(problems)
+        ],
+    )
+
+
+def smaller_cases(case: Case):
+    """Variants of a case with one thing made smaller, smallest first"""
+    if len(case.problems) > 1:
+        for problem in case.problems:
+            yield Case(**dict(asdict(case), problems=[problem]))
+    for height in range(case.forest_height):
+        yield Case(**dict(asdict(case), forest_height=height))
+    for rounds in range(1, case.rounds):
+        yield Case(**dict(asdict(case), rounds=rounds))
+    for batch_size in range(VLEN * N_CORES, case.batch_size, VLEN * N_CORES):
+        yield Case(**dict(asdict(case), batch_size=batch_size))
+    for name in case.params:
+        params = {k: v for k, v in case.params.items() if k != name}
+        yield Case(**dict(asdict(case), params=params))
+    passes = case.params.get("passes", [])
+    for i in range(len(passes)):
+        params = dict(case.params, passes=passes[:i] + passes[i + 1 :])
+        yield Case(**dict(asdict(case), params=params))
+
+
+def shrink(case: Case, failure: str, reference: str = "numpy") -> tuple[Case, str]:
+    """
+    Keep replacing a failing case with the first smaller variant that still
+    fails, until none does. Returns the last case and how it failed.
+    """
+    while True:
+        for smaller in smaller_cases(case):
+            result = check(smaller, reference)
+            if result is not None:
+                case, failure = smaller, result
+                break
+        else:
+            return case, failure
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz the kernel.")
+    parser.add_argument("--cases", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--max-height", type=int, default=10)
+    parser.add_argument("--max-rounds", type=int, default=16)
+    parser.add_argument(
+        "--max-batches",
+        type=int,
+        default=16,
+        help="largest batch size, in multiples of VLEN * N_CORES",
+    )
+    parser.add_argument(
+        "--problems", type=int, default=8, help="problems run together per case"
+    )
+    parser.add_argument("--reference", default="numpy")
+    parser.add_argument("--replay", help="check just this case, as printed")
+    args = parser.parse_args()
+
+    if args.replay:
+        case = Case(**json.loads(args.replay))
+        case.problems = [tuple(p) for p in case.problems]
+        failure = check(case, args.reference)
+        print(failure or "The case passes")
+        sys.exit(1 if failure else 0)
+
+    seed = random.randrange(2**32) if args.seed is None else args.seed
+    print(f"Fuzzing {args.cases} cases with --seed {seed}")
+    rng = random.Random(seed)
+    cases = [
+        random_case(
+            rng, args.max_height, args.max_rounds, args.max_batches, args.problems
+        )
+        for _ in range(args.cases)
+    ]
+    failures = []
+    with ProcessPoolExecutor(args.workers) as pool:
+        futures = {pool.submit(check, case, args.reference): case for case in cases}
+        for n, future in enumerate(as_completed(futures), 1):
+            case, failure = futures[future], future.result()
+            if failure is not None:
+                failures.append((case, failure))
+            print(f"[{n}/{len(cases)}] {len(failures)} failing")
+    for case, failure in failures:
+        case, failure = shrink(case, failure, args.reference)
+        print(f"\nFAIL {failure}")
+        print(f"  python fuzz.py --replay '{json.dumps(asdict(case))}'")
+    if failures:
+        sys.exit(1)
+    print("Every case matches the reference")
+
+
+if __name__ == "__main__":
+    main()
@@ -64,26 +64,771 @@ to publish or redistribute.
 We recommend you read through problem.py next.
 """
 
+from bisect import bisect_right
+from collections import defaultdict, deque
+from dataclasses import dataclass
+import gzip
+import heapq
+import json
+import os
 import random
+import tempfile
+import time
 import unittest
 
 from problem import *
 
+# Pseudo-addresses for state that slots depend on outside of scratch. Memory
+# addresses are only known at runtime, so all of main memory is one location.
+MEM = -1
+TRACE = -2
+
+# Flow ops that end a straight-line region: nothing may move across them
+BARRIER_OPS = {"halt", "pause", "jump", "jump_indirect", "cond_jump", "cond_jump_rel"}
+
+# Most bundles a kernel may have. The simulator doesn't bound the program,
+# but anything longer is a sign of unrolling gone too far.
+INSTR_LIMIT = 1 << 16
+
+# Scratch words unrolled loops leave free when taking copies of private scratch
+UNROLL_SCRATCH_RESERVE = 64
+
+# Virtual registers are numbered from here up, far above scratch, until
+# KernelBuilder.allocate maps them onto it
+VREG_BASE = 1 << 20
+
+# KernelBuilder.optimize's passes, in the order they run
+OPT_PASSES = ["masks", "rename", "strength", "cse", "copies", "dead"]
+
+# Ops that give back their left operand when the right one is this constant,
+# and those that don't care which side it's on. Values wrap at 2**32, so
+# masking with all ones does nothing.
+IDENTITIES = {
+    "+": 0,
+    "-": 0,
+    "^": 0,
+    "|": 0,
+    "<<": 0,
+    ">>": 0,
+    "*": 1,
+    "//": 1,
+    "&": 2**32 - 1,
+}
+COMMUTATIVE = {"+", "*", "^", "&", "|", "=="}
+
+# Flow ops that only write their destination
+PURE_FLOW_OPS = {"select", "vselect", "coreid"}
+
+
+def vec(addr):
+    return range(addr, addr + VLEN)
+
+
+def fuse_hash_stage(stage: tuple) -> tuple:
+    """
+    A HASH_STAGES entry in fewer ops. (a + C) + (a << k) is a * (1 + 2**k)
+    + C mod 2**32, one multiply and one add instead of three ops, which
+    comes back as ("madd", 1 + 2**k, C). Other stages come back as is.
+    """
+    match stage:
+        case ("+", c, "+", "<<", k):
+            return ("madd", 1 + 2**k, c)
+    return stage
+
+
+def slot_reads_writes(engine: str, slot: tuple) -> tuple[list[int], list[int]]:
+    """
+    The scratch addresses (plus MEM and TRACE) a slot reads and writes
+    """
+    match engine, slot:
+        case "alu", (_, dest, a1, a2):
+            return [a1, a2], [dest]
+        case "valu", ("vbroadcast", dest, src):
+            return [src], [*vec(dest)]
+        case "valu", (_, dest, a1, a2):
+            return [*vec(a1), *vec(a2)], [*vec(dest)]
+        case "load", ("load", dest, addr):
+            return [addr, MEM], [dest]
+        case "load", ("load_offset", dest, addr, offset):
+            return [addr + offset, MEM], [dest + offset]
+        case "load", ("vload", dest, addr):
+            return [addr, MEM], [*vec(dest)]
+        case "load", ("const", dest, _):
+            return [], [dest]
+        case "store", ("store", addr, src):
+            return [addr, src], [MEM]
+        case "store", ("vstore", addr, src):
+            return [addr, *vec(src)], [MEM]
+        case "flow", ("select", dest, cond, a, b):
+            return [cond, a, b], [dest]
+        case "flow", ("vselect", dest, cond, a, b):
+            return [*vec(cond), *vec(a), *vec(b)], [*vec(dest)]
+        case "flow", ("trace_write", val):
+            return [val], [TRACE]
+        case "flow", ("coreid", dest):
+            return [], [dest]
+        case "flow", ("cond_jump" | "cond_jump_rel", cond, _):
+            return [cond], []
+        case "flow", ("jump_indirect", addr):
+            return [addr], []
+    return [], []
+
+
+def slot_deps(
+    slots: list[tuple[Engine, tuple]], rw: list[tuple[list, list]] | None = None
+) -> list[list[tuple[int, int]]]:
+    """
+    Dependency edges between slots in program order, as succs[i] = [(j,
+    latency)] meaning slot j can go at the earliest latency cycles after i.
+
+    Writes land at the end of the cycle, so a read after a write (and a
+    write after a write on another engine) needs latency 1, while a write
+    after a read can share the reader's bundle. Two writes on the same
+    engine can share a bundle too, as slots keep program order within an
+    engine and the later write wins. Barriers (jumps, halt, pause) keep
+    everything before them at or before their bundle and everything after
+    them strictly later. Debug slots stay between their neighbours.
+
+    rw optionally overrides slot_reads_writes for each slot.
+    """
+    succs = [[] for _ in slots]
+    last_write = {}
+    reads_since_write = defaultdict(list)
+    region = []
+    barrier = None
+    for j, (engine, slot) in enumerate(slots):
+        edges = {}
+
+        def dep(i, latency):
+            if i != j:
+                edges[i] = max(edges.get(i, 0), latency)
+
+        if barrier is not None:
+            dep(barrier, 1)
+        if engine == "debug":
+            if j > 0:
+                dep(j - 1, 0)
+        elif j > 0 and slots[j - 1][0] == "debug":
+            dep(j - 1, 0)
+        reads, writes = rw[j] if rw else slot_reads_writes(engine, slot)
+        for addr in reads:
+            if addr in last_write:
+                dep(last_write[addr], 1)
+        for addr in writes:
+            for i in reads_since_write[addr]:
+                dep(i, 0)
+            if addr in last_write:
+                i = last_write[addr]
+                dep(i, 0 if slots[i][0] == engine else 1)
+        if engine == "flow" and slot[0] in BARRIER_OPS:
+            for i in region:
+                dep(i, 0)
+            barrier, region = j, []
+        region.append(j)
+        for addr in reads:
+            reads_since_write[addr].append(j)
+        for addr in writes:
+            last_write[addr] = j
+            reads_since_write[addr] = []
+        for i, latency in edges.items():
+            succs[i].append((j, latency))
+    return succs
+
+
+def list_schedule(
+    slots: list[tuple[Engine, tuple]], rw: list[tuple[list, list]] | None = None
+) -> list[Instruction]:
+    """
+    Pack slots into as few bundles as possible with a greedy list scheduler.
+    Each cycle, every engine takes the ready slots with the longest path to
+    the end of the program first, up to its SLOT_LIMITS. rw is passed on to
+    slot_deps.
+    """
+    n = len(slots)
+    succs = slot_deps(slots, rw)
+    n_preds = [0] * n
+    for edges in succs:
+        for j, _ in edges:
+            n_preds[j] += 1
+    height = [0] * n
+    for i in reversed(range(n)):
+        for j, latency in succs[i]:
+            height[i] = max(height[i], height[j] + latency)
+
+    earliest = [0] * n
+    ready = defaultdict(list)
+    waiting = []
+
+    def release(j, cycle):
+        if earliest[j] <= cycle:
+            heapq.heappush(ready[slots[j][0]], (-height[j], j))
+        else:
+            heapq.heappush(waiting, (earliest[j], j))
+
+    for j in range(n):
+        if n_preds[j] == 0:
+            release(j, 0)
+    bundles = []
+    cycle = 0
+    while waiting or any(ready.values()):
+        while waiting and waiting[0][0] <= cycle:
+            release(heapq.heappop(waiting)[1], cycle)
+        bundle = defaultdict(list)
+        placed = True
+        while placed:
+            placed = False
+            for engine, heap in list(ready.items()):
+                limit = SLOT_LIMITS.get(engine, n)
+                while heap and len(bundle[engine]) < limit:
+                    _, i = heapq.heappop(heap)
+                    bundle[engine].append(i)
+                    placed = True
+                    for j, latency in succs[i]:
+                        earliest[j] = max(earliest[j], cycle + latency)
+                        n_preds[j] -= 1
+                        if n_preds[j] == 0:
+                            release(j, cycle)
+        bundles.append(
+            {
+                engine: [slots[i][1] for i in sorted(idxs)]
+                for engine, idxs in sorted(bundle.items(), key=lambda e: min(e[1]))
+                if idxs
+            }
+        )
+        cycle += 1
+    return bundles
+
+
+def resource_bound(slots: list[tuple[Engine, tuple]]) -> float:
+    """
+    The fewest cycles per run of slots given SLOT_LIMITS, ignoring
+    dependencies, as when many runs of a loop body overlap
+    """
+    counts = defaultdict(int)
+    for engine, _ in slots:
+        if engine != "debug":
+            counts[engine] += 1
+    return max((n / SLOT_LIMITS[e] for e, n in counts.items()), default=0)
+
+
+def map_slot_addrs(engine: str, slot: tuple, f) -> tuple:
+    """
+    Rewrite the scratch addresses a slot refers to. f(addr, length) gives the
+    new address of the length words starting at addr.
+    """
+    match engine, slot:
+        case "alu", (op, dest, a1, a2):
+            return (op, f(dest, 1), f(a1, 1), f(a2, 1))
+        case "valu", ("vbroadcast", dest, src):
+            return ("vbroadcast", f(dest, VLEN), f(src, 1))
+        case "valu", (op, dest, a1, a2):
+            return (op, f(dest, VLEN), f(a1, VLEN), f(a2, VLEN))
+        case "load", ("load", dest, addr):
+            return ("load", f(dest, 1), f(addr, 1))
+        case "load", ("load_offset", dest, addr, offset):
+            dest, addr = f(dest + offset, 1), f(addr + offset, 1)
+            return ("load_offset", dest - offset, addr - offset, offset)
+        case "load", ("vload", dest, addr):
+            return ("vload", f(dest, VLEN), f(addr, 1))
+        case "load", ("const", dest, val):
+            return ("const", f(dest, 1), val)
+        case "store", ("store", addr, src):
+            return ("store", f(addr, 1), f(src, 1))
+        case "store", ("vstore", addr, src):
+            return ("vstore", f(addr, 1), f(src, VLEN))
+        case "flow", ("select", dest, cond, a, b):
+            return ("select", f(dest, 1), f(cond, 1), f(a, 1), f(b, 1))
+        case "flow", ("vselect", dest, cond, a, b):
+            return ("vselect", *(f(x, VLEN) for x in (dest, cond, a, b)))
+        case "flow", ("trace_write" | "coreid" | "jump_indirect" as op, addr):
+            return (op, f(addr, 1))
+        case "flow", ("cond_jump" | "cond_jump_rel" as op, cond, target):
+            return (op, f(cond, 1), target)
+    return slot
+
+
+def slot_dest(engine: str, slot: tuple) -> tuple[int, int] | None:
+    """The scratch a slot writes as (address, length), or None"""
+    writes = [a for a in slot_reads_writes(engine, slot)[1] if a >= 0]
+    return (writes[0], len(writes)) if writes else None
+
+
+def map_slot_reads(engine: str, slot: tuple, f) -> tuple:
+    """map_slot_addrs for only the addresses a slot reads"""
+    mapped = map_slot_addrs(engine, slot, f)
+    if slot_dest(engine, slot) is None:
+        return mapped
+    return (mapped[0], slot[1], *mapped[2:])
+
+
+def with_dest(engine: str, slot: tuple, addr: int) -> tuple:
+    """A slot writing its result to addr instead"""
+    dest, _ = slot_dest(engine, slot)
+    return (slot[0], slot[1] + addr - dest, *slot[2:])
+
+
+def place_slot(bundles: list[Instruction], engine: Engine, slot: tuple, start=0) -> int:
+    """
+    Add a slot to the first bundle from start on with a free slot for its
+    engine, or to a new bundle at the end. Returns the bundle's index.
+    """
+    for i in range(start, len(bundles)):
+        if len(bundles[i].get(engine, [])) < SLOT_LIMITS[engine]:
+            bundles[i].setdefault(engine, []).append(slot)
+            return i
+    bundles.append({engine: [slot]})
+    return len(bundles) - 1
+
+
+def annotate(instr: Instruction, *slot) -> Instruction:
+    """
+    Add a debug slot to a bundle for analyze.py, which the machine ignores:
+    ("trip_count", n) on a loop's backwards jump says the loop runs n times
+    each time it's entered, and ("taken", p) on a forward cond_jump says
+    it's taken that fraction of the times it runs. ("label", name) marks
+    where a part of the program starts, for KernelBuilder.collect_labels.
+    """
+    instr.setdefault("debug", []).append(slot)
+    return instr
+
+
+class Label:
+    """
+    A jump target for code that doesn't know where it'll end up in the
+    program. A jump or cond_jump takes one in place of a pc, place() marks
+    where it points and resolve_labels turns both into pcs once the program
+    is complete. Labels are compared by identity, so two with the same name
+    are different targets.
+    """
+
+    def __init__(self, name: str = ""):
+        self.name = name
+
+    def __repr__(self):
+        return f"Label({self.name!r})"
+
+
+def place(label: Label) -> Instruction:
+    """
+    A marker bundle for label that points it at the next real bundle, and
+    takes up no cycles once resolve_labels removes it
+    """
+    return {"debug": [("target", label)]}
+
+
+def is_marker(instr: Instruction) -> bool:
+    return set(instr) == {"debug"} and any(s[0] == "target" for s in instr["debug"])
+
+
+def jump_target(slot: tuple, pc: int) -> int | Label | None:
+    """Where a flow slot at pc jumps, if it's a jump to a known place"""
+    match slot:
+        case ("jump", target) | ("cond_jump", _, target):
+            return target
+        case ("cond_jump_rel", _, offset):
+            return pc + 1 + offset
+    return None
+
+
+def retarget(slot: tuple, f) -> tuple:
+    """A flow slot with its absolute jump target, if it has one, mapped by f"""
+    match slot:
+        case ("jump", target):
+            return ("jump", f(target))
+        case ("cond_jump", cond, target):
+            return ("cond_jump", cond, f(target))
+    return slot
+
+
+def resolve_labels(instrs: list[Instruction]) -> list[Instruction]:
+    """
+    The program with its marker bundles (see place) taken out and jumps to
+    labels pointing at the bundles the labels mark. Other debug slots on a
+    marker move to the bundle after it.
+    """
+    pcs = {}
+    resolved = []
+    carried = []
+    for instr in instrs:
+        if is_marker(instr):
+            for slot in instr["debug"]:
+                if slot[0] == "target":
+                    pcs[slot[1]] = len(resolved)
+                else:
+                    carried.append(slot)
+            continue
+        instr = dict(instr)
+        if carried:
+            instr["debug"] = carried + instr.get("debug", [])
+            carried = []
+        resolved.append(instr)
+
+    def pc_of(target):
+        if not isinstance(target, Label):
+            return target
+        assert target in pcs, f"{target} is jumped to but never placed"
+        return pcs[target]
+
+    for instr in resolved:
+        if "flow" in instr:
+            instr["flow"] = [retarget(slot, pc_of) for slot in instr["flow"]]
+    return resolved
+
+
+def relocate(instrs: list[Instruction], start: int = 0) -> list[Instruction]:
+    """
+    A copy of code, with the labels placed in it swapped for new ones so
+    the copy can go in the same program as the original. Absolute jump
+    targets that are pcs, from code built to be placed at address 0, are
+    moved so it can be placed at start instead.
+    """
+    fresh = {
+        slot[1]: Label(slot[1].name)
+        for instr in instrs
+        if is_marker(instr)
+        for slot in instr["debug"]
+        if slot[0] == "target"
+    }
+
+    def move(target):
+        if isinstance(target, Label):
+            return fresh.get(target, target)
+        return target + start
+
+    def copy_slot(engine, slot):
+        if engine == "flow":
+            return retarget(slot, move)
+        if engine == "debug" and slot[0] == "target":
+            return ("target", move(slot[1]))
+        return slot
+
+    return [
+        {e: [copy_slot(e, s) for s in slots] for e, slots in instr.items()}
+        for instr in instrs
+    ]
+
+
+@dataclass
+class BasicBlock:
+    """
+    A straight-line run of bundles from a program, only entered at the top
+    and only left from the bottom, as split up by basic_blocks
+    """
+
+    label: Label
+    # Where the block was in the program
+    start: int
+    # With jumps going to blocks' labels
+    instrs: list[Instruction]
+    # Where control goes when the last bundle doesn't jump, None if it
+    # always does or halts
+    fallthrough: Label | None
+    # Runs of the block's first bundle over every core, from a profile
+    count: int = 0
+
+    def successors(self) -> list[Label]:
+        targets = []
+        for slot in self.instrs[-1].get("flow", []) if self.instrs else []:
+            target = jump_target(slot, 0)
+            if isinstance(target, Label):
+                targets.append(target)
+        if self.fallthrough is not None:
+            targets.append(self.fallthrough)
+        return targets
+
+
+def basic_blocks(instrs: list[Instruction], exit: Label) -> list[BasicBlock]:
+    """
+    Split a program with resolved jumps into basic blocks, which start at
+    jump targets and after bundles with control flow. Jump targets become
+    the labels of the blocks they start, or exit for pcs past the end of the
+    program, with relative jumps made absolute. Indirect jumps go to pcs
+    only known when the program runs, so programs with them can't be split.
+    """
+    starts = {0}
+    for pc, instr in enumerate(instrs):
+        for slot in instr.get("flow", []):
+            assert slot[0] != "jump_indirect", "Can't split up indirect jumps"
+            if slot[0] in BARRIER_OPS:
+                starts.add(pc + 1)
+            target = jump_target(slot, pc)
+            if target is not None:
+                assert target >= 0, f"Jump to pc {target} at {pc}"
+                starts.add(target)
+    starts = sorted(s for s in starts if s < len(instrs))
+    labels = {start: Label(f"pc {start}") for start in starts}
+
+    def label_of(pc):
+        return labels[pc] if pc < len(instrs) else exit
+
+    blocks = []
+    for start, end in zip(starts, starts[1:] + [len(instrs)]):
+        code = []
+        for pc in range(start, end):
+            instr = dict(instrs[pc])
+            if "flow" in instr:
+                flow = []
+                for slot in instr["flow"]:
+                    if slot[0] == "cond_jump_rel":
+                        slot = ("cond_jump", slot[1], jump_target(slot, pc))
+                    flow.append(retarget(slot, label_of))
+                instr["flow"] = flow
+            code.append(instr)
+        ends = {slot[0] for slot in code[-1].get("flow", [])}
+        fallthrough = None if ends & {"jump", "halt"} else label_of(end)
+        blocks.append(BasicBlock(labels[start], start, code, fallthrough))
+    return blocks
+
+
+def chain_order(blocks: list[BasicBlock]) -> list[BasicBlock]:
+    """
+    The blocks ordered so the paths their counts say are hottest fall
+    through. Each edge between blocks, hottest first, puts its target
+    straight after its source if the source still ends a chain of blocks
+    and the target still starts another one. An edge is taken to run as
+    often as the less frequent of its ends. The entry block stays first,
+    and the chains go out in the program order of their first blocks.
+    """
+    by_label = {block.label: block for block in blocks}
+    edges = [
+        (min(block.count, by_label[s].count), s is not block.fallthrough, block, s)
+        for block in blocks
+        for s in block.successors()
+        if s in by_label and s is not block.label and s is not blocks[0].label
+    ]
+    chain_of = {block.label: [block] for block in blocks}
+    for _, _, source, s in sorted(edges, key=lambda e: (-e[0], e[1], e[2].start)):
+        tail, head = chain_of[source.label], chain_of[s]
+        if head is tail or tail[-1] is not source or head[0].label is not s:
+            continue
+        tail.extend(head)
+        for block in head:
+            chain_of[block.label] = tail
+    heads = [block for block in blocks if chain_of[block.label][0] is block]
+    return [b for head in heads for b in chain_of[head.label]]
+
+
+def layout(blocks: list[BasicBlock], exit: Label) -> list[Instruction]:
+    """
+    Code running the blocks in the given order, ending at exit. A jump to
+    the block right after it is dropped, with its bundle if that leaves it
+    empty, and a fallthrough to anywhere else gets a jump, in the last
+    bundle's flow slot if it's free and in a bundle of its own otherwise.
+    """
+    code = []
+    # Labels naming a dropped bundle's part of the program, see collect_labels
+    names = []
+    for i, block in enumerate(blocks):
+        after = blocks[i + 1].label if i + 1 < len(blocks) else exit
+        code.append({"debug": [("target", block.label), *names]})
+        names = []
+        instrs = [dict(instr) for instr in block.instrs]
+        last = instrs[-1]
+        if last.get("flow") == [("jump", after)]:
+            del last["flow"]
+            if set(last) <= {"debug"}:
+                names = [s for s in instrs.pop().get("debug", []) if s[0] == "label"]
+        elif block.fallthrough is not None and block.fallthrough is not after:
+            jump = ("jump", block.fallthrough)
+            if len(last.get("flow", [])) < SLOT_LIMITS["flow"]:
+                last["flow"] = last.get("flow", []) + [jump]
+            else:
+                instrs.append({"flow": [jump]})
+        code.extend(instrs)
+    code.append({"debug": [("target", exit), *names]})
+    return code
+
+
+def private_scratch(body: list[tuple[Engine, tuple]]) -> set[int]:
+    """
+    Scratch a loop body writes before reading it, so each iteration has its
+    own value and iterations can use separate copies of it
+    """
+    seen, local = set(), set()
+    for engine, slot in body:
+        reads, writes = slot_reads_writes(engine, slot)
+        seen.update(reads)
+        local.update(a for a in writes if a >= 0 and a not in seen)
+        seen.update(writes)
+    return local
+
+
+def live_after(
+    slots: list[tuple[Engine, tuple]], live_out: set[int]
+) -> list[set[int]]:
+    """The scratch each slot leaves live, given what's live after them all"""
+    live = set(live_out)
+    after = []
+    for engine, slot in reversed(slots):
+        after.append(set(live))
+        reads, writes = slot_reads_writes(engine, slot)
+        live.difference_update(writes)
+        live.update(reads)
+    return after[::-1]
+
+
+def remove_dead(
+    slots: list[tuple[Engine, tuple]], live_out: set[int]
+) -> list[tuple[Engine, tuple]]:
+    """
+    slots without those whose results are overwritten or left unused after
+    them all before anything reads them. Memory, the trace and control flow
+    always count as used.
+    """
+    live = set(live_out)
+    kept = []
+    for engine, slot in reversed(slots):
+        reads, writes = slot_reads_writes(engine, slot)
+        pure = engine in ("alu", "valu", "load") or slot[0] in PURE_FLOW_OPS
+        if pure and writes and live.isdisjoint(writes):
+            continue
+        live.difference_update(writes)
+        live.update(reads)
+        kept.append((engine, slot))
+    return kept[::-1]
+
+
+def expression(engine: str, slot: tuple, versions: dict[int, int]) -> tuple | None:
+    """
+    What a slot computes, as its op and the versions of everything it reads,
+    or None if it has side effects
+    """
+    if engine not in ("alu", "valu", "load") and slot[0] not in PURE_FLOW_OPS:
+        return None
+    reads, _ = slot_reads_writes(engine, slot)
+    operands = tuple((a, versions[a]) for a in reads)
+    if engine in ("alu", "valu") and slot[0] in COMMUTATIVE:
+        half = len(operands) // 2
+        operands = tuple(sorted([operands[:half], operands[half:]]))
+    return (engine, slot[0], slot[2] if slot[0] == "const" else None, operands)
+
+
+def modulo_schedule(
+    slots: list[tuple[Engine, tuple]], local: set[int], mem_disjoint: bool = False
+) -> tuple[int, list[int]]:
+    """
+    Iterative modulo scheduling of a loop body. Returns the initiation
+    interval II and the cycle of each slot within an iteration, such that
+    starting a new iteration every II cycles respects SLOT_LIMITS and every
+    dependency, including the ones between consecutive iterations.
+
+    Addresses in local are private to an iteration (they get renamed per
+    iteration), so only the other addresses carry dependencies from one
+    iteration to the next. With mem_disjoint, iterations touch disjoint
+    memory, so memory doesn't either.
+    """
+    n = len(slots)
+    rw = [slot_reads_writes(engine, slot) for engine, slot in slots]
+    fresh = -(1 << 30)
+
+    def next_iter(addr):
+        if addr in local or (mem_disjoint and addr == MEM):
+            return addr + fresh
+        return addr
+
+    rw_next = [
+        ([next_iter(a) for a in reads], [next_iter(a) for a in writes])
+        for reads, writes in rw
+    ]
+    edges = slot_deps(slots + slots, rw + rw_next)
+    intra = [[(j, lat) for j, lat in edges[i] if j < n] for i in range(n)]
+    carried = [(i, j - n, lat) for i in range(n) for j, lat in edges[i] if j >= n]
+
+    counts = defaultdict(int)
+    for engine, _ in slots:
+        counts[engine] += 1
+    ii = max(cdiv(counts[e], SLOT_LIMITS[e]) for e in counts)
+    height = [0] * n
+    for i in reversed(range(n)):
+        for j, latency in intra[i]:
+            height[i] = max(height[i], height[j] + latency)
+    carried_into = defaultdict(list)
+    for i, j, latency in carried:
+        carried_into[j].append((i, latency))
+
+    while True:
+        times = [None] * n
+        n_preds = [0] * n
+        for i in range(n):
+            for j, _ in intra[i]:
+                n_preds[j] += 1
+        earliest = [0] * n
+        used = defaultdict(int)
+        ready = [(-height[j], j) for j in range(n) if n_preds[j] == 0]
+        heapq.heapify(ready)
+        while ready:
+            _, j = heapq.heappop(ready)
+            engine = slots[j][0]
+            start = earliest[j]
+            for i, latency in carried_into[j]:
+                if times[i] is not None:
+                    start = max(start, times[i] + latency - ii)
+            for t in range(start, start + ii):
+                if used[(engine, t % ii)] < SLOT_LIMITS[engine]:
+                    break
+            else:
+                break
+            used[(engine, t % ii)] += 1
+            times[j] = t
+            for k, latency in intra[j]:
+                earliest[k] = max(earliest[k], t + latency)
+                n_preds[k] -= 1
+                if n_preds[k] == 0:
+                    heapq.heappush(ready, (-height[k], k))
+        if None not in times and all(
+            times[j] + ii >= times[i] + latency for i, j, latency in carried
+        ):
+            return ii, times
+        ii += 1
+
 
 class KernelBuilder:
-    def __init__(self):
+    def __init__(
+        self,
+        unroll_rounds: int | None = 1,
+        unroll_batches: int | None = 1,
+        max_instrs: int = INSTR_LIMIT,
+        tree_cache_levels: int | None = None,
+        passes: list[str] | None = None,
+    ):
+        """
+        unroll_rounds and unroll_batches are how many iterations of the round
+        and batch loops build_kernel emits as straight-line code per loop
+        iteration, with None unrolling the loop entirely. 1 keeps the loops
+        (the batch loop is then software pipelined). The program must fit in
+        max_instrs bundles.
+
+        build_kernel keeps the top tree_cache_levels levels of the tree in
+        scratch instead of gathering node values from memory, by default as
+        many as pay off.
+
+        The batch loop bodies go through the optimize passes named in passes,
+        by default all of OPT_PASSES, with the slots each pass saved added up
+        in pass_savings.
+        """
         self.instrs = []
         self.labels = {}
         self.scratch = {}
         self.scratch_debug = {}
         self.scratch_ptr = 0
         self.const_map = {}
+        self.vconst_map = {}
+        self.vregs = {}
+        self.vreg_ptr = VREG_BASE
+        self.unroll_rounds = unroll_rounds
+        self.unroll_batches = unroll_batches
+        self.max_instrs = max_instrs
+        self.tree_cache_levels = tree_cache_levels
+        self.passes = OPT_PASSES if passes is None else passes
+        self.pass_savings = dict.fromkeys(self.passes, 0)
 
     def debug_info(self):
         # Hint: This isn't consumed anywhere, but you should probably use it in some way for debugging
         return DebugInfo(scratch_map=self.scratch_debug)
 
     def build(self, slots: list[tuple[Engine, tuple]], vliw: bool = False):
+        if vliw:
+            return list_schedule(slots)
         # Simple slot packing that just uses one slot per instruction bundle
         instrs = []
         for engine, slot in slots:
@@ -96,6 +841,34 @@ class KernelBuilder:
     def label(self, name):
         self.labels[name] = len(self.instrs)
 
+    def collect_labels(self):
+        """
+        Add the ("label", name) debug slots in the program (see annotate) to
+        labels, numbering names that come up again like "round #2"
+        """
+        seen = defaultdict(int)
+        for pc, instr in enumerate(self.instrs):
+            for slot in instr.get("debug", []):
+                if slot[0] == "label":
+                    seen[slot[1]] += 1
+                    n = seen[slot[1]]
+                    self.labels[slot[1] if n == 1 else f"{slot[1]} #{n}"] = pc
+
+    def reorder_blocks(self, pc_counts: list[int]):
+        """
+        Lay the program's basic blocks out again by how often they ran, from
+        a machine's pc_counts after running the program, so the hottest
+        paths fall through instead of jumping (see chain_order and layout).
+        Loops that test at the top then usually have their back edge fall
+        through, saving the bundle holding the backwards jump.
+        """
+        exit = Label("exit")
+        blocks = basic_blocks(self.instrs, exit)
+        for block in blocks:
+            block.count = pc_counts[block.start]
+        self.instrs = resolve_labels(layout(chain_order(blocks), exit))
+        self.collect_labels()
+
     def alloc_scratch(self, name=None, length=1):
         addr = self.scratch_ptr
         if name is not None:
@@ -105,6 +878,148 @@ class KernelBuilder:
         assert self.scratch_ptr <= SCRATCH_SIZE, "Out of scratch space"
         return addr
 
+    def alloc_vreg(self, name=None, length=1):
+        """
+        A virtual register of length words (VLEN for a vector), usable in
+        slots like scratch. allocate() assigns it scratch later on.
+        """
+        addr = self.vreg_ptr
+        self.vregs[addr] = (name, length)
+        self.vreg_ptr += length
+        return addr
+
+    def allocate(self, instrs: list[Instruction]) -> list[Instruction]:
+        """
+        Map the virtual registers in a program onto the scratch above
+        scratch_ptr by linear scan.
+
+        Each value a register holds is live from its write to its last read
+        in program order, in half bundles since reads happen before writes
+        land, so a value last read in a bundle frees its scratch for a write
+        in the same bundle. A bundle writing all of a register without
+        reading it starts a new value, which can go elsewhere in scratch. A
+        loop (the code between a backwards jump and its target) keeps a value
+        in one place all the way through if it's live on entry or exit or is
+        read before being written inside the loop, as it then crosses the
+        back edge. Code a forward jump skips mustn't write registers that
+        are live across the jump. Freed scratch is reused oldest first,
+        which leaves the longest gap between a value's last read and the
+        next value's write.
+        """
+        bases = list(self.vregs)
+
+        def vreg_of(addr):
+            return bases[bisect_right(bases, addr) - 1] if addr >= VREG_BASE else None
+
+        # For each register and bundle using it: whether the bundle reads it,
+        # writes it, and writes all of it
+        touches = defaultdict(dict)
+        loops = []
+        for i, instr in enumerate(instrs):
+            read, written = set(), defaultdict(set)
+            for engine, slots in instr.items():
+                for slot in slots:
+                    reads, writes = slot_reads_writes(engine, slot)
+                    read.update(vreg_of(a) for a in reads)
+                    for a in writes:
+                        written[vreg_of(a)].add(a)
+                    match engine, slot:
+                        case "flow", ("jump", target) | ("cond_jump", _, target):
+                            if target <= i:
+                                loops.append((2 * target, 2 * i + 1))
+            for r in (read | set(written)) - {None}:
+                full = len(written[r]) == self.vregs[r][1]
+                touches[r][i] = (r in read, r in written, full)
+
+        # Values as [start, end, register, bundles]
+        values, value_at = [], {}
+        for r, by_bundle in touches.items():
+            first = min(by_bundle)
+            for i in sorted(by_bundle):
+                reads, writes, full = by_bundle[i]
+                if i == first or (full and not reads):
+                    values.append([2 * i + (not reads), 0, r, []])
+                values[-1][1] = 2 * i + writes
+                values[-1][3].append(i)
+                value_at[(r, i)] = len(values) - 1
+
+        changed = True
+        while changed:
+            changed = False
+            for lo, hi in loops:
+                carried = defaultdict(list)
+                for k, value in enumerate(values):
+                    if value is None or value[0] > hi or value[1] < lo:
+                        continue
+                    start, end, r, used = value
+                    first = next((i for i in used if 2 * i + 1 >= lo), None)
+                    if first is None or 2 * first > hi:
+                        continue
+                    if start < lo or end > hi or touches[r][first][0]:
+                        carried[r].append(k)
+                for r, ks in carried.items():
+                    keep = values[ks[0]]
+                    if len(ks) == 1 and keep[0] <= lo and keep[1] >= hi:
+                        continue
+                    for k in ks[1:]:
+                        keep[0] = min(keep[0], values[k][0])
+                        keep[1] = max(keep[1], values[k][1])
+                        keep[3] = sorted(keep[3] + values[k][3])
+                        for i in values[k][3]:
+                            value_at[(r, i)] = ks[0]
+                        values[k] = None
+                    keep[0], keep[1] = min(keep[0], lo), max(keep[1], hi)
+                    changed = True
+
+        free = defaultdict(deque)
+        active = []
+        top = self.scratch_ptr
+        phys = {}
+        order = sorted(
+            (value[0], k) for k, value in enumerate(values) if value is not None
+        )
+        for start, k in order:
+            while active and active[0][0] < start:
+                _, old = heapq.heappop(active)
+                free[self.vregs[values[old][2]][1]].append(phys[old])
+            r = values[k][2]
+            name, length = self.vregs[r]
+            if free[length]:
+                phys[k] = free[length].popleft()
+            else:
+                live = [
+                    self.vregs[values[a][2]][0] or f"v{values[a][2] - VREG_BASE}"
+                    for _, a in active
+                ]
+                assert top + length <= SCRATCH_SIZE, (
+                    f"Out of scratch space for {name or 'a register'} at bundle "
+                    f"{start // 2} with {len(live)} registers live: "
+                    f"{', '.join(sorted(live))}"
+                )
+                phys[k], top = top, top + length
+            heapq.heappush(active, (values[k][1], k))
+            if name is not None:
+                old_name, _ = self.scratch_debug.get(phys[k], (None, 0))
+                if old_name is not None and name not in old_name.split("/"):
+                    name = f"{old_name}/{name}"
+                self.scratch_debug[phys[k]] = (name or old_name, length)
+        self.scratch_ptr = top
+
+        def to_scratch(i):
+            def f(addr, length):
+                r = vreg_of(addr)
+                return addr if r is None else phys[value_at[(r, i)]] + addr - r
+
+            return f
+
+        return [
+            {
+                e: [map_slot_addrs(e, slot, to_scratch(i)) for slot in slots]
+                for e, slots in instr.items()
+            }
+            for i, instr in enumerate(instrs)
+        ]
+
     def scratch_const(self, val, name=None):
         if val not in self.const_map:
             addr = self.alloc_scratch(name)
@@ -112,24 +1027,545 @@ class KernelBuilder:
             self.const_map[val] = addr
         return self.const_map[val]
 
-    def for_loop(self, iter_addr, limit_addr, body: list[Instruction]):
+    def scratch_vconst(self, val, name=None):
+        """A vector of val in every lane, like scratch_const"""
+        if val not in self.vconst_map:
+            addr = self.alloc_scratch(name, VLEN)
+            self.add("valu", ("vbroadcast", addr, self.scratch_const(val)))
+            self.vconst_map[val] = addr
+        return self.vconst_map[val]
+
+    def const_values(self) -> dict[tuple[int, int], int]:
+        """The value of each constant in scratch by (address, length)"""
+        values = {(addr, 1): val for val, addr in self.const_map.items()}
+        values.update(((addr, VLEN), val) for val, addr in self.vconst_map.items())
+        return values
+
+    def copy_source(self, engine: str, slot: tuple, consts: dict) -> int | None:
+        """
+        The address an identity op like x + 0 or x & 0xFFFFFFFF copies its
+        result from, or None for other slots. consts is const_values().
+        """
+        if engine not in ("alu", "valu") or slot[0] not in IDENTITIES:
+            return None
+        op, _, a1, a2 = slot
+        n = 1 if engine == "alu" else VLEN
+        if consts.get((a2, n)) == IDENTITIES[op]:
+            return a1
+        if op in COMMUTATIVE and consts.get((a1, n)) == IDENTITIES[op]:
+            return a2
+        return None
+
+    def optimize(
+        self, slots: list[tuple[Engine, tuple]], live_out: set[int] | None = None
+    ) -> list[tuple[Engine, tuple]]:
+        """
+        Run straight-line slots through the passes in self.passes before
+        they're scheduled, adding the slots each pass saved to pass_savings.
+
+        live_out is the scratch whose values are still needed after the
+        slots. By default they're a loop body, whose private scratch (see
+        private_scratch) is dead after each iteration as modulo_loop assumes,
+        so only the scratch carried between iterations is live.
+        """
+        if live_out is None:
+            written = {a for e, slot in slots for a in slot_reads_writes(e, slot)[1]}
+            live_out = written - private_scratch(slots)
+        steps = {
+            "masks": self.drop_identities,
+            "rename": self.rename_values,
+            "strength": self.reduce_strength,
+            "cse": self.eliminate_common,
+            "copies": lambda slots: self.propagate_copies(slots, live_out),
+            "dead": lambda slots: remove_dead(slots, live_out),
+        }
+        for name in self.passes:
+            before = len(slots)
+            slots = steps[name](slots)
+            self.pass_savings[name] += before - len(slots)
+        return slots
+
+    def drop_identities(
+        self, slots: list[tuple[Engine, tuple]]
+    ) -> list[tuple[Engine, tuple]]:
+        """
+        Identity ops writing back to where they read from, like masking with
+        v_mask after every valu op when values wrap at 2**32 anyway
+        """
+        consts = self.const_values()
+        kept = []
+        for engine, slot in slots:
+            src = self.copy_source(engine, slot, consts)
+            if src is None or src != slot[1]:
+                kept.append((engine, slot))
+        return kept
+
+    def rename_values(
+        self, slots: list[tuple[Engine, tuple]]
+    ) -> list[tuple[Engine, tuple]]:
         """
-        A for loop that runs len times
+        Give each value a virtual register takes on its own register, so the
+        other passes see values instead of reused names. A slot writing all
+        of a register gets a fresh one unless it's the last to write it, and
+        reads up to the next such write follow it. Registers only written in
+        part somewhere are left alone.
         """
+        bases = list(self.vregs)
+
+        def vreg_of(addr):
+            return bases[bisect_right(bases, addr) - 1] if addr >= VREG_BASE else None
+
+        last_write, partial = {}, set()
+        for i, (engine, slot) in enumerate(slots):
+            dest = slot_dest(engine, slot)
+            if dest is None:
+                continue
+            r = vreg_of(dest[0])
+            if r == dest[0] and self.vregs[r][1] == dest[1]:
+                last_write[r] = i
+            elif r is not None:
+                partial.add(r)
+
+        current = {}
+
+        def rename(addr, length):
+            r = vreg_of(addr)
+            return addr if r is None else current.get(r, r) + addr - r
+
+        renamed = []
+        for i, (engine, slot) in enumerate(slots):
+            slot = map_slot_reads(engine, slot, rename)
+            dest = slot_dest(engine, slot)
+            r = dest and dest[0]
+            if r in last_write and r not in partial:
+                current[r] = r
+                if i < last_write[r]:
+                    current[r] = self.alloc_vreg(*self.vregs[r])
+                slot = with_dest(engine, slot, current[r])
+            renamed.append((engine, slot))
+        return renamed
+
+    def reduce_strength(
+        self, slots: list[tuple[Engine, tuple]]
+    ) -> list[tuple[Engine, tuple]]:
+        """
+        Cheaper forms of ops: x % 2**k is x & (2**k - 1) and x // 2**k is
+        x >> k. A select on b == 0 selects on b with its arms swapped
+        instead, which leaves the == to dead-store removal.
+        """
+        consts = self.const_values()
+        # (address, length) of values known to be b == 0, mapped to b
+        negations = {}
+        reduced = []
+        for engine, slot in slots:
+            n = VLEN if engine == "valu" or slot[0] == "vselect" else 1
+            op = slot[0]
+            if engine in ("alu", "valu") and op in ("%", "//"):
+                c = consts.get((slot[3], n), 0)
+                if c > 0 and c & (c - 1) == 0:
+                    const = self.scratch_const if n == 1 else self.scratch_vconst
+                    if op == "%":
+                        slot = ("&", slot[1], slot[2], const(c - 1))
+                    else:
+                        slot = (">>", slot[1], slot[2], const(c.bit_length() - 1))
+                    consts = self.const_values()
+            elif op in ("select", "vselect") and (slot[2], n) in negations:
+                slot = (op, slot[1], negations[(slot[2], n)], slot[4], slot[3])
+
+            written = set(slot_reads_writes(engine, slot)[1])
+            negations = {
+                (a, k): b
+                for (a, k), b in negations.items()
+                if written.isdisjoint(range(a, a + k))
+                and written.isdisjoint(range(b, b + k))
+            }
+            if engine in ("alu", "valu") and op == "==":
+                _, dest, a1, a2 = slot
+                for x, y in [(a1, a2), (a2, a1)]:
+                    if consts.get((y, n)) == 0 and written.isdisjoint(range(x, x + n)):
+                        negations[(dest, n)] = x
+            reduced.append((engine, slot))
+        return reduced
+
+    def eliminate_common(
+        self, slots: list[tuple[Engine, tuple]]
+    ) -> list[tuple[Engine, tuple]]:
+        """
+        Common subexpressions: a slot computing a value some register still
+        holds from an earlier slot copies it from there instead, or is
+        dropped if that's where it writes, as with a repeated const load
+        """
+        # Each address's version goes up with every write to it, so the same
+        # operation on the same versions gives the same value
+        versions = defaultdict(int)
+        tick = 0
+        held = {}
+        common = []
+        for engine, slot in slots:
+            key = expression(engine, slot, versions)
+            dest = slot_dest(engine, slot)
+            if key in held:
+                addr, length, when = held[key]
+                if when == tuple(versions[a] for a in range(addr, addr + length)):
+                    if addr == dest[0]:
+                        continue
+                    if length == 1:
+                        engine, zero = "alu", self.scratch_const(0)
+                    else:
+                        engine, zero = "valu", self.scratch_vconst(0)
+                    common.append((engine, ("+", dest[0], addr, zero)))
+                    for a in range(dest[0], dest[0] + length):
+                        tick += 1
+                        versions[a] = tick
+                    continue
+            for a in slot_reads_writes(engine, slot)[1]:
+                tick += 1
+                versions[a] = tick
+            if key is not None:
+                addr, length = dest
+                when = tuple(versions[a] for a in range(addr, addr + length))
+                held[key] = (addr, length, when)
+            common.append((engine, slot))
+        return common
+
+    def propagate_copies(
+        self, slots: list[tuple[Engine, tuple]], live_out: set[int]
+    ) -> list[tuple[Engine, tuple]]:
+        """
+        Copies (identity ops, see copy_source) made unneeded. Reads of a
+        copy read the original instead while neither has been overwritten.
+        A copy of a value that's dead afterwards is coalesced into the slot
+        computing the value, which writes it to the copy's destination
+        directly, as long as nothing touches that in between. The copies
+        left unread go in dead-store removal.
+        """
+        consts = self.const_values()
+        copies = {}
+        forwarded = []
+        for engine, slot in slots:
+
+            def follow(addr, length):
+                for (dest, n), src in copies.items():
+                    if dest <= addr and addr + length <= dest + n:
+                        return src + addr - dest
+                return addr
+
+            slot = map_slot_reads(engine, slot, follow)
+            written = set(slot_reads_writes(engine, slot)[1])
+            copies = {
+                (dest, n): src
+                for (dest, n), src in copies.items()
+                if written.isdisjoint(range(dest, dest + n))
+                and written.isdisjoint(range(src, src + n))
+            }
+            src = self.copy_source(engine, slot, consts)
+            if src is not None:
+                dest, n = slot_dest(engine, slot)
+                if abs(src - dest) >= n:
+                    copies[(dest, n)] = src
+            forwarded.append((engine, slot))
+
+        slots = forwarded
+        while True:
+            live = live_after(slots, live_out)
+            for j in reversed(range(len(slots))):
+                coalesced = self.coalesce(slots, j, live[j], consts)
+                if coalesced is not None:
+                    slots = coalesced
+                    break
+            else:
+                return slots
+
+    def coalesce(
+        self,
+        slots: list[tuple[Engine, tuple]],
+        j: int,
+        live: set[int],
+        consts: dict,
+    ) -> list[tuple[Engine, tuple]] | None:
+        """
+        slots with the copy at j folded into the slot computing what it
+        copies, given the scratch live after it, or None if it can't be
+        """
+        engine, slot = slots[j]
+        src = self.copy_source(engine, slot, consts)
+        if src is None:
+            return None
+        dest, n = slot_dest(engine, slot)
+        from_src, to_dest = set(range(src, src + n)), set(range(dest, dest + n))
+        if not from_src.isdisjoint(live) or not from_src.isdisjoint(to_dest):
+            return None
+
+        def to_copy(addr, length):
+            if src <= addr and addr + length <= src + n:
+                return dest + addr - src
+            return addr
+
+        between = []
+        for i in reversed(range(j)):
+            e, s = slots[i]
+            reads, writes = slot_reads_writes(e, s)
+            if not to_dest.isdisjoint(reads) or not to_dest.isdisjoint(writes):
+                return None
+            if not from_src.isdisjoint(writes):
+                break
+            s = map_slot_reads(e, s, to_copy)
+            if not from_src.isdisjoint(slot_reads_writes(e, s)[0]):
+                return None
+            between.append((e, s))
+        else:
+            return None
+        if slot_dest(e, s) != (src, n):
+            return None
+        return slots[:i] + [(e, with_dest(e, s, dest))] + between[::-1] + slots[j + 1 :]
+
+    def for_loop(
+        self,
+        iter_addr,
+        limit_addr,
+        body: list[Instruction],
+        trip_count: int | None = None,
+        mem_disjoint: bool = False,
+        expected_trips: int | None = None,
+    ):
+        """
+        A for loop that runs len times. iter_addr counts from 1 to limit inside
+        the body. Its jumps go to labels, so the code can be placed anywhere
+        and needs resolve_labels before it runs.
+
+        If the trip count (the value at limit_addr) is known at build time,
+        pass it as trip_count and body as a list of slots instead of bundles
+        to get a software-pipelined loop, see modulo_loop. Otherwise a count
+        known at build time can be given as expected_trips, which is only
+        recorded for analyze.py.
+        """
+        if trip_count is not None:
+            return self.modulo_loop(iter_addr, trip_count, body, mem_disjoint)
         loop_cond = self.alloc_scratch()
         one_constant = self.scratch_const(1)
-        start_addr = len(self.instrs)
-        prologue_len, epilogue_len = 3, 1
-        end_addr = start_addr + prologue_len + len(body) + epilogue_len
+        top, end = Label("loop"), Label("loop end")
         instrs = [
+            place(top),
             {"alu": [("+", iter_addr, one_constant, iter_addr)]},
             {"alu": [("<", loop_cond, limit_addr, iter_addr)]},
-            {"flow": [("cond_jump", loop_cond, end_addr)]},
+            {"flow": [("cond_jump", loop_cond, end)]},
         ]
         instrs.extend(body)
-        instrs.append({"flow": [("jump", start_addr)]})
+        instrs.append({"flow": [("jump", top)]})
+        if expected_trips is not None:
+            annotate(instrs[-1], "trip_count", expected_trips)
+        instrs.append(place(end))
         return instrs
 
+    def iteration_body(
+        self, iter_addr, body: list[tuple[Engine, tuple]]
+    ) -> list[tuple[Engine, tuple]]:
+        """
+        A loop body of slots that bumps iter_addr itself and reads its own copy
+        of it, so that iterations can overlap. Debug slots are dropped.
+        """
+        one = self.scratch_const(1)
+        iter_local = self.alloc_scratch()
+
+        def local_iter(addr, length):
+            return iter_local if addr == iter_addr else addr
+
+        body = [
+            ("alu", ("+", iter_local, iter_addr, one)),
+            ("alu", ("+", iter_addr, iter_addr, one)),
+        ] + [
+            (e, map_slot_addrs(e, slot, local_iter)) for e, slot in body if e != "debug"
+        ]
+        assert not any(
+            e == "flow" and slot[0] in BARRIER_OPS for e, slot in body
+        ), "Can't overlap iterations of a loop body with control flow"
+        return body
+
+    def rename_copies(
+        self, body: list[tuple[Engine, tuple]], local: set[int], copies: int
+    ) -> list[list[tuple[Engine, tuple]]]:
+        """
+        copies versions of body, the first as is and the others with the
+        private scratch in local moved to freshly allocated scratch. Private
+        virtual registers get virtual copies.
+        """
+        runs = []
+        for a in sorted(local):
+            if runs and runs[-1][1] == a and a not in self.vregs:
+                runs[-1][1] = a + 1
+            else:
+                runs.append([a, a + 1])
+        run_of = {a: run for run in map(tuple, runs) for a in range(*run)}
+
+        def fresh(run, k):
+            length = run[1] - run[0]
+            if run[0] not in self.vregs:
+                return self.alloc_scratch(length=length)
+            name = self.vregs[run[0]][0]
+            return self.alloc_vreg(name and f"{name}.{k}", length)
+
+        bases = [{run: run[0] for run in run_of.values()}]
+        for k in range(1, copies):
+            bases.append({run: fresh(run, k) for run in bases[0]})
+
+        def renamer(k):
+            def rename(addr, length):
+                run = run_of.get(addr)
+                if run is None:
+                    assert not local.intersection(range(addr, addr + length))
+                    return addr
+                assert addr + length <= run[1], "Vector straddles private scratch"
+                return bases[k][run] + addr - run[0]
+
+            return rename
+
+        return [
+            [(e, map_slot_addrs(e, slot, renamer(k))) for e, slot in body]
+            for k in range(copies)
+        ]
+
+    def unrolled_loop(
+        self,
+        iter_addr,
+        trip_count: int,
+        body: list[tuple[Engine, tuple]],
+        factor: int | None = None,
+        mem_disjoint: bool = False,
+    ) -> list[Instruction]:
+        """
+        Runs a body of slots trip_count times as straight-line code, factor
+        iterations at a time: a for_loop over trip_count // factor blocks of
+        factor iterations, then the remaining iterations. With factor None
+        (or at least trip_count) there's no loop left at all.
+
+        Each block is list scheduled as a whole. As in modulo_loop, scratch an
+        iteration writes before reading it is private, and consecutive
+        iterations get their own copies of it for as many as fit in scratch so
+        their dependency chains can overlap. Reads of iter_addr see 1 to
+        trip_count, counting on iter_addr starting at 0. Pass mem_disjoint if
+        iterations touch disjoint memory, otherwise every store orders
+        against the next iteration's loads.
+        """
+        if trip_count == 0:
+            return []
+        factor = min(factor or trip_count, trip_count)
+        body = self.iteration_body(iter_addr, body)
+        local = private_scratch(body)
+        free = SCRATCH_SIZE - self.scratch_ptr - UNROLL_SCRATCH_RESERVE
+        copies = max(1, min(factor, 1 + free // max(1, len(local))))
+        renamed = self.rename_copies(body, local, copies)
+
+        def block(n):
+            slots, rw = [], []
+            for k in range(n):
+                for engine, slot in renamed[k % copies]:
+                    reads, writes = slot_reads_writes(engine, slot)
+                    if mem_disjoint:
+                        # Each iteration's memory is a location of its own
+                        mem = MEM - (k << 30)
+                        reads = [mem if a == MEM else a for a in reads]
+                        writes = [mem if a == MEM else a for a in writes]
+                    slots.append((engine, slot))
+                    rw.append((reads, writes))
+            return list_schedule(slots, rw)
+
+        n_blocks, rest = divmod(trip_count, factor)
+        if n_blocks == 1:
+            return block(factor) + block(rest)
+        block_i, n_blocks_addr = self.alloc_scratch(), self.alloc_scratch()
+        instrs = [{"load": [("const", block_i, 0), ("const", n_blocks_addr, n_blocks)]}]
+        instrs += self.for_loop(
+            block_i, n_blocks_addr, block(factor), expected_trips=n_blocks
+        )
+        return instrs + block(rest)
+
+    def modulo_loop(
+        self,
+        iter_addr,
+        trip_count: int,
+        body: list[tuple[Engine, tuple]],
+        mem_disjoint: bool = False,
+    ) -> list[Instruction]:
+        """
+        Software-pipelined loop running a body of slots trip_count times, with
+        a new iteration starting every II cycles (see modulo_schedule) so
+        iteration i+1's loads overlap iteration i's compute.
+
+        Scratch that an iteration writes before reading it is private to the
+        iteration and rotated between K copies, where K is the most iterations
+        one value is live across. Scratch read before it's written carries
+        over between iterations and isn't renamed, so private values are
+        dead after the loop. Reads of iter_addr see 1 to trip_count as with
+        for_loop. Pass mem_disjoint if iterations touch disjoint memory,
+        otherwise every store orders against the next iteration's loads.
+
+        The code is a prologue filling the pipeline, a steady-state block of
+        K*II cycles looped over with a counter, and the drain, with bundles
+        that would be empty dropped.
+        """
+        one = self.scratch_const(1)
+        if trip_count == 0:
+            return []
+        body = self.iteration_body(iter_addr, body)
+        local = private_scratch(body)
+        ii, times = modulo_schedule(body, local, mem_disjoint)
+        stages = max(times) // ii + 1
+
+        # Rotate private scratch between enough copies that iteration i+K only
+        # overwrites a value once iteration i is done with it
+        first_write, last_read, last_write = {}, defaultdict(int), defaultdict(int)
+        for (engine, slot), t in zip(body, times):
+            reads, writes = slot_reads_writes(engine, slot)
+            for a in writes:
+                first_write.setdefault(a, t)
+                last_write[a] = max(last_write[a], t)
+            for a in reads:
+                last_read[a] = max(last_read[a], t)
+        copies = max(
+            [1]
+            + [cdiv(last_read[a] - first_write[a], ii) for a in local]
+            + [(last_write[a] - first_write[a]) // ii + 1 for a in local]
+        )
+        renamed = self.rename_copies(body, local, copies)
+
+        by_residue = defaultdict(list)
+        for op, t in enumerate(times):
+            by_residue[t % ii].append(op)
+
+        def bundle_at(cycle):
+            bundle = {}
+            ops = [((cycle - times[op]) // ii, op) for op in by_residue[cycle % ii]]
+            for i, op in sorted(ops):
+                if 0 <= i < trip_count:
+                    engine, slot = renamed[i % copies][op]
+                    bundle.setdefault(engine, []).append(slot)
+            return bundle
+
+        def bundles(start, end):
+            return [b for b in map(bundle_at, range(start, end)) if b]
+
+        total = (trip_count - 1) * ii + max(times) + 1
+        fill = (stages - 1) * ii
+        reps = (trip_count - stages + 1) // copies if trip_count >= stages else 0
+        if reps < 2:
+            return bundles(0, total)
+
+        # Loop over the steady-state block reps times
+        prologue = bundles(0, fill)
+        block = bundles(fill, fill + copies * ii)
+        tail = bundles(fill + reps * copies * ii, total)
+        rep, rep_limit, cond = (self.alloc_scratch() for _ in range(3))
+        place_slot(prologue, "load", ("const", rep, 0))
+        place_slot(prologue, "load", ("const", rep_limit, reps))
+        top = Label("pipelined loop")
+        i = place_slot(block, "alu", ("+", rep, rep, one))
+        i = place_slot(block, "alu", ("<", cond, rep, rep_limit), i + 1)
+        i = place_slot(
+            block, "flow", ("cond_jump", cond, top), max(i + 1, len(block) - 1)
+        )
+        annotate(block[i], "trip_count", reps)
+        return prologue + [place(top)] + block + tail
+
     def build_simple_test(self):
         """
         A simple test program that just counts to 10
@@ -141,21 +1577,60 @@ class KernelBuilder:
         limit_addr = self.alloc_scratch("limit")
         self.add("load", ("const", limit_addr, 10))
         body = [("alu", ("+", accum, accum, one_constant))]
-        self.instrs.extend(self.for_loop(iter_addr, limit_addr, self.build(body)))
+        self.instrs.extend(
+            self.for_loop(iter_addr, limit_addr, self.build(body), expected_trips=10)
+        )
+        self.instrs = resolve_labels(self.instrs)
+
+    def gather(self, dest, base, indices, vbase=None) -> list[tuple[Engine, tuple]]:
+        """
+        Slots loading mem[base + indices[i]] into lane i of the vector at
+        dest, for every lane. The addresses go in a vector register, from
+        one valu op if base is also given broadcast as vbase or else an alu
+        op per lane, and each load_offset writes its lane of dest directly.
+        The loads don't depend on each other, so they issue as many per
+        cycle as there are load slots.
+        """
+        addrs = self.alloc_vreg("gather_addrs", VLEN)
+        if vbase is not None:
+            slots = [("valu", ("+", addrs, vbase, indices))]
+        else:
+            slots = [("alu", ("+", addrs + i, base, indices + i)) for i in range(VLEN)]
+        slots += [("load", ("load_offset", dest, addrs, i)) for i in range(VLEN)]
+        return slots
 
     def build_hash(self, val_hash_addr, tmp1, tmp2):
         slots = []
 
-        for op1, val1, op2, op3, val3 in HASH_STAGES:
+        for stage in map(fuse_hash_stage, HASH_STAGES):
+            if stage[0] == "madd":
+                _, mul, add = stage
+                slots.append(("alu", ("*", tmp1, val_hash_addr, self.scratch_const(mul))))
+                slots.append(("alu", ("+", val_hash_addr, tmp1, self.scratch_const(add))))
+                continue
+            op1, val1, op2, op3, val3 = stage
             slots.append(("alu", (op1, tmp1, val_hash_addr, self.scratch_const(val1))))
             slots.append(("alu", (op3, tmp2, val_hash_addr, self.scratch_const(val3))))
             slots.append(("alu", (op2, val_hash_addr, tmp1, tmp2)))
 
         return slots
     
-    def build_kernel(self, forest_height: int, n_nodes: int, batch_size: int):
-        """Optimized kernel implementation using VLIW, SIMD, and advanced scheduling"""
+    def build_kernel(
+        self,
+        forest_height: int,
+        n_nodes: int,
+        batch_size: int,
+        rounds: int | None = None,
+    ):
+        """
+        Optimized kernel implementation using VLIW, SIMD, and advanced scheduling
+
+        rounds is only needed (and then must match mem) to fully unroll the
+        round loop, otherwise the kernel reads it from memory.
+        """
         
+        self.label("setup")
+
         # Constants we'll need frequently
         zero_const = self.scratch_const(0)
         one_const = self.scratch_const(1) 
@@ -164,16 +1639,10 @@ class KernelBuilder:
         mask_const = self.scratch_const(0xFFFFFFFF)
         
         # Vector constants - allocate space and broadcast scalar to vector
-        v_zero = self.alloc_scratch("v_zero", VLEN)
-        v_one = self.alloc_scratch("v_one", VLEN)
-        v_two = self.alloc_scratch("v_two", VLEN)
-        v_mask = self.alloc_scratch("v_mask", VLEN)
-        
-        # Broadcast constants to vectors
-        self.add("valu", ("vbroadcast", v_zero, zero_const))
-        self.add("valu", ("vbroadcast", v_one, one_const))
-        self.add("valu", ("vbroadcast", v_two, two_const))
-        self.add("valu", ("vbroadcast", v_mask, mask_const))
+        v_zero = self.scratch_vconst(0, "v_zero")
+        v_one = self.scratch_vconst(1, "v_one")
+        v_two = self.scratch_vconst(2, "v_two")
+        v_mask = self.scratch_vconst(0xFFFFFFFF, "v_mask")
         
         # Memory pointers and indices
         mem_tmp = self.alloc_scratch("mem_tmp")
@@ -195,12 +1664,12 @@ class KernelBuilder:
         self.add("alu", ("*", core_offset, core_id, batch_per_core_addr))
         
         # Vector registers for processing VLEN items at once
-        v_indices = self.alloc_scratch("v_indices", VLEN)
-        v_values = self.alloc_scratch("v_values", VLEN)
-        v_node_vals = self.alloc_scratch("v_node_vals", VLEN)
-        v_tmp1 = self.alloc_scratch("v_tmp1", VLEN)
-        v_tmp2 = self.alloc_scratch("v_tmp2", VLEN)
-        v_tmp3 = self.alloc_scratch("v_tmp3", VLEN)
+        v_indices = self.alloc_vreg("v_indices", VLEN)
+        v_values = self.alloc_vreg("v_values", VLEN)
+        v_node_vals = self.alloc_vreg("v_node_vals", VLEN)
+        v_tmp1 = self.alloc_vreg("v_tmp1", VLEN)
+        v_tmp2 = self.alloc_vreg("v_tmp2", VLEN)
+        v_tmp3 = self.alloc_vreg("v_tmp3", VLEN)
         
         # Broadcast n_nodes to vector for range comparison
         v_n_nodes = self.alloc_scratch("v_n_nodes", VLEN)
@@ -212,99 +1681,309 @@ class KernelBuilder:
         self.add("alu", ("+", round_i, zero_const, zero_const))
         self.add("alu", ("+", batch_i, zero_const, zero_const))
         
-        # Scratch for index calculations
-        batch_abs_idx = self.alloc_scratch("batch_abs_idx")
-        node_addr = self.alloc_scratch("node_addr")
-        load_tmp = self.alloc_scratch("load_tmp")
-        idx_tmp = self.alloc_scratch("idx_tmp")
+        # Registers for index calculations
+        batch_abs_idx = self.alloc_vreg("batch_abs_idx")
+        mem_addr = self.alloc_vreg("mem_addr")
         
-        # Vector registers for hash constants
+        # Vector registers for hash constants, with the stages that allow it
+        # fused into a multiply and an add
+        hash_stages = [fuse_hash_stage(stage) for stage in HASH_STAGES]
         hash_constants = {}
-        for op1, val1, op2, op3, val3 in HASH_STAGES:
-            if val1 not in hash_constants:
-                v_addr = self.alloc_scratch(f"v_hash_{val1}", VLEN)
-                val1_const = self.scratch_const(val1)
-                self.add("valu", ("vbroadcast", v_addr, val1_const))
-                hash_constants[val1] = v_addr
-            if val3 not in hash_constants:
-                v_addr = self.alloc_scratch(f"v_hash_{val3}", VLEN)
-                val3_const = self.scratch_const(val3)
-                self.add("valu", ("vbroadcast", v_addr, val3_const))
-                hash_constants[val3] = v_addr
+        for stage in hash_stages:
+            if stage[0] == "madd":
+                vals = stage[1:]
+            else:
+                vals = (stage[1], stage[4])
+            for val in vals:
+                if val not in hash_constants:
+                    v_addr = self.alloc_scratch(f"v_hash_{val}", VLEN)
+                    self.add("valu", ("vbroadcast", v_addr, self.scratch_const(val)))
+                    hash_constants[val] = v_addr
         
         # Build the body of the batch processing loop
-        batch_body = []
+        batch_head = []
         
-        # Calculate absolute index for this SIMD batch
-        batch_body.append(("alu", ("*", batch_abs_idx, batch_i, vlen_const)))
-        batch_body.append(("alu", ("+", batch_abs_idx, batch_abs_idx, core_offset)))
+        # Calculate absolute index for this SIMD batch (batch_i counts from 1)
+        batch_head.append(("alu", ("-", batch_abs_idx, batch_i, one_const)))
+        batch_head.append(("alu", ("*", batch_abs_idx, batch_abs_idx, vlen_const)))
+        batch_head.append(("alu", ("+", batch_abs_idx, batch_abs_idx, core_offset)))
         
         # Load VLEN indices and values
-        batch_body.append(("alu", ("+", mem_tmp, self.scratch["inp_indices_p"], batch_abs_idx)))
-        batch_body.append(("load", ("vload", v_indices, mem_tmp)))
-        batch_body.append(("alu", ("+", mem_tmp, self.scratch["inp_values_p"], batch_abs_idx)))
-        batch_body.append(("load", ("vload", v_values, mem_tmp)))
+        batch_head.append(("alu", ("+", mem_addr, self.scratch["inp_indices_p"], batch_abs_idx)))
+        batch_head.append(("load", ("vload", v_indices, mem_addr)))
+        batch_head.append(("alu", ("+", mem_addr, self.scratch["inp_values_p"], batch_abs_idx)))
+        batch_head.append(("load", ("vload", v_values, mem_addr)))
         
         # Load node values individually using indirect access
-        for i in range(VLEN):
-            # Get index value from v_indices[i]
-            batch_body.append(("load", ("load_offset", load_tmp, v_indices, i)))  # Load the actual index value
-            
-            # Calculate forest address and load value
-            batch_body.append(("alu", ("+", node_addr, self.scratch["forest_values_p"], load_tmp)))
-            batch_body.append(("load", ("load", load_tmp, node_addr)))
-            
-            # Store to v_node_vals[i]
-            batch_body.append(("alu", ("+", v_node_vals + i, load_tmp, zero_const)))
-        
-        # Initial XOR into temporary
-        batch_body.append(("valu", ("^", v_tmp1, v_values, v_node_vals)))
-        batch_body.append(("valu", ("&", v_tmp1, v_tmp1, v_mask)))
+        gather = self.gather(v_node_vals, self.scratch["forest_values_p"], v_indices)
         
-        # Hash computation
-        for op1, val1, op2, op3, val3 in HASH_STAGES:
-            batch_body.append(("valu", (op1, v_tmp2, v_tmp1, hash_constants[val1])))
-            batch_body.append(("valu", ("&", v_tmp2, v_tmp2, v_mask)))
+        # Hash computation, starting from the node values XORed in
+        batch_tail = []
+        batch_tail.append(("valu", ("&", v_tmp1, v_tmp1, v_mask)))
+        for stage in hash_stages:
+            if stage[0] == "madd":
+                _, mul, add = stage
+                batch_tail.append(("valu", ("*", v_tmp2, v_tmp1, hash_constants[mul])))
+                batch_tail.append(("valu", ("&", v_tmp2, v_tmp2, v_mask)))
+                batch_tail.append(("valu", ("+", v_tmp1, v_tmp2, hash_constants[add])))
+                batch_tail.append(("valu", ("&", v_tmp1, v_tmp1, v_mask)))
+                continue
+            op1, val1, op2, op3, val3 = stage
+            batch_tail.append(("valu", (op1, v_tmp2, v_tmp1, hash_constants[val1])))
+            batch_tail.append(("valu", ("&", v_tmp2, v_tmp2, v_mask)))
             
-            batch_body.append(("valu", (op3, v_tmp3, v_tmp1, hash_constants[val3])))
-            batch_body.append(("valu", ("&", v_tmp3, v_tmp3, v_mask)))
+            batch_tail.append(("valu", (op3, v_tmp3, v_tmp1, hash_constants[val3])))
+            batch_tail.append(("valu", ("&", v_tmp3, v_tmp3, v_mask)))
             
-            batch_body.append(("valu", (op2, v_tmp1, v_tmp2, v_tmp3)))
-            batch_body.append(("valu", ("&", v_tmp1, v_tmp1, v_mask)))
+            batch_tail.append(("valu", (op2, v_tmp1, v_tmp2, v_tmp3)))
+            batch_tail.append(("valu", ("&", v_tmp1, v_tmp1, v_mask)))
         
         # Copy final hash result to v_values
-        batch_body.append(("valu", ("+", v_values, v_tmp1, v_zero)))
+        batch_tail.append(("valu", ("+", v_values, v_tmp1, v_zero)))
         
         # Check if values are even/odd using the hashed value
-        batch_body.append(("valu", ("%", v_tmp1, v_values, v_two)))
-        batch_body.append(("valu", ("==", v_tmp1, v_tmp1, v_zero)))
+        batch_tail.append(("valu", ("%", v_tmp1, v_values, v_two)))
+        batch_tail.append(("valu", ("==", v_tmp1, v_tmp1, v_zero)))
         
         # Compute 2*indices + (1 or 2)
-        batch_body.append(("valu", ("*", v_indices, v_indices, v_two)))
-        batch_body.append(("flow", ("vselect", v_tmp2, v_tmp1, v_two, v_one)))
-        batch_body.append(("valu", ("+", v_indices, v_indices, v_tmp2)))
+        batch_tail.append(("valu", ("*", v_indices, v_indices, v_two)))
+        batch_tail.append(("flow", ("vselect", v_tmp2, v_tmp1, v_one, v_two)))
+        batch_tail.append(("valu", ("+", v_indices, v_indices, v_tmp2)))
         
         # Check range and wrap to root if needed
-        batch_body.append(("valu", ("<", v_tmp1, v_indices, v_n_nodes)))
-        batch_body.append(("flow", ("vselect", v_indices, v_tmp1, v_indices, v_zero)))
+        batch_tail.append(("valu", ("<", v_tmp1, v_indices, v_n_nodes)))
+        batch_tail.append(("flow", ("vselect", v_indices, v_tmp1, v_indices, v_zero)))
         
         # Store results back to memory
-        batch_body.append(("alu", ("+", mem_tmp, self.scratch["inp_values_p"], batch_abs_idx)))
-        batch_body.append(("store", ("vstore", mem_tmp, v_values)))
-        batch_body.append(("alu", ("+", mem_tmp, self.scratch["inp_indices_p"], batch_abs_idx)))
-        batch_body.append(("store", ("vstore", mem_tmp, v_indices)))
+        batch_tail.append(("alu", ("+", mem_addr, self.scratch["inp_values_p"], batch_abs_idx)))
+        batch_tail.append(("store", ("vstore", mem_addr, v_values)))
+        batch_tail.append(("alu", ("+", mem_addr, self.scratch["inp_indices_p"], batch_abs_idx)))
+        batch_tail.append(("store", ("vstore", mem_addr, v_indices)))
+
+        def batch_body(node_slots, node_vals):
+            xor = ("valu", ("^", v_tmp1, v_values, node_vals))
+            return batch_head + node_slots + [xor] + batch_tail
+
+        # Every index starts at the root and moves down a level a round until
+        # it wraps from the leaves back to the root, so round r is at depth
+        # r % (forest_height + 1). The top of the tree has few enough nodes to
+        # keep them in scratch, and pick each lane's node value from them with
+        # arithmetic instead of VLEN loads.
+        def cached_node_slots(depth, cache, diffs, vconst):
+            """
+            Slots resolving the node values at depth from cache, a vector per
+            node index, and the vector they end up in. diffs has cache[i + 1]
+            - cache[i] for every left child i.
+            """
+            first = 2**depth - 1
+            if depth == 0:
+                return [], cache[0]
+            offset = self.alloc_vreg("offset", VLEN)
+            slots = [("valu", ("-", offset, v_indices, vconst(first)))]
+            # A node's offset in its level has a bit per branch taken on the
+            # way down, the last in bit 0, so the node values come from
+            # interpolating between neighbours one bit at a time
+            level = [cache[i] for i in range(first, 2 * first + 1)]
+            for bit_i in range(depth):
+                if depth == 1:
+                    bit = offset
+                elif bit_i == depth - 1:
+                    # The top bit needs no masking
+                    bit = self.alloc_vreg("bit", VLEN)
+                    slots.append(("valu", (">>", bit, offset, vconst(bit_i))))
+                else:
+                    bit, shifted = self.alloc_vreg("bit", VLEN), offset
+                    if bit_i > 0:
+                        shifted = self.alloc_vreg("shifted", VLEN)
+                        slots.append(("valu", (">>", shifted, offset, vconst(bit_i))))
+                    slots.append(("valu", ("&", bit, shifted, v_one)))
+                next_level = []
+                for k in range(0, len(level), 2):
+                    lo, hi = level[k], level[k + 1]
+                    if bit_i == 0:
+                        diff = diffs[first + k]
+                    else:
+                        diff = self.alloc_vreg("diff", VLEN)
+                        slots.append(("valu", ("-", diff, hi, lo)))
+                    step = self.alloc_vreg("step", VLEN)
+                    out = self.alloc_vreg("node", VLEN)
+                    slots.append(("valu", ("*", step, bit, diff)))
+                    slots.append(("valu", ("+", out, lo, step)))
+                    next_level.append(out)
+                level = next_level
+            return slots, level[0]
+
+        # Cache as many levels as fit in a quarter of the free scratch and
+        # make a batch's slots quicker to issue than gathering does
+        gather_body = self.optimize(batch_body(gather, v_node_vals))
+        levels = self.tree_cache_levels
+        if levels is None:
+            budget = (SCRATCH_SIZE - self.scratch_ptr) // 4
+            levels = 0
+            while levels <= forest_height:
+                # Node vectors plus differences for all but the root's level
+                words = VLEN * (2 ** (levels + 1) - 1 + 2**levels - 1)
+                if words > budget:
+                    break
+                dummy = defaultdict(lambda: self.alloc_vreg(length=VLEN))
+                slots, vals = cached_node_slots(levels, dummy, dummy, lambda v: 0)
+                savings = dict(self.pass_savings)
+                body = self.optimize(batch_body(slots, vals))
+                self.pass_savings = savings
+                if resource_bound(body) >= resource_bound(gather_body):
+                    break
+                levels += 1
+        levels = min(levels, forest_height + 1)
+
+        cache, diffs = {}, {}
+        setup = []
+        for i in range(2**levels - 1):
+            cache[i] = self.alloc_scratch(f"v_node_{i}", VLEN)
+            addr, val = self.alloc_vreg(), self.alloc_vreg()
+            forest_values_p = self.scratch["forest_values_p"]
+            setup.append(("alu", ("+", addr, forest_values_p, self.scratch_const(i))))
+            setup.append(("load", ("load", val, addr)))
+            setup.append(("valu", ("vbroadcast", cache[i], val)))
+        for i in range(1, 2**levels - 1, 2):
+            diffs[i] = self.alloc_scratch(f"v_node_diff_{i}", VLEN)
+            setup.append(("valu", ("-", diffs[i], cache[i + 1], cache[i])))
+        bodies = {
+            depth: self.optimize(
+                batch_body(*cached_node_slots(depth, cache, diffs, self.scratch_vconst))
+            )
+            for depth in range(levels)
+        }
+        self.instrs.extend(self.build(setup, vliw=True))
         
         # Create nested loops
         batches_per_core = batch_per_core // VLEN
         batches_addr = self.scratch_const(batches_per_core)
-        batch_body_instrs = self.build(batch_body)
-        batch_loop = self.for_loop(batch_i, batches_addr, batch_body_instrs)
-        round_loop = self.for_loop(round_i, self.scratch["rounds"], batch_loop)
-        
-        # Add to program
-        self.instrs.extend(round_loop)
-    
-        
+
+        def batch_loop(body):
+            if self.unroll_batches == 1:
+                # Batches touch disjoint slices of memory, so they can be pipelined
+                return self.for_loop(
+                    batch_i,
+                    batches_addr,
+                    body,
+                    trip_count=batches_per_core,
+                    mem_disjoint=True,
+                )
+            return self.unrolled_loop(
+                batch_i,
+                batches_per_core,
+                body,
+                self.unroll_batches,
+                mem_disjoint=True,
+            )
+
+        # Rounds at a known depth run that depth's batch loop. Otherwise the
+        # round picks one with the depth register, which counts rounds modulo
+        # forest_height + 1.
+        depth_reg = self.alloc_scratch("depth")
+        height_const = self.scratch_const(forest_height + 1)
+        is_depth = [self.alloc_scratch(f"is_depth_{d}") for d in range(levels)]
+        variants = {
+            depth: batch_loop(body)
+            for depth, body in [(None, gather_body), *bodies.items()]
+        }
+        for depth, variant in variants.items():
+            if variant:
+                name = "gather batches" if depth is None else f"depth {depth} batches"
+                annotate(variant[0], "label", name)
+
+        def round_body(depth):
+            reset = {"alu": [("+", batch_i, zero_const, zero_const)]}
+            annotate(reset, "label", "round")
+            if depth is not None or levels == 0:
+                variant = variants[depth if depth in bodies else None]
+                return [reset] + relocate(variant) + [{"flow": [("pause",)]}]
+            reset["alu"] += [
+                ("==", is_depth[d], depth_reg, self.scratch_const(d))
+                for d in range(levels)
+            ]
+            code = [reset]
+            entries = {d: Label(f"depth {d}") for d in range(levels)}
+            done = Label("round end")
+            # How often each depth's jump is taken when reached, going by the
+            # depths of all the rounds, for analyze.py
+            depths = [r % (forest_height + 1) for r in range(rounds or 0)]
+            for d in range(levels):
+                code.append({"flow": [("cond_jump", is_depth[d], entries[d])]})
+                if depths:
+                    taken = depths.count(d) / len(depths)
+                    annotate(code[-1], "taken", taken)
+                    depths = [depth for depth in depths if depth != d]
+            for d in [None, *range(levels)]:
+                if d is not None:
+                    code.append(place(entries[d]))
+                code += relocate(variants[d])
+                # The last variant falls through to the end
+                if d != levels - 1:
+                    code.append({"flow": [("jump", done)]})
+            code.append(place(done))
+            code.append({"alu": [("+", depth_reg, depth_reg, one_const)]})
+            code.append(
+                {
+                    "alu": [("%", depth_reg, depth_reg, height_const)],
+                    "flow": [("pause",)],
+                }
+            )
+            return code
+
+        # Pause before the first round and after every round so the rounds
+        # can be checked against reference_kernel2
+        self.add("alu", ("+", depth_reg, zero_const, zero_const))
+        self.add("flow", ("pause",))
+
+        def repeat(n, first_round=None):
+            code = []
+            for r in range(n):
+                depth = None
+                if first_round is not None:
+                    depth = (first_round + r) % (forest_height + 1)
+                code += round_body(depth)
+            return code
+
+        factor = self.unroll_rounds or rounds
+        assert factor is not None, "Unrolling all rounds needs rounds at build time"
+        if factor == 1:
+            code = self.for_loop(
+                round_i, self.scratch["rounds"], round_body(None), expected_trips=rounds
+            )
+        elif rounds is not None and factor >= rounds:
+            code = repeat(rounds, first_round=0)
+        else:
+            # factor rounds per iteration of a loop, then a loop over the rest
+            n_blocks, rest = self.alloc_scratch("n_blocks"), self.alloc_scratch("rest")
+            block_i = self.alloc_scratch("block_i")
+            factor_const = self.scratch_const(factor)
+            code = [
+                {
+                    "alu": [
+                        ("//", n_blocks, self.scratch["rounds"], factor_const),
+                        ("%", rest, self.scratch["rounds"], factor_const),
+                        ("+", block_i, zero_const, zero_const),
+                    ]
+                }
+            ]
+            blocks = rest_rounds = None
+            if rounds is not None:
+                blocks, rest_rounds = divmod(rounds, factor)
+            code += self.for_loop(
+                block_i, n_blocks, repeat(factor), expected_trips=blocks
+            )
+            code += self.for_loop(
+                round_i, rest, round_body(None), expected_trips=rest_rounds
+            )
+
+        self.instrs.extend(code)
+        self.instrs = self.allocate(resolve_labels(self.instrs))
+        self.collect_labels()
+        assert len(self.instrs) <= self.max_instrs, (
+            f"Kernel is {len(self.instrs)} bundles, more than max_instrs="
+            f"{self.max_instrs}; use smaller unroll factors"
+        )
 
     def build_kernel_old(self, forest_height: int, n_nodes: int, batch_size: int):
         """
@@ -392,38 +2071,51 @@ class KernelBuilder:
 
         height_i = self.alloc_scratch("height_i")
         loop = self.for_loop(height_i, self.scratch["rounds"], body_instrs)
-        self.instrs.extend(loop)
+        self.instrs = resolve_labels(self.instrs + loop)
 
 
-def do_kernel_test(
+def run_kernel(
     forest_height: int,
     rounds: int,
     batch_size: int,
     seed: int = 123,
     trace: bool = False,
     prints: bool = False,
+    backend: str = "python",
+    builder_args: dict | None = None,
+    reference: str = "python",
+    parallel: bool | int = False,
 ):
-    print(f"{forest_height=}, {rounds=}, {batch_size=}")
+    """
+    Build the kernel for a random problem of the given shape and run it,
+    checking every round against the reference kernel. Returns the builder,
+    the machine and the seconds spent in the simulator.
+    """
     random.seed(seed)
     forest = Tree.generate(forest_height)
     inp = Input.generate(forest, batch_size, rounds)
     mem = build_mem_image(forest, inp)
 
-    kb = KernelBuilder()
-    kb.build_kernel(forest.height, len(forest.values), len(inp.indices))
+    kb = KernelBuilder(**(builder_args or {}))
+    kb.build_kernel(forest.height, len(forest.values), len(inp.indices), rounds)
     # print(kb.instrs)
 
-    machine = Machine(mem, kb.instrs, kb.debug_info(), n_cores=N_CORES, trace=trace)
+    machine_cls = BACKENDS[backend]
+    machine = machine_cls(mem, kb.instrs, kb.debug_info(), n_cores=N_CORES, trace=trace)
     machine.prints = prints
-    for i, ref_mem in enumerate(reference_kernel2(mem)):
+    machine.parallel = parallel
+    sim_time = 0.0
+    for i, ref_mem in enumerate(REFERENCE_KERNELS[reference](mem)):
+        start = time.perf_counter()
         machine.run()
+        sim_time += time.perf_counter() - start
         inp_values_p = ref_mem[6]
         if prints:
             print(machine.mem[inp_values_p : inp_values_p + len(inp.values)])
             print(ref_mem[inp_values_p : inp_values_p + len(inp.values)])
         assert (
-            machine.mem[inp_values_p : inp_values_p + len(inp.values)]
-            == ref_mem[inp_values_p : inp_values_p + len(inp.values)]
+            list(machine.mem[inp_values_p : inp_values_p + len(inp.values)])
+            == list(ref_mem[inp_values_p : inp_values_p + len(inp.values)])
         ), f"Incorrect result on round {i}"
         inp_indices_p = ref_mem[5]
         if prints:
@@ -431,8 +2123,74 @@ def do_kernel_test(
             print(ref_mem[inp_indices_p : inp_indices_p + len(inp.indices)])
         # Updating these in memory isn't required, but you can enable this check for debugging
         # assert machine.mem[inp_indices_p:inp_indices_p+len(inp.indices)] == ref_mem[inp_indices_p:inp_indices_p+len(inp.indices)]
+    return kb, machine, sim_time
+
+
+def run_kernel_batch(
+    forest_height: int,
+    rounds: int,
+    batch_size: int,
+    seeds: list[int],
+    builder_args: dict | None = None,
+    reference: str = "numpy",
+):
+    """
+    run_kernel for many seeds at once: the kernel is built once and runs on
+    a BatchMachine over every seed's problem together, checking each round
+    against the reference. Returns the builder, the machine, with each
+    seed's cycles in machine.cycles, and the seconds spent in the simulator.
+    """
+    mems = []
+    for seed in seeds:
+        random.seed(seed)
+        forest = Tree.generate(forest_height)
+        inp = Input.generate(forest, batch_size, rounds)
+        mems.append(build_mem_image(forest, inp))
+
+    kb = KernelBuilder(**(builder_args or {}))
+    kb.build_kernel(forest_height, len(forest.values), batch_size, rounds)
+    machine = BatchMachine(mems, kb.instrs, kb.debug_info(), n_cores=N_CORES)
+    sim_time = 0.0
+    refs = [REFERENCE_KERNELS[reference](mem) for mem in mems]
+    for i, ref_mems in enumerate(zip(*refs)):
+        start = time.perf_counter()
+        machine.run()
+        sim_time += time.perf_counter() - start
+        for seed, mem, ref_mem in zip(seeds, machine.mem, ref_mems):
+            values = slice(ref_mem[6], ref_mem[6] + batch_size)
+            assert list(mem[values]) == list(ref_mem[values]), (
+                f"Incorrect result on round {i} for seed {seed}"
+            )
+    return kb, machine, sim_time
+
 
+def do_kernel_test(
+    forest_height: int,
+    rounds: int,
+    batch_size: int,
+    seed: int = 123,
+    trace: bool = False,
+    prints: bool = False,
+    backend: str = "python",
+    builder_args: dict | None = None,
+    reference: str = "python",
+    parallel: bool | int = False,
+):
+    print(f"{forest_height=}, {rounds=}, {batch_size=}")
+    _, machine, _ = run_kernel(
+        forest_height,
+        rounds,
+        batch_size,
+        seed,
+        trace,
+        prints,
+        backend,
+        builder_args,
+        reference,
+        parallel,
+    )
     print("CYCLES: ", machine.cycle)
+    print("UTILIZATION: ", machine.stats().summary())
     return machine.cycle
 
 
@@ -452,6 +2210,20 @@ class Tests(unittest.TestCase):
             assert inp.indices == mem[mem[5] : mem[5] + len(inp.indices)]
             assert inp.values == mem[mem[6] : mem[6] + len(inp.values)]
 
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_numpy_reference(self):
+        random.seed(123)
+        vals = [0, 1, 2**31, 2**32 - 1] + [random.getrandbits(32) for _ in range(1000)]
+        assert myhash_np(vals).tolist() == [myhash(v) for v in vals]
+        for height in range(6):
+            f = Tree.generate(height)
+            inp = Input.generate(f, 37, 2 * height + 3)
+            mem = build_mem_image(f, inp)
+            fast = reference_kernel_np(mem)
+            for ref_mem in reference_kernel2(list(mem)):
+                assert next(fast).tolist() == ref_mem
+            assert next(fast, None) is None
+
     def test_simple(self):
         # Test the kernel builder
         kb = KernelBuilder()
@@ -466,6 +2238,774 @@ class Tests(unittest.TestCase):
         # print(machine.cores[0])
         assert machine.cores[0].scratch[1] == 10
 
+    def test_mem_image(self):
+        random.seed(123)
+        forest = Tree.generate(3)
+        inp = Input.generate(forest, 16, 2)
+        mem = build_mem_image(forest, inp)
+        assert mem[mem[4] : mem[5]] == forest.values and mem[mem[6] :] == inp.values
+        # The machine shares the image until one of them writes
+        machine = Machine(mem, [], DebugInfo({}))
+        assert machine.mem.words is mem.words
+        expected = mem.tolist()
+        for ref_mem in reference_kernel2(mem):
+            pass
+        assert machine.mem == expected and mem != expected
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "mem.bin")
+            mem.save(path)
+            loaded = MemImage.load(path)
+            assert loaded == mem and len(loaded) == len(mem)
+            loaded[0] = 99
+            loaded[1:3] = [5, 6]
+            assert loaded[:4] == [99, 5, 6, mem[3]]
+            assert MemImage.load(path) == mem
+
+    def test_predecode_matches_step(self):
+        # The pre-decoded fast path must be bit-identical to the interpreter
+        random.seed(123)
+        forest = Tree.generate(3)
+        inp = Input.generate(forest, 16, 4)
+        mem = build_mem_image(forest, inp)
+        kb = KernelBuilder()
+        kb.build_kernel_old(forest.height, len(forest.values), len(inp.indices))
+        machines = []
+        for predecode in (False, True):
+            machine = Machine(mem, kb.instrs, kb.debug_info(), n_cores=N_CORES)
+            machine.predecode = predecode
+            machine.enable_pause = False
+            machine.run()
+            machines.append(machine)
+        slow, fast = machines
+        assert slow.cycle == fast.cycle
+        assert slow.mem == fast.mem
+        assert [c.scratch for c in slow.cores] == [c.scratch for c in fast.cores]
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_numpy_backend(self):
+        random.seed(123)
+        forest = Tree.generate(3)
+        inp = Input.generate(forest, 16, 4)
+        mem = build_mem_image(forest, inp)
+        kb = KernelBuilder()
+        kb.build_kernel_old(forest.height, len(forest.values), len(inp.indices))
+        # Exercise the vector engines too, including wraparound and big shifts
+        for i, val in enumerate([0xFFFFFFFF, 33, 7]):
+            kb.add("load", ("const", i, val))
+            kb.add("valu", ("vbroadcast", 8 * (i + 1), i))
+        for op in ALU_OPS:
+            kb.add("valu", (op, 32, 8, 16))
+            kb.add("valu", (op, 40, 16, 24))
+            kb.add("valu", ("+", 48, 32, 40))
+        kb.add("flow", ("vselect", 56, 48, 8, 16))
+        # A full bundle, which the numpy backend runs as one op per opcode
+        kb.instrs.append(
+            {"valu": [(op, 64 + 8 * i, 8 * i, 56) for i, op in enumerate("+^*&+-")]}
+        )
+        machines = []
+        for machine_cls in (Machine, NumpyMachine):
+            machine = machine_cls(mem, kb.instrs, kb.debug_info())
+            machine.enable_pause = False
+            machine.run()
+            machines.append(machine)
+        ref, fast = machines
+        assert ref.cycle == fast.cycle
+        assert ref.mem == fast.mem.tolist()
+        assert ref.cores[0].scratch == fast.cores[0].scratch.tolist()
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_batch_machine(self):
+        # A loop running mem[0] times, so the images' control flow diverges
+        kb = KernelBuilder()
+        kb.build_simple_test()
+        limit = kb.scratch["limit"]
+        i = kb.instrs.index({"load": [("const", limit, 10)]})
+        kb.instrs[i] = {"load": [("load", limit, kb.scratch_ptr)]}
+        kb.add("valu", ("vbroadcast", 16, kb.scratch["accum"]))
+        kb.add("valu", ("*", 24, 16, 16))
+        kb.add("store", ("vstore", kb.scratch_ptr, 24))
+        mems = [[n] + [0] * 15 for n in (3, 0, 10, 7, 3)]
+        batch = BatchMachine(mems, kb.instrs, kb.debug_info(), n_cores=2)
+        batch.run()
+        for j, mem in enumerate(mems):
+            machine = Machine(mem, kb.instrs, kb.debug_info(), n_cores=2)
+            machine.run()
+            assert batch.cycles[j] == machine.cycle
+            assert batch.mem[j].tolist() == machine.mem
+            for core, ref in zip(batch.cores, machine.cores):
+                assert core.scratch[j].tolist() == ref.scratch
+        assert batch.mem[:, 0].tolist() == [9, 0, 100, 49, 9]
+        assert batch.cycle == max(batch.cycles)
+
+        shape = (3, 4, 4 * VLEN * N_CORES)
+        seeds = [123, 1, 2, 3]
+        kb, batch, _ = run_kernel_batch(*shape, seeds)
+        for seed, cycles in zip(seeds, batch.cycles):
+            assert cycles == run_kernel(*shape, seed)[1].cycle
+
+    @unittest.skipIf(np is None, "numpy not installed")
+    def test_fuzz(self):
+        import fuzz
+
+        for mode, parity in [("even", 0), ("odd", 1)]:
+            mem = fuzz.make_problem(2, 9, 64, mode, 5)
+            nodes = mem[mem[4] : mem[5]]
+            for val in mem[mem[6] : mem[6] + 64]:
+                idx = 0
+                for _ in range(9):
+                    val = myhash(val ^ nodes[idx])
+                    assert val % 2 == parity
+                    idx = 2 * idx + 1 + parity
+                    idx = 0 if idx >= len(nodes) else idx
+        rng = random.Random(123)
+        for _ in range(3):
+            case = fuzz.random_case(rng, 4, 6, 3, 4)
+            assert fuzz.check(case) is None, case
+        # A kernel that can't fit in one bundle shrinks down to the option
+        # that breaks it, on the smallest shape
+        params = {"max_instrs": 1, "unroll_rounds": 2}
+        case = fuzz.Case(3, 5, 3 * VLEN * N_CORES, params, [("random", 1), ("odd", 2)])
+        case, failure = fuzz.shrink(case, fuzz.check(case))
+        assert failure.startswith("build failed")
+        assert case == fuzz.Case(0, 1, VLEN * N_CORES, {"max_instrs": 1}, [("random", 1)])
+
+    def test_parallel_machine(self):
+        shape = (3, 4, 2 * VLEN * N_CORES)
+        lockstep = run_kernel(*shape)[1]
+        machine = run_kernel(*shape, parallel=True)[1]
+        assert machine.lockstep_fallbacks == 0
+        assert machine.cycle == lockstep.cycle
+        assert machine.pc_counts == lockstep.pc_counts
+        assert machine.mem == lockstep.mem
+        # Every core stores its id to address 0, so only lockstep gets it right
+        program = [
+            {"load": [("const", 0, 0)], "flow": [("coreid", 1)]},
+            {"store": [("store", 0, 1)]},
+        ]
+        machine = Machine([0], program, DebugInfo(scratch_map={}), n_cores=N_CORES)
+        machine.parallel = True
+        machine.run()
+        assert machine.lockstep_fallbacks == 1
+        assert machine.mem == [N_CORES - 1]
+        assert machine.cycle == 3
+
+    def test_compiled_machine(self):
+        def check(mem, program, runs=1):
+            ref = Machine(mem, program, DebugInfo(scratch_map={}), n_cores=N_CORES)
+            machine = CompiledMachine(
+                mem, program, DebugInfo(scratch_map={}), n_cores=N_CORES
+            )
+            for _ in range(runs):
+                ref.run()
+                machine.run()
+                assert machine.cycle == ref.cycle
+                assert machine.pc_counts == ref.pc_counts
+                assert list(machine.mem) == list(ref.mem)
+                for core, ref_core in zip(machine.cores, ref.cores):
+                    assert (core.pc, core.state) == (ref_core.pc, ref_core.state)
+                    assert core.scratch == ref_core.scratch
+                    assert core.trace_buf == ref_core.trace_buf
+            return machine
+
+        shape = (3, 4, 2 * VLEN * N_CORES)
+        ref = run_kernel(*shape)[1]
+        machine = run_kernel(*shape, backend="compiled")[1]
+        assert machine.cycle == ref.cycle
+        assert machine.pc_counts == ref.pc_counts
+        assert list(machine.mem) == list(ref.mem)
+        # Every core stores its id to address 0 in the same cycle
+        program = [
+            {"load": [("const", 0, 0)], "flow": [("coreid", 1)]},
+            {"store": [("store", 0, 1)]},
+        ]
+        assert check([0], program).mem == [N_CORES - 1]
+        # Core i loops i + 1 times, so the cores leave the loop one by one
+        # and run its last trips on Machine's path, then meet again after it
+        program = [
+            {"load": [("const", 0, 1), ("const", 4, 0)], "flow": [("coreid", 1)]},
+            {"alu": [("+", 1, 1, 0)]},
+            {"alu": [("-", 1, 1, 0), ("*", 2, 1, 1)], "flow": [("trace_write", 1)]},
+            {"store": [("store", 1, 2)], "alu": [("+", 4, 4, 2)]},
+            {"flow": [("cond_jump", 1, 2)]},
+            {"flow": [("pause",)]},
+            {"valu": [("vbroadcast", 8, 4), ("*", 16, 8, 8)]},
+            {"store": [("vstore", 0, 16)], "flow": [("halt",)]},
+        ]
+        check([0] * 16, program, runs=2)
+
+    def test_snapshot(self):
+        random.seed(123)
+        forest = Tree.generate(3)
+        inp = Input.generate(forest, 2 * VLEN * N_CORES, 4)
+        mem = build_mem_image(forest, inp)
+        kb = KernelBuilder()
+        kb.build_kernel(forest.height, len(forest.values), len(inp.indices), 4)
+        for backend in BACKENDS:
+            machine = BACKENDS[backend](
+                mem, kb.instrs, kb.debug_info(), n_cores=N_CORES
+            )
+            machine.run()
+            machine.run()
+            blob = machine.snapshot()
+            while any(c.state != CoreState.STOPPED for c in machine.cores):
+                machine.run()
+            end = machine.snapshot()
+            # Carry on from the snapshot on a fresh machine
+            resumed = BACKENDS[backend](
+                mem, kb.instrs, kb.debug_info(), n_cores=N_CORES
+            )
+            resumed.restore(blob)
+            while any(c.state != CoreState.STOPPED for c in resumed.cores):
+                resumed.run()
+            assert resumed.snapshot() == end
+            assert resumed.stats() == machine.stats()
+
+    def test_snapshot_diff(self):
+        import snapshot_diff
+
+        shape = (3, 4, 2 * VLEN * N_CORES)
+        with tempfile.TemporaryDirectory() as tmp:
+            assert snapshot_diff.find_divergence(*shape, save_dir=tmp) is None
+            path = snapshot_diff.snapshot_path(tmp, 2)
+            with open(path, "rb") as f:
+                blob = f.read()
+            # Break one value before round 2 and it's found there by name
+            snap = MachineSnapshot.from_bytes(blob)
+            snap.mem[snap.mem[6] + 5] += 1
+            with open(path, "wb") as f:
+                f.write(snap.to_bytes())
+            i, lines = snapshot_diff.find_divergence(
+                *shape, save_dir=tmp, start_round=2, values_only=True
+            )
+            assert i == 2
+            assert "first inp_values[5] " in lines[0]
+        kb = KernelBuilder()
+        kb.build_kernel(3, 15, shape[2], shape[1])
+        original = MachineSnapshot.from_bytes(blob)
+        diff = snapshot_diff.diff_snapshots(original, snap, kb.debug_info())
+        value = original.mem[original.mem[6] + 5]
+        assert diff == [f"inp_values[5]: {value} != {value + 1}"]
+
+    def test_trace_writer(self):
+        # Traces from the pre-decoded path and from step() should be identical
+        kb = KernelBuilder()
+        kb.build_simple_test()
+        with tempfile.TemporaryDirectory() as tmp:
+            traces = []
+            for predecode in (False, True):
+                path = os.path.join(tmp, f"trace_{predecode}.json.gz")
+                machine = Machine([0] * 10, kb.instrs, kb.debug_info(), trace=path)
+                machine.predecode = predecode
+                machine.run()
+                machine.close_trace()
+                with gzip.open(path, "rt") as f:
+                    traces.append(json.load(f))
+        assert traces[0] == traces[1]
+        ops = [e for e in traces[1] if e["ph"] == "X"]
+        # 2 setup slots, 10 iterations of 5 and the final exit check
+        assert len(ops) == 2 + 10 * 5 + 3
+        assert ops[-1]["name"] == "cond_jump" and ops[-1]["args"]["pc"] == 4
+
+    def test_machine_stats(self):
+        kb = KernelBuilder()
+        kb.build_simple_test()
+        kb.instrs.append({"load": [("vload", 4, 0), ("load", 3, 0)]})
+        kb.instrs.append({"store": [("vstore", 0, 4)], "flow": [("halt",)]})
+        machine = Machine([0] * 10, kb.instrs, kb.debug_info())
+        machine.run()
+        stats = machine.stats()
+        assert stats.bundles == 57
+        assert stats.pc_counts[2] == 11 and stats.pc_counts[5] == 10
+        # Every bundle fills the single flow slot or leaves it empty
+        assert stats.saturated["flow"] == stats.occupancy["flow"][1] == 10 + 11 + 1
+        assert stats.occupancy["alu"][1] == 11 * 2 + 10
+        assert stats.occupancy["load"][2] == 1
+        assert stats.words_loaded == VLEN + 1 and stats.words_stored == VLEN
+
+    def test_list_schedule(self):
+        # Scheduled random straight-line code must match running it one slot
+        # per bundle. Addresses stay small so loads and stores stay in range.
+        rng = random.Random(123)
+
+        def rand_slot():
+            a, v = rng.randrange(24), rng.randrange(17)
+            return rng.choice(
+                [
+                    ("alu", (rng.choice("+*^-"), a, rng.randrange(24), v)),
+                    ("valu", (rng.choice("+*^"), v, rng.randrange(17), a % 17)),
+                    ("valu", ("vbroadcast", v, a)),
+                    ("load", ("const", a, rng.randrange(40))),
+                    ("load", ("load", a, v)),
+                    ("load", ("vload", v, a)),
+                    ("store", ("store", a, v)),
+                    ("store", ("vstore", a, v)),
+                    ("flow", ("select", a, v, a, rng.randrange(24))),
+                ]
+            )
+
+        checked = 0
+        for _ in range(300):
+            slots = [rand_slot() for _ in range(rng.randrange(1, 60))]
+            setup = [{"load": [("const", i, rng.randrange(8))]} for i in range(32)]
+            mem = [rng.randrange(8) for _ in range(64)]
+            kb = KernelBuilder()
+            serial = Machine(mem, setup + kb.build(slots), kb.debug_info())
+            packed = Machine(mem, setup + kb.build(slots, vliw=True), kb.debug_info())
+            try:
+                serial.run()
+            except IndexError:
+                continue
+            packed.run()
+            assert packed.mem == serial.mem, slots
+            assert packed.cores[0].scratch == serial.cores[0].scratch, slots
+            assert packed.cycle <= serial.cycle
+            checked += 1
+        assert checked > 200
+
+    def test_optimize(self):
+        # Optimized random straight-line code must leave memory and the live
+        # registers as running it unoptimized does, with or without renaming
+        # (which hides values being overwritten from the other passes).
+        # Registers are virtual and some lanes are written one at a time. Ops
+        # like the kernel's masks, copies and parity tests are mixed in so
+        # every pass has work to do.
+        def check(kb, slots, live, mem):
+            """Whether slots ran, checking they match once optimized if so"""
+            optimized = kb.optimize(slots, live)
+            plain = kb.allocate(kb.instrs + kb.build(slots))
+            packed = kb.allocate(kb.instrs + kb.build(optimized, vliw=True))
+            serial = Machine(mem, plain, kb.debug_info())
+            try:
+                serial.run()
+            except IndexError:
+                return False
+            machine = Machine(mem, packed, kb.debug_info())
+            machine.run()
+            assert machine.mem == serial.mem, slots
+            for a in live:
+                assert machine.cores[0].scratch[a] == serial.cores[0].scratch[a]
+            assert len(optimized) <= len(slots)
+            return True
+
+        rng = random.Random(123)
+        checked = 0
+        for n in range(600):
+            passes = OPT_PASSES if n % 2 else [p for p in OPT_PASSES if p != "rename"]
+            kb = KernelBuilder(passes=passes)
+            zero, one, two = (kb.scratch_const(c) for c in (0, 1, 2))
+            v_zero, v_one, v_two, v_mask = (
+                kb.scratch_vconst(c) for c in (0, 1, 2, 2**32 - 1)
+            )
+            regs = [kb.alloc_vreg(f"r{k}") for k in range(6)]
+            vregs = [kb.alloc_vreg(f"v{k}", VLEN) for k in range(4)]
+            lanes = regs + vregs + [v + rng.randrange(1, VLEN) for v in vregs]
+            slots = [("load", ("const", r, rng.randrange(64))) for r in regs]
+            slots += [("valu", ("vbroadcast", v, rng.choice(regs))) for v in vregs]
+
+            def rand_slot():
+                r, s, t = rng.choice(regs), rng.choice(lanes), rng.choice(lanes)
+                v, w, x = (rng.choice(vregs) for _ in range(3))
+                # A parity test, sometimes with what it tests overwritten
+                parity = [
+                    ("valu", ("%", w, x, v_two)),
+                    ("valu", ("==", v, w, v_zero)),
+                    ("flow", ("vselect", x, v, v_one, v_two)),
+                ]
+                overwrite = ("valu", ("+", rng.choice([w, x]), x, v_one))
+                parity.insert(rng.randrange(1, 4), overwrite)
+                return rng.choice(
+                    [
+                        [("alu", (rng.choice("+*^-<"), rng.choice(lanes), s, t))],
+                        [("alu", ("+", r, s, zero))],
+                        [("alu", ("%", r, s, two)), ("alu", ("==", t, r, zero))],
+                        [("valu", (rng.choice("+*^<"), v, w, x))],
+                        [("valu", ("&", v, v, v_mask))],
+                        [("valu", ("+", v, w, v_zero))],
+                        [("valu", ("%", v, w, v_two))],
+                        [("valu", ("==", v, w, v_zero))],
+                        [("flow", ("vselect", v, w, v_one, v_two))],
+                        parity,
+                        [("load", ("const", r, rng.randrange(64)))],
+                        [("load", ("load", r, s))],
+                        [("store", ("store", s, t))],
+                        [("store", ("vstore", s, v))],
+                        [("flow", ("select", r, s, t, r))],
+                    ]
+                )
+
+            for _ in range(rng.randrange(1, 30)):
+                slots += rand_slot()
+            # Half the registers end up in scratch that's live afterwards
+            live = set()
+            for r in regs[:3]:
+                live.add(kb.alloc_scratch())
+                slots.append(("alu", ("+", max(live), r, zero)))
+            for v in vregs[:2]:
+                live.update(vec(kb.alloc_scratch(length=VLEN)))
+                slots.append(("valu", ("+", max(live) - VLEN + 1, v, v_zero)))
+            checked += check(kb, slots, live, [rng.randrange(64) for _ in range(64)])
+        assert checked > 400
+
+        # Too rare to count on above: a lane that's copied out and dead
+        # after, of a vector read whole before the copy
+        kb = KernelBuilder()
+        zero, one = kb.scratch_const(0), kb.scratch_const(1)
+        v, out = kb.alloc_vreg("v", VLEN), kb.alloc_scratch("out")
+        slots = [
+            ("valu", ("vbroadcast", v, one)),
+            ("alu", ("==", v, one, zero)),
+            ("store", ("vstore", zero, v)),
+            ("alu", ("+", out, v, zero)),
+        ]
+        assert check(kb, slots, {out}, [0] * VLEN)
+
+        # The kernel's batch body loses its masks, the copy out of the hash,
+        # the parity test and its recomputed addresses
+        kb = KernelBuilder(tree_cache_levels=0)
+        kb.build_kernel(10, 2047, 256, 16)
+        fused = sum(fuse_hash_stage(stage)[0] == "madd" for stage in HASH_STAGES)
+        assert kb.pass_savings["masks"] == 1 + 3 * len(HASH_STAGES) - fused
+        assert kb.pass_savings["dead"] == 4
+
+    def test_gather(self):
+        # Lane i of the result is mem[base + indices[i]], with the addresses
+        # from alu or valu ops, and the loads fill both load slots
+        rng = random.Random(123)
+        mem = [rng.randrange(2**32) for _ in range(64)]
+        indices = [rng.randrange(32) for _ in range(VLEN)]
+        for use_vbase in (False, True):
+            kb = KernelBuilder()
+            base = kb.scratch_const(16)
+            vbase = kb.scratch_vconst(16) if use_vbase else None
+            idx, dest = kb.alloc_scratch("idx", VLEN), kb.alloc_scratch("dest", VLEN)
+            for i, index in enumerate(indices):
+                kb.add("load", ("const", idx + i, index))
+            slots = kb.gather(dest, base, idx, vbase)
+            assert len(slots) == (1 if use_vbase else VLEN) + VLEN
+            gather = kb.allocate(kb.build(slots, vliw=True))
+            assert sum("load" in instr for instr in gather) == VLEN // 2
+            machine = Machine(mem, kb.instrs + gather, kb.debug_info())
+            machine.run()
+            scratch = machine.cores[0].scratch
+            assert scratch[dest : dest + VLEN] == [mem[16 + i] for i in indices]
+
+    def test_fused_hash(self):
+        # The (a + C) + (a << k) stages are a multiply and an add in
+        # build_hash, which must still hash like myhash: on every single bit,
+        # the ends of the range and random values
+        rng = random.Random(123)
+        vals = [0, 2**32 - 1] + [1 << i for i in range(32)]
+        vals += [rng.randrange(2**32) for _ in range(2000)]
+        kb = KernelBuilder()
+        val, tmp1, tmp2, addr = (kb.alloc_scratch() for _ in range(4))
+        body = []
+        for i in range(len(vals)):
+            body.append(("load", ("const", addr, i)))
+            body.append(("load", ("load", val, addr)))
+            body += kb.build_hash(val, tmp1, tmp2)
+            body.append(("store", ("store", addr, val)))
+        kb.instrs.extend(kb.build(body, vliw=True))
+        machine = Machine(list(vals), kb.instrs, kb.debug_info())
+        machine.run()
+        assert machine.mem == [myhash(v) for v in vals]
+
+        fused = [s for s in HASH_STAGES if fuse_hash_stage(s)[0] == "madd"]
+        assert len(fused) == 3
+        hash_ops = 3 * len(HASH_STAGES) - len(fused)
+        assert len(kb.build_hash(val, tmp1, tmp2)) == hash_ops
+
+    def test_modulo_loop(self):
+        # out[i-1] = 3 * mem[i-1] + i and total += mem[i-1], pipelined or not
+        for trip_count in range(20):
+            results = []
+            for pipelined in (False, True, "mem_disjoint"):
+                kb = KernelBuilder()
+                one, three = kb.scratch_const(1), kb.scratch_const(3)
+                out_p, limit = kb.scratch_const(32), kb.scratch_const(trip_count)
+                i, total = kb.alloc_scratch("i"), kb.alloc_scratch("total")
+                addr, val = kb.alloc_scratch("addr"), kb.alloc_scratch("val")
+                body = [
+                    ("alu", ("-", addr, i, one)),
+                    ("load", ("load", val, addr)),
+                    ("alu", ("+", total, total, val)),
+                    ("alu", ("*", val, val, three)),
+                    ("alu", ("+", val, val, i)),
+                    ("alu", ("+", addr, addr, out_p)),
+                    ("store", ("store", addr, val)),
+                ]
+                if pipelined:
+                    loop = kb.for_loop(
+                        i,
+                        limit,
+                        body,
+                        trip_count=trip_count,
+                        mem_disjoint=pipelined == "mem_disjoint",
+                    )
+                else:
+                    loop = kb.for_loop(i, limit, kb.build(body))
+                kb.instrs.extend(loop)
+                program = resolve_labels(kb.instrs)
+                machine = Machine(list(range(64)), program, kb.debug_info())
+                machine.run()
+                results.append((machine.mem, machine.cores[0].scratch[total]))
+            assert results[0] == results[1] == results[2], trip_count
+
+    def test_reorder_blocks(self):
+        # Copies of a loop jump within themselves, and markers take no bundles
+        kb = KernelBuilder()
+        i, limit = kb.alloc_scratch("i"), kb.scratch_const(2)
+        loop = kb.for_loop(i, limit, [{"alu": [("+", 0, 0, 0)]}])
+        program = resolve_labels(loop + relocate(loop))
+        assert len(program) == 2 * (len(loop) - 2)
+        assert program[-1]["flow"] == [("jump", len(loop) - 2)]
+        with self.assertRaisesRegex(AssertionError, "never placed"):
+            resolve_labels([{"flow": [("jump", Label("nowhere"))]}])
+
+        shape = (3, 7, 2 * VLEN * N_CORES)
+        kb, profiled, _ = run_kernel(*shape)
+        kb.reorder_blocks(profiled.pc_counts)
+        assert kb.labels["setup"] == 0
+        random.seed(123)
+        forest = Tree.generate(shape[0])
+        inp = Input.generate(forest, shape[2], shape[1])
+        mem = build_mem_image(forest, inp)
+        machine = Machine(mem, kb.instrs, kb.debug_info(), n_cores=N_CORES)
+        for ref_mem in reference_kernel2(mem):
+            machine.run()
+            values = slice(ref_mem[6], ref_mem[6] + shape[2])
+            assert list(machine.mem[values]) == list(ref_mem[values])
+        # The round loop's backwards jump now falls through
+        assert machine.cycle < profiled.cycle
+
+    def test_allocate(self):
+        # Far more vectors than fit in scratch, but only a few live at a time,
+        # with acc carried around the loop
+        kb = KernelBuilder()
+        one, limit = kb.scratch_const(1), kb.scratch_const(3)
+        i, out = kb.alloc_scratch("i"), kb.alloc_scratch("out")
+        acc = kb.alloc_vreg("acc", VLEN)
+        kb.add("valu", ("vbroadcast", acc, one))
+        body = []
+        for k in range(400):
+            v = kb.alloc_vreg(f"v{k}", VLEN)
+            body.append(("valu", ("+", v, acc, acc)))
+            body.append(("valu", ("^", acc, v, acc)))
+        kb.instrs.extend(kb.for_loop(i, limit, kb.build(body, vliw=True)))
+        kb.add("store", ("vstore", out, acc))
+        program = kb.allocate(resolve_labels(kb.instrs))
+        machine = Machine([0] * 16, program, kb.debug_info())
+        machine.run()
+        expected = 1
+        for _ in range(3 * 400):
+            expected ^= 2 * expected % 2**32
+        assert machine.mem[:VLEN] == [expected] * VLEN
+        assert kb.scratch_ptr < 64
+
+        # All of them live at once
+        ws = [kb.alloc_vreg(f"w{k}", VLEN) for k in range(200)]
+        writes = [("valu", ("+", w, acc, acc)) for w in ws]
+        reads = [("valu", ("+", acc, acc, w)) for w in ws]
+        with self.assertRaisesRegex(AssertionError, "live: .*w17"):
+            kb.allocate(kb.build(writes + reads))
+
+    def test_tree_cache(self):
+        # Nine rounds of a height 3 tree go back to the root after the leaves,
+        # with depths picked at runtime or fixed by unrolling the rounds
+        for levels in (1, 2, 5):
+            for unroll_rounds in (1, 2, None):
+                do_kernel_test(
+                    3,
+                    9,
+                    2 * VLEN * N_CORES,
+                    builder_args=dict(
+                        tree_cache_levels=levels, unroll_rounds=unroll_rounds
+                    ),
+                )
+
+    def test_unrolled_kernel(self):
+        # do_kernel_test checks every round against the reference
+        for unroll_rounds, unroll_batches in [(None, 1), (3, 2), (2, None), (1, 3)]:
+            do_kernel_test(
+                3,
+                5,
+                8 * VLEN * N_CORES,
+                builder_args=dict(
+                    unroll_rounds=unroll_rounds, unroll_batches=unroll_batches
+                ),
+            )
+        kb = KernelBuilder(unroll_rounds=None, max_instrs=100)
+        with self.assertRaises(AssertionError):
+            kb.build_kernel(10, 2047, 1024, 16)
+
+    def test_analyze(self):
+        import analyze
+
+        kb = KernelBuilder()
+        kb.build_simple_test()
+        machine = Machine([0], kb.instrs, kb.debug_info())
+        machine.run()
+        counts, guesses = analyze.exec_counts(kb.instrs)
+        assert counts == machine.pc_counts and guesses == []
+
+        shape = (3, 5, 8 * VLEN * N_CORES)
+        for args in [{}, {"unroll_rounds": 2}, {"tree_cache_levels": 2}]:
+            kb, machine, _ = run_kernel(*shape, builder_args=args)
+            result = analyze.estimate(kb.instrs)
+            assert result["guesses"] == []
+            # Off by the loop tests after the last pause
+            assert 0 <= result["cycles"] - machine.cycle <= 8
+            assert result["resource_floor"] <= result["region_floor"]
+            assert result["region_floor"] <= machine.cycle
+        # Without rounds at build time the round loop's trip count is a guess
+        kb = KernelBuilder()
+        kb.build_kernel(3, 15, 8 * VLEN * N_CORES)
+        assert analyze.estimate(kb.instrs)["guesses"]
+
+    def test_trace_stats(self):
+        import io
+        import trace_stats
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json.gz")
+            kb, machine, _ = run_kernel(3, 4, 4 * VLEN * N_CORES, trace=path)
+            machine.close_trace()
+            out = io.StringIO()
+            summary = trace_stats.summarize(trace_stats.read_events(path), 7, out)
+        stats = machine.stats()
+        assert summary.cycles == machine.cycle
+        for engine in SLOT_LIMITS:
+            n = sum(summary.slots[core, engine] for core in range(N_CORES))
+            assert n == stats.slots(engine)
+        runs = {pc: b.runs for pc, b in summary.bundles.items()}
+        assert runs == {
+            pc: n
+            for pc, n in enumerate(stats.pc_counts)
+            if n and set(kb.instrs[pc]) - {"debug"}
+        }
+        # The counters add back up to the slots, windows being 7 cycles
+        counters = [e for e in json.loads(out.getvalue()) if e["ph"] == "C"]
+        ends = sorted({e["ts"] for e in counters}) + [summary.cycles]
+        width = dict(zip(ends, [b - a for a, b in zip(ends, ends[1:])]))
+        filled = sum(
+            e["args"]["occupancy"] * SLOT_LIMITS[e["name"]] * width[e["ts"]]
+            for e in counters
+        )
+        assert abs(filled - summary.events) < 1e-3 * summary.events
+        assert kb.labels["setup"] == 0 and "gather batches" in kb.labels
+        rows = trace_stats.hot_spots(summary, kb.labels)
+        assert sum(r[1] for r in rows) == sum(runs.values())
+        assert rows[0][2] == max(r[2] for r in rows)
+
+    def test_watch_trace(self):
+        import http.server
+        import threading
+        import urllib.error
+        import urllib.request
+        import watch_trace
+
+        with tempfile.TemporaryDirectory() as tmp:
+            trace = os.path.join(tmp, "trace.json")
+            ui = os.path.join(tmp, "ui")
+            os.makedirs(ui)
+            bundle = os.path.join(ui, "frontend_bundle.js")
+            with open(bundle, "wb") as f:
+                f.write(b"track = {collapsed: true}")
+            with open(trace, "w") as f:
+                json.dump([{"ph": "X", "ts": i} for i in range(100)], f)
+
+            class Handler(watch_trace.MyHandler):
+                assets = ui
+                cache_dir = os.path.join(tmp, "cache")
+                trace_files = [trace, trace + ".gz"]
+
+                def log_message(self, *args):
+                    pass
+
+            server = http.server.ThreadingHTTPServer(("localhost", 0), Handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://localhost:{server.server_address[1]}"
+
+            def get(path, **headers):
+                request = urllib.request.Request(url + path, headers=headers)
+                try:
+                    with urllib.request.urlopen(request, timeout=10) as r:
+                        return r.status, r.headers, r.read()
+                except urllib.error.HTTPError as e:
+                    return e.code, e.headers, b""
+
+            try:
+                # The bundle is patched once as it's cached, then served offline
+                _, _, body = get("/perfetto/frontend_bundle.js")
+                assert body == b"track = {collapsed: false}"
+                os.remove(bundle)
+                assert get("/perfetto/frontend_bundle.js")[2] == body
+                assert get("/perfetto/missing.js")[0] == 404
+
+                status, headers, body = get("/trace.json")
+                with open(trace, "rb") as f:
+                    assert gzip.decompress(body) == f.read()
+                assert headers["Content-Encoding"] == "gzip"
+                status, _, part = get("/trace.json", Range="bytes=10-19")
+                assert status == 206 and part == body[10:20]
+                assert get("/trace.json", Range="bytes=-5")[2] == body[-5:]
+                assert get("/trace.json", Range=f"bytes={len(body)}-")[0] == 416
+                etag = headers["ETag"]
+                assert get("/trace.json", **{"If-None-Match": etag})[0] == 304
+
+                # A new trace is announced once it's done being written
+                with urllib.request.urlopen(url + "/events", timeout=10) as events:
+
+                    def next_version():
+                        while not (line := events.readline()).startswith(b"data:"):
+                            pass
+                        return line.split()[1].decode()
+
+                    assert next_version() == headers["X-Trace-Version"]
+                    with open(trace, "a") as f:
+                        f.write(" ")
+                    version = next_version()
+                _, headers, _ = get("/trace.json", **{"If-None-Match": etag})
+                assert headers["X-Trace-Version"] == version != etag
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_autotune(self):
+        import autotune
+
+        space = {"unroll_rounds": [1, None], "max_instrs": [1, INSTR_LIMIT]}
+        shape = (2, 3, 2 * VLEN * N_CORES)
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = os.path.join(tmp, "cache.json")
+            results = autotune.tune(space, shape, workers=1, cache_path=cache)
+            # Nothing fits in one bundle
+            assert [p["max_instrs"] for p, r in results if "error" in r] == [1, 1]
+            mtime = os.path.getmtime(cache)
+            assert autotune.tune(space, shape, cache_path=cache) == results
+            assert os.path.getmtime(cache) == mtime
+        front = autotune.pareto_front(results)
+        cycles = [r["cycles"] for _, r in results if "error" not in r]
+        assert front[0][1]["cycles"] == min(cycles)
+
+    def test_benchmark(self):
+        import benchmark
+
+        shapes = benchmark.grid([2, 3], [3], [2 * VLEN * N_CORES], [123])
+        results = [benchmark.measure(*shape) for shape in shapes]
+        assert not any(row["error"] for row in results)
+        assert results[0]["cycles"] == do_kernel_test(2, 3, 2 * VLEN * N_CORES)
+        assert benchmark.compare(results, results) == []
+        faster = [dict(row, cycles=row["cycles"] - 1) for row in results]
+        assert len(benchmark.compare(results, faster)) == 2
+        assert benchmark.compare(results, faster, tolerance=0.5) == []
+        broken = [dict(results[0], error="AssertionError"), results[1]]
+        assert len(benchmark.compare(broken, results)) == 1
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "results.json")
+            benchmark.save_results(path, results)
+            assert benchmark.load_results(path) == results
+            benchmark.save_results(os.path.join(tmp, "results.csv"), results)
+
     def test_kernel_trace(self):
         # Tiny example for correctness debugging
         # do_kernel_test(3, 1, 1, trace=True, prints=True)
@@ -5,11 +5,27 @@ This file is separate mostly for ease of copying it to freeze the machine and
 reference kernel for testing.
 """
 
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from copy import copy
 from dataclasses import dataclass
 from enum import Enum
-from typing import Literal
+from typing import Callable, Literal
+import gzip
+import hashlib
+import json
+import mmap
+import multiprocessing
+import operator
+import os
 import random
+import tempfile
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only NumpyMachine needs it
+    np = None
 
 Engine = Literal["alu", "load", "store", "flow"]
 Instruction = dict[Engine, list[tuple]]
@@ -57,6 +73,311 @@ VLEN = 8
 N_CORES = 4
 SCRATCH_SIZE = 1536
 
+# Binary ops shared by the alu and valu engines, before the 32-bit wraparound
+ALU_OPS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "//": operator.floordiv,
+    "cdiv": cdiv,
+    "^": operator.xor,
+    "&": operator.and_,
+    "|": operator.or_,
+    "<<": operator.lshift,
+    ">>": operator.rshift,
+    "%": operator.mod,
+    "<": lambda a, b: int(a < b),
+    "==": lambda a, b: int(a == b),
+}
+
+# A pre-decoded slot: called as fn(core, mem, scratch_write, mem_write)
+DecodedSlot = Callable[["Core", list[int], dict[int, int], dict[int, int]], None]
+
+
+@dataclass
+class MachineStats:
+    """
+    Utilization counters for everything a Machine has executed so far. Only
+    per-pc execution counts are collected while running, everything else is
+    derived from them and the static contents of each bundle.
+
+    Bundle counts are summed over cores, so with several cores running a
+    bundle executed once by each core counts once per core.
+    """
+
+    cycles: int
+    # Bundles executed, summed over cores
+    bundles: int
+    # Times each bundle in the program was executed
+    pc_counts: list[int]
+    # occupancy[engine][k] is the number of bundles with k slots of engine
+    occupancy: dict[str, list[int]]
+    # Bundles that filled every slot of an engine
+    saturated: dict[str, int]
+    # Memory words moved by the load and store engines
+    words_loaded: int
+    words_stored: int
+
+    def slots(self, engine: str) -> int:
+        return sum(k * n for k, n in enumerate(self.occupancy[engine]))
+
+    def utilization(self) -> dict[str, float]:
+        """Fraction of each engine's slots that were filled"""
+        return {
+            engine: self.slots(engine) / max(1, limit * self.bundles)
+            for engine, limit in SLOT_LIMITS.items()
+        }
+
+    def summary(self) -> str:
+        util = " ".join(f"{e}={u:.1%}" for e, u in self.utilization().items())
+        return (
+            f"{self.bundles} bundles, {util}, "
+            f"{self.words_loaded} words loaded, {self.words_stored} words stored"
+        )
+
+
+def slot_words(slot: tuple) -> int:
+    """Memory words a load or store engine slot reads or writes"""
+    match slot[0]:
+        case "load" | "load_offset" | "store":
+            return 1
+        case "vload" | "vstore":
+            return VLEN
+    return 0
+
+
+# Every (engine, slot index) pair a core has, in trace thread order
+TRACE_LANES = [(name, i) for name, limit in SLOT_LIMITS.items() for i in range(limit)]
+
+
+class TraceWriter:
+    """
+    Buffered sink for slot traces. Each executed slot is appended to an
+    in-memory array as a compact (cycle, core, lane, pc, slot id) record,
+    where lane indexes TRACE_LANES and slot ids index the interned slots.
+    Full blocks are spilled to a temporary binary file, and the Chrome Trace
+    Event JSON is only produced by export(), in a single streaming pass.
+
+    Paths ending in .gz are written gzip-compressed.
+    """
+
+    RECORD = 5
+    BLOCK_RECORDS = 1 << 16
+
+    def __init__(self, path: str, n_cores: int):
+        self.path = path
+        self.n_cores = n_cores
+        self.buf = array("I")
+        self.spill = tempfile.TemporaryFile()
+        self.slot_ids = {}
+        self.slots = []
+
+    def slot_id(self, slot: tuple) -> int:
+        if slot not in self.slot_ids:
+            self.slot_ids[slot] = len(self.slots)
+            self.slots.append(slot)
+        return self.slot_ids[slot]
+
+    def tid(self, core_id: int, lane: int) -> int:
+        # Matches the thread numbering of the metadata events
+        return core_id * len(TRACE_LANES) + lane + 1
+
+    def add(self, cycle: int, core_id: int, lane: int, pc: int, slot_id: int):
+        self.buf.extend((cycle, core_id, lane, pc, slot_id))
+        if len(self.buf) >= self.RECORD * self.BLOCK_RECORDS:
+            self.flush()
+
+    def add_bundle(self, cycle: int, core_id: int, pc: int, lanes):
+        """Add a record per (lane, slot id) pair of one executed bundle"""
+        buf = self.buf
+        for lane, slot_id in lanes:
+            buf.extend((cycle, core_id, lane, pc, slot_id))
+        if len(buf) >= self.RECORD * self.BLOCK_RECORDS:
+            self.flush()
+
+    def flush(self):
+        self.buf.tofile(self.spill)
+        del self.buf[:]
+
+    def records(self):
+        """Yield the records so far as arrays of whole records, in order"""
+        self.flush()
+        self.spill.seek(0)
+        block = self.RECORD * self.BLOCK_RECORDS * self.buf.itemsize
+        while chunk := self.spill.read(block):
+            records = array("I")
+            records.frombytes(chunk)
+            yield records
+        self.spill.seek(0, 2)
+
+    def metadata_events(self):
+        for ci in range(self.n_cores):
+            yield (
+                f'{{"name": "process_name", "ph": "M", "pid": {ci}, "tid": 0, '
+                f'"args": {{"name":"Core {ci}"}}}}'
+            )
+            for lane, (name, i) in enumerate(TRACE_LANES):
+                yield (
+                    f'{{"name": "thread_name", "ph": "M", "pid": {ci}, '
+                    f'"tid": {self.tid(ci, lane)}, "args": {{"name":"{name}-{i}"}}}}'
+                )
+
+    def events(self):
+        """Yield Chrome Trace Event JSON objects, one string per event"""
+        yield from self.metadata_events()
+        texts = [(json.dumps(slot[0]), json.dumps(str(slot))) for slot in self.slots]
+        n = self.RECORD
+        for records in self.records():
+            for r in range(0, len(records), n):
+                cycle, core_id, lane, pc, slot_id = records[r : r + n]
+                name, text = texts[slot_id]
+                yield (
+                    f'{{"name": {name}, "cat": "op", "ph": "X", "pid": {core_id}, '
+                    f'"tid": {self.tid(core_id, lane)}, "ts": {cycle}, "dur": 1, '
+                    f'"args": {{"slot": {text}, "pc": {pc}}}}}'
+                )
+
+    def export(self, path: str | None = None):
+        """
+        Write everything traced so far as Chrome Trace JSON, one event per
+        line. Can be called at any point, tracing continues afterwards.
+        """
+        path = path or self.path
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "wt") as f:
+            f.write("[\n")
+            lines = []
+            for event in self.events():
+                lines.append(event)
+                if len(lines) >= self.BLOCK_RECORDS:
+                    f.write(",\n".join(lines) + ",\n")
+                    lines = []
+            f.write(",\n".join(lines) + "\n]\n")
+
+    def close(self):
+        self.export()
+        self.spill.close()
+
+
+@dataclass
+class MachineSnapshot:
+    """
+    Everything a Machine needs to carry on running from some point: main
+    memory, the cycle count, per-pc execution counts and each core's pc,
+    state, scratch and trace buffer. to_bytes() packs it all into 32-bit
+    words and zlib-compresses them.
+    """
+
+    MAGIC = 0x534E4150
+
+    cycle: int
+    mem: list[int]
+    pc_counts: list[int]
+    cores: list[Core]
+
+    def to_bytes(self) -> bytes:
+        words = array("I", [self.MAGIC, self.cycle, len(self.mem)])
+        words.append(len(self.pc_counts))
+        words.append(len(self.cores))
+        for core in self.cores:
+            words.extend([core.id, core.pc, core.state.value])
+            words.extend([len(core.scratch), len(core.trace_buf)])
+        words.extend(self.mem)
+        words.extend(self.pc_counts)
+        for core in self.cores:
+            words.extend(core.scratch)
+            words.extend(core.trace_buf)
+        return zlib.compress(words.tobytes(), 1)
+
+    @classmethod
+    def from_bytes(cls, blob: bytes) -> "MachineSnapshot":
+        words = array("I")
+        words.frombytes(zlib.decompress(blob))
+        assert words[0] == cls.MAGIC, "Not a machine snapshot"
+        cycle, n_mem, n_pcs, n_cores = words[1:5]
+        header = [words[5 + 5 * i : 10 + 5 * i] for i in range(n_cores)]
+        pos = 5 + 5 * n_cores
+
+        def take(n: int) -> list[int]:
+            nonlocal pos
+            pos += n
+            return words[pos - n : pos].tolist()
+
+        mem, pc_counts = take(n_mem), take(n_pcs)
+        cores = [
+            Core(
+                id=core_id,
+                scratch=take(n_scratch),
+                trace_buf=take(n_trace),
+                pc=pc,
+                state=CoreState(state),
+            )
+            for core_id, pc, state, n_scratch, n_trace in header
+        ]
+        return cls(cycle, mem, pc_counts, cores)
+
+
+class MemRecorder:
+    """
+    Wraps a core's view of main memory and remembers every address it reads
+    or writes, so a parallel run can check that cores didn't interact
+    """
+
+    def __init__(self, mem):
+        self.mem = mem
+        self.reads = set()
+        self.writes = set()
+
+    def __len__(self):
+        return len(self.mem)
+
+    def addrs(self, index) -> range:
+        if isinstance(index, slice):
+            return range(*index.indices(len(self.mem)))
+        return range(index, index + 1)
+
+    def __getitem__(self, index):
+        self.reads.update(self.addrs(index))
+        return self.mem[index]
+
+    def item(self, index):
+        self.reads.add(index)
+        return self.mem.item(index)
+
+    def __setitem__(self, index, val):
+        self.writes.update(self.addrs(index))
+        self.mem[index] = val
+
+
+# The single-core machine each parallel worker process runs cores on
+_core_machine = None
+
+
+def _init_core_worker(machine_cls, program, debug_info, scratch_size, shared):
+    global _core_machine
+    _core_machine = machine_cls([], program, debug_info, scratch_size=scratch_size)
+    _core_machine.shared = _core_machine.shared_mem(shared)
+
+
+def _run_core(core, enable_pause: bool, predecode: bool, record: bool):
+    """
+    Run one core on the shared memory until it pauses or stops. Returns the
+    core, the cycles it ran for, its pc counts and, if record is set, the
+    addresses it read and wrote.
+    """
+    machine = _core_machine
+    machine.cores = [core]
+    machine.cycle = 0
+    machine.pc_counts = [0] * len(machine.program)
+    machine.enable_pause = enable_pause
+    machine.predecode = predecode
+    machine.mem = MemRecorder(machine.shared) if record else machine.shared
+    machine.run()
+    reads = writes = None
+    if record:
+        reads, writes = machine.mem.reads, machine.mem.writes
+    return core, machine.cycle, machine.pc_counts, reads, writes
+
 
 class Machine:
     """
@@ -101,7 +422,7 @@ class Machine:
         debug_info: DebugInfo,
         n_cores: int = 1,
         scratch_size: int = SCRATCH_SIZE,
-        trace: bool = False,
+        trace: bool | str = False,
     ):
         self.cores = [
             Core(id=i, scratch=[0] * scratch_size, trace_buf=[]) for i in range(n_cores)
@@ -112,56 +433,421 @@ class Machine:
         self.prints = False
         self.cycle = 0
         self.enable_pause = True
+        # Set to False to run every bundle through the step() interpreter
+        self.predecode = True
+        # Set to True (one worker per core) or a worker count to simulate the
+        # cores in separate processes, see run_parallel()
+        self.parallel = False
+        # None checks that cores didn't interact in a parallel run, True trusts
+        # that they only touch disjoint memory
+        self.mem_disjoint = None
+        # Parallel runs that were redone in lockstep because cores interacted
+        self.lockstep_fallbacks = 0
+        self.pool = None
+        self.decode()
+        self.trace = None
         if trace:
-            self.setup_trace()
-        else:
-            self.trace = None
+            self.setup_trace(trace if isinstance(trace, str) else "trace.json")
 
-    def setup_trace(self):
+    def setup_trace(self, path: str = "trace.json"):
         """
         The simulator generates traces in Chrome's Trace Event Format for
         visualization in Perfetto (or chrome://tracing if you prefer it). See
         the bottom of the file for info about how to use this.
 
+        Slots are buffered as binary records by a TraceWriter and the JSON is
+        written to path when the machine is closed or garbage collected, or
+        whenever self.trace.export() is called. Use a path ending in .gz for
+        a compressed trace.
+
         See the format docs in case you want to add more info to the trace:
         https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU/preview
         """
-        self.trace = open("trace.json", "w")
-        self.trace.write("[")
-        tid_counter = 0
+        self.trace = TraceWriter(path, len(self.cores))
+        self.trace_lanes = {}
         self.tids = {}
         for ci, core in enumerate(self.cores):
-            self.trace.write(
-                f'{{"name": "process_name", "ph": "M", "pid": {ci}, "tid": 0, "args": {{"name":"Core {ci}"}}}},\n'
-            )
-            for name, limit in SLOT_LIMITS.items():
-                for i in range(limit):
-                    tid_counter += 1
-                    self.trace.write(
-                        f'{{"name": "thread_name", "ph": "M", "pid": {ci}, "tid": {tid_counter}, "args": {{"name":"{name}-{i}"}}}},\n'
-                    )
-                    self.tids[(ci, name, i)] = tid_counter
+            for lane, (name, i) in enumerate(TRACE_LANES):
+                self.tids[(ci, name, i)] = self.trace.tid(ci, lane)
+
+    def close_trace(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
 
     def print_step(self, instr, core):
         print(core.id, core.pc, instr)
 
+    def decode(self):
+        """
+        Decode the program once into a list of pre-bound slot closures per
+        bundle, so run() only has to dispatch. A bundle that doesn't decode
+        (unknown op, too many slots for an engine) becomes None and is left
+        to step(), which raises the same error when it's actually executed.
+        """
+        self.decoded = [self.decode_instr(instr) for instr in self.program]
+        self.decoded_program = self.program
+        self.pc_counts = [0] * len(self.program)
+        self.trace_lanes = {}
+
+    def decode_instr(self, instr: Instruction) -> list[DecodedSlot] | None:
+        decoders = {
+            "alu": self.decode_alu,
+            "valu": self.decode_valu,
+            "load": self.decode_load,
+            "store": self.decode_store,
+            "flow": self.decode_flow,
+        }
+        fns = []
+        for name, slots in instr.items():
+            if name == "debug":
+                continue
+            if name not in SLOT_LIMITS or len(slots) > SLOT_LIMITS[name]:
+                return None
+            for slot in slots:
+                fn = decoders[name](*slot)
+                if fn is None:
+                    return None
+                fns.append(fn)
+            if name == "valu" and slots:
+                start = len(fns) - len(slots)
+                fns[start:] = self.fuse_valu(slots, fns[start:])
+        return fns
+
+    def fuse_valu(self, slots, fns: list[DecodedSlot]) -> list[DecodedSlot]:
+        """Hook for backends that can run several valu slots as one op"""
+        return fns
+
+    def decode_alu(self, op, dest, a1, a2):
+        if op not in ALU_OPS:
+            return None
+        f = ALU_OPS[op]
+
+        def alu(core, mem, sw, mw):
+            s = core.scratch
+            sw[dest] = f(s[a1], s[a2]) % (2**32)
+
+        return alu
+
+    def decode_valu(self, *slot):
+        match slot:
+            case ("vbroadcast", dest, src):
+
+                def vbroadcast(core, mem, sw, mw):
+                    val = core.scratch[src]
+                    for i in range(dest, dest + VLEN):
+                        sw[i] = val
+
+                return vbroadcast
+            case (op, dest, a1, a2):
+                if op not in ALU_OPS:
+                    return None
+                f = ALU_OPS[op]
+
+                def valu(core, mem, sw, mw):
+                    s = core.scratch
+                    for i in range(VLEN):
+                        sw[dest + i] = f(s[a1 + i], s[a2 + i]) % (2**32)
+
+                return valu
+        return None
+
+    def decode_load(self, *slot):
+        match slot:
+            case ("load", dest, addr):
+
+                def load(core, mem, sw, mw):
+                    sw[dest] = mem[core.scratch[addr]]
+
+                return load
+            case ("load_offset", dest, addr, offset):
+                dest, addr = dest + offset, addr + offset
+
+                def load_offset(core, mem, sw, mw):
+                    sw[dest] = mem[core.scratch[addr]]
+
+                return load_offset
+            case ("vload", dest, addr):
+
+                def vload(core, mem, sw, mw):
+                    a = core.scratch[addr]
+                    for vi in range(VLEN):
+                        sw[dest + vi] = mem[a + vi]
+
+                return vload
+            case ("const", dest, val):
+
+                def const(core, mem, sw, mw):
+                    sw[dest] = val
+
+                return const
+        return None
+
+    def decode_store(self, *slot):
+        match slot:
+            case ("store", addr, src):
+
+                def store(core, mem, sw, mw):
+                    mw[core.scratch[addr]] = core.scratch[src]
+
+                return store
+            case ("vstore", addr, src):
+
+                def vstore(core, mem, sw, mw):
+                    s = core.scratch
+                    a = s[addr]
+                    for vi in range(VLEN):
+                        mw[a + vi] = s[src + vi]
+
+                return vstore
+        return None
+
+    def decode_flow(self, *slot):
+        match slot:
+            case ("select", dest, cond, a, b):
+
+                def select(core, mem, sw, mw):
+                    s = core.scratch
+                    sw[dest] = s[a] if s[cond] != 0 else s[b]
+
+                return select
+            case ("vselect", dest, cond, a, b):
+
+                def vselect(core, mem, sw, mw):
+                    s = core.scratch
+                    for vi in range(VLEN):
+                        sw[dest + vi] = s[a + vi] if s[cond + vi] != 0 else s[b + vi]
+
+                return vselect
+            case ("halt",):
+
+                def halt(core, mem, sw, mw):
+                    core.state = CoreState.STOPPED
+
+                return halt
+            case ("pause",):
+
+                def pause(core, mem, sw, mw):
+                    if self.enable_pause:
+                        core.state = CoreState.PAUSED
+
+                return pause
+            case ("trace_write", val):
+
+                def trace_write(core, mem, sw, mw):
+                    core.trace_buf.append(core.scratch[val])
+
+                return trace_write
+            case ("cond_jump", cond, addr):
+
+                def cond_jump(core, mem, sw, mw):
+                    if core.scratch[cond] != 0:
+                        core.pc = addr
+
+                return cond_jump
+            case ("cond_jump_rel", cond, offset):
+
+                def cond_jump_rel(core, mem, sw, mw):
+                    if core.scratch[cond] != 0:
+                        core.pc += offset
+
+                return cond_jump_rel
+            case ("jump", addr):
+
+                def jump(core, mem, sw, mw):
+                    core.pc = addr
+
+                return jump
+            case ("jump_indirect", addr):
+
+                def jump_indirect(core, mem, sw, mw):
+                    core.pc = core.scratch[addr]
+
+                return jump_indirect
+            case ("coreid", dest):
+
+                def coreid(core, mem, sw, mw):
+                    sw[dest] = core.id
+
+                return coreid
+        return None
+
     def run(self):
+        if self.decoded_program is not self.program:
+            self.decode()
         for core in self.cores:
             if core.state == CoreState.PAUSED:
                 core.state = CoreState.RUNNING
+        if self.parallel and len(self.cores) > 1 and not self.trace and not self.prints:
+            self.run_parallel()
+        else:
+            self.run_lockstep()
+
+    def run_lockstep(self):
         while any(c.state == CoreState.RUNNING for c in self.cores):
-            for core in self.cores:
-                if core.state != CoreState.RUNNING:
-                    continue
-                if core.pc >= len(self.program):
-                    core.state = CoreState.STOPPED
-                    continue
-                instr = self.program[core.pc]
-                if self.prints:
-                    self.print_step(instr, core)
-                core.pc += 1
+            self.lockstep_cycle()
+
+    def lockstep_cycle(self):
+        """One cycle: the next bundle on each running core, in core order"""
+        for core in self.cores:
+            if core.state != CoreState.RUNNING:
+                continue
+            if core.pc >= len(self.program):
+                core.state = CoreState.STOPPED
+                continue
+            instr = self.program[core.pc]
+            if self.prints:
+                self.print_step(instr, core)
+            fns = self.decoded[core.pc]
+            pc = core.pc
+            self.pc_counts[pc] += 1
+            core.pc += 1
+            if fns is None or not self.predecode:
                 self.step(instr, core)
-            self.cycle += 1
+                continue
+            if self.trace is not None:
+                self.trace_bundle(instr, core, pc)
+            self.step_decoded(fns, core)
+            if self.trace:
+                self.trace_post_step(instr, core)
+        self.cycle += 1
+
+    def shared_mem(self, shared):
+        """Hook for backends that want a different view of the shared memory"""
+        return shared
+
+    def run_parallel(self):
+        """
+        Run each core in a worker process until it pauses or stops, with main
+        memory copied into a shared array they all read and write. Cores
+        only see each other's writes in whatever order the processes happen
+        to run, so this matches run_lockstep() only if no core reads or
+        writes an address another core writes.
+
+        Unless mem_disjoint is set the workers record every address each
+        core touches, and if two cores did interact the parallel results are
+        thrown away and the run is redone in lockstep. Either way the cycle
+        count is the lockstep one, the longest any core ran.
+        """
+        if self.pool is None or self.pool_program is not self.program:
+            self.close_parallel()
+            workers = len(self.cores) if self.parallel is True else self.parallel
+            self.shared = multiprocessing.RawArray("I", len(self.mem))
+            self.pool = ProcessPoolExecutor(
+                min(workers, os.cpu_count() or 1),
+                initializer=_init_core_worker,
+                initargs=(
+                    type(self),
+                    self.program,
+                    self.debug_info,
+                    len(self.cores[0].scratch),
+                    self.shared,
+                ),
+            )
+            self.pool_program = self.program
+        record = not self.mem_disjoint
+        running = [c for c in self.cores if c.state == CoreState.RUNNING]
+        self.shared_mem(self.shared)[:] = self.mem
+        futures = [
+            self.pool.submit(_run_core, core, self.enable_pause, self.predecode, record)
+            for core in running
+        ]
+        results = [f.result() for f in futures]
+        if record:
+            for i, (_, _, _, _, writes) in enumerate(results):
+                for j, (_, _, _, reads, other_writes) in enumerate(results):
+                    if i != j and not writes.isdisjoint(reads | other_writes):
+                        self.lockstep_fallbacks += 1
+                        self.run_lockstep()
+                        return
+        self.mem[:] = self.shared_mem(self.shared)[:]
+        for core, (done, steps, pc_counts, _, _) in zip(running, results):
+            vars(core).update(vars(done))
+            for pc, count in enumerate(pc_counts):
+                self.pc_counts[pc] += count
+        self.cycle += max((steps for _, steps, _, _, _ in results), default=0)
+
+    def close_parallel(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def snapshot(self) -> bytes:
+        """The machine's state as a blob that restore() can go back to"""
+        cores = [
+            Core(
+                id=core.id,
+                scratch=core.scratch,
+                trace_buf=core.trace_buf,
+                pc=core.pc,
+                state=core.state,
+            )
+            for core in self.cores
+        ]
+        return MachineSnapshot(self.cycle, self.mem, self.pc_counts, cores).to_bytes()
+
+    def restore(self, blob: bytes | MachineSnapshot):
+        """
+        Go back to the state in a snapshot() of a machine with the same
+        program and memory and scratch sizes
+        """
+        snap = blob
+        if not isinstance(snap, MachineSnapshot):
+            snap = MachineSnapshot.from_bytes(blob)
+        if self.decoded_program is not self.program:
+            self.decode()
+        assert len(snap.mem) == len(self.mem), "Snapshot has a different memory size"
+        assert len(snap.pc_counts) == len(self.program), "Snapshot of another program"
+        assert len(snap.cores) == len(self.cores), "Snapshot has a different core count"
+        self.cycle = snap.cycle
+        self.mem[:] = snap.mem
+        self.pc_counts[:] = snap.pc_counts
+        for core, saved in zip(self.cores, snap.cores):
+            assert len(saved.scratch) == len(core.scratch)
+            core.scratch[:] = saved.scratch
+            core.trace_buf[:] = saved.trace_buf
+            core.pc = saved.pc
+            core.state = saved.state
+
+    def stats(self) -> MachineStats:
+        occupancy = {name: [0] * (limit + 1) for name, limit in SLOT_LIMITS.items()}
+        saturated = dict.fromkeys(SLOT_LIMITS, 0)
+        words = {"load": 0, "store": 0}
+        for instr, count in zip(self.program, self.pc_counts):
+            if count == 0:
+                continue
+            for name in SLOT_LIMITS:
+                slots = instr.get(name, [])
+                occupancy[name][min(len(slots), SLOT_LIMITS[name])] += count
+                if len(slots) >= SLOT_LIMITS[name]:
+                    saturated[name] += count
+                if name in words:
+                    words[name] += count * sum(slot_words(slot) for slot in slots)
+        return MachineStats(
+            cycles=self.cycle,
+            bundles=sum(self.pc_counts),
+            pc_counts=list(self.pc_counts),
+            occupancy=occupancy,
+            saturated=saturated,
+            words_loaded=words["load"],
+            words_stored=words["store"],
+        )
+
+    def step_decoded(self, fns: list[DecodedSlot], core):
+        """
+        Execute a pre-decoded bundle, with the same end-of-cycle write
+        semantics as step()
+        """
+        mem = self.mem
+        scratch_write = {}
+        mem_write = {}
+        for fn in fns:
+            fn(core, mem, scratch_write, mem_write)
+        scratch = core.scratch
+        for addr, val in scratch_write.items():
+            scratch[addr] = val
+        for addr, val in mem_write.items():
+            mem[addr] = val
 
     def alu(self, core, op, dest, a1, a2):
         a1 = core.scratch[a1]
@@ -280,15 +966,29 @@ class Machine:
         # This method is here so my solution file can override it with my extra tracing ;)
         pass
 
-    def trace_slot(self, core, slot, name, i):
-        self.trace.write(
-            f'{{"name": "{slot[0]}", "cat": "op", "ph": "X", "pid": {core.id}, "tid": {self.tids[(core.id, name, i)]}, "ts": {self.cycle}, "dur": 1, "args":{{"slot": "{str(slot)}" }} }},\n'
-        )
+    def trace_slot(self, core, slot, name, i, pc=None):
+        pc = core.pc - 1 if pc is None else pc
+        lane = TRACE_LANES.index((name, i))
+        self.trace.add(self.cycle, core.id, lane, pc, self.trace.slot_id(slot))
+
+    def trace_bundle(self, instr: Instruction, core, pc: int):
+        """Trace every slot of a bundle, with its lanes looked up once per pc"""
+        lanes = self.trace_lanes.get(pc)
+        if lanes is None:
+            lanes = [
+                (TRACE_LANES.index((name, i)), self.trace.slot_id(slot))
+                for name, slots in instr.items()
+                if name != "debug"
+                for i, slot in enumerate(slots)
+            ]
+            self.trace_lanes[pc] = lanes
+        self.trace.add_bundle(self.cycle, core.id, pc, lanes)
 
     def step(self, instr: Instruction, core):
         """
         Execute all the slots in each engine for a single instruction bundle
         """
+        pc = core.pc - 1
         ENGINE_FNS = {
             "alu": self.alu,
             "valu": self.valu,
@@ -304,7 +1004,7 @@ class Machine:
             assert len(slots) <= SLOT_LIMITS[name]
             for i, slot in enumerate(slots):
                 if self.trace is not None:
-                    self.trace_slot(core, slot, name, i)
+                    self.trace_slot(core, slot, name, i, pc)
                 ENGINE_FNS[name](core, *slot)
         for addr, val in self.scratch_write.items():
             core.scratch[addr] = val
@@ -318,9 +1018,826 @@ class Machine:
         del self.mem_write
 
     def __del__(self):
+        if hasattr(self, "trace"):
+            self.close_trace()
+        if getattr(self, "pool", None) is not None:
+            self.close_parallel()
+
+
+def _np_check_divisor(b):
+    if not b.all():
+        raise ZeroDivisionError("integer division or modulo by zero")
+
+
+def _np_div(a, b):
+    _np_check_divisor(b)
+    return a // b
+
+
+def _np_cdiv(a, b):
+    _np_check_divisor(b)
+    return ((a.astype(np.uint64) + b - 1) // b).astype(np.uint32)
+
+
+def _np_mod(a, b):
+    _np_check_divisor(b)
+    return a % b
+
+
+# Vector versions of ALU_OPS on uint32 arrays. Shifts by 32 or more give 0,
+# like the Python ints do once they're wrapped.
+NP_VALU_OPS = {
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "//": _np_div,
+    "cdiv": _np_cdiv,
+    "^": lambda a, b: a ^ b,
+    "&": lambda a, b: a & b,
+    "|": lambda a, b: a | b,
+    "<<": lambda a, b: np.where(b < 32, a << (b & 31), 0).astype(np.uint32),
+    ">>": lambda a, b: np.where(b < 32, a >> (b & 31), 0).astype(np.uint32),
+    "%": _np_mod,
+    "<": lambda a, b: (a < b).astype(np.uint32),
+    "==": lambda a, b: (a == b).astype(np.uint32),
+}
+
+
+class NumpyMachine(Machine):
+    """
+    Machine backend that keeps each core's scratch and the shared memory in
+    uint32 numpy arrays, so every vector slot is a single sliced array op
+    instead of VLEN scalar ALU calls.
+
+    Write buffers are lists of (index, value) pairs committed in execution
+    order, where index is an address or a slice for vector writes. That's
+    the same "last write in the bundle wins, and nothing lands before the end
+    of the cycle" behaviour as the dicts in Machine.step.
+    """
+
+    def __init__(
+        self,
+        mem_dump: list[int],
+        program: list[Instruction],
+        debug_info: DebugInfo,
+        n_cores: int = 1,
+        scratch_size: int = SCRATCH_SIZE,
+        trace: bool | str = False,
+    ):
+        assert np is not None, "NumpyMachine needs numpy installed"
+        super().__init__(mem_dump, program, debug_info, n_cores, scratch_size, trace)
+        self.mem = np.array(self.mem, dtype=np.uint32)
+        for core in self.cores:
+            core.scratch = np.zeros(scratch_size, dtype=np.uint32)
+
+    def shared_mem(self, shared):
+        return np.frombuffer(shared, dtype=np.uint32)
+
+    def step(self, instr: Instruction, core):
+        fns = self.decode_instr(instr)
+        assert fns is not None, f"Can't execute {instr} on the numpy backend"
         if self.trace is not None:
-            self.trace.write("]")
-            self.trace.close()
+            self.trace_bundle(instr, core, core.pc - 1)
+        self.step_decoded(fns, core)
+        if self.trace:
+            self.trace_post_step(instr, core)
+
+    def step_decoded(self, fns: list[DecodedSlot], core):
+        mem = self.mem
+        scratch_write = []
+        mem_write = []
+        for fn in fns:
+            fn(core, mem, scratch_write, mem_write)
+        scratch = core.scratch
+        for index, val in scratch_write:
+            scratch[index] = val
+        for index, val in mem_write:
+            mem[index] = val
+
+    def fuse_valu(self, slots, fns: list[DecodedSlot]) -> list[DecodedSlot]:
+        """
+        Merge the valu slots of a bundle that share an op into one gather /
+        compute / scatter over index arrays. Only done when no two slots
+        write the same address, since then the order of writes can't matter.
+        """
+        dests = [slot[1] + i for slot in slots for i in range(VLEN)]
+        if len(slots) < 2 or len(set(dests)) != len(dests):
+            return fns
+        groups = {}
+        for slot in slots:
+            groups.setdefault(slot[0], []).append(slot)
+        return [self.decode_valu_group(op, group) for op, group in groups.items()]
+
+    def decode_valu_group(self, op, group) -> DecodedSlot:
+        def lanes(k):
+            return np.array(
+                [slot[k] + i for slot in group for i in range(VLEN)], dtype=np.intp
+            )
+
+        out = lanes(1)
+        if op == "vbroadcast":
+            src = np.repeat(np.array([slot[2] for slot in group], dtype=np.intp), VLEN)
+
+            def vbroadcast(core, mem, sw, mw):
+                sw.append((out, core.scratch[src]))
+
+            return vbroadcast
+        f = NP_VALU_OPS[op]
+        in1, in2 = lanes(2), lanes(3)
+
+        def valu(core, mem, sw, mw):
+            s = core.scratch
+            sw.append((out, f(s[in1], s[in2])))
+
+        return valu
+
+    def decode_alu(self, op, dest, a1, a2):
+        if op not in ALU_OPS:
+            return None
+        f = ALU_OPS[op]
+
+        def alu(core, mem, sw, mw):
+            s = core.scratch
+            sw.append((dest, f(s.item(a1), s.item(a2)) % (2**32)))
+
+        return alu
+
+    def decode_valu(self, *slot):
+        match slot:
+            case ("vbroadcast", dest, src):
+                out = slice(dest, dest + VLEN)
+
+                def vbroadcast(core, mem, sw, mw):
+                    sw.append((out, core.scratch[src]))
+
+                return vbroadcast
+            case (op, dest, a1, a2):
+                if op not in NP_VALU_OPS:
+                    return None
+                f = NP_VALU_OPS[op]
+                out, in1, in2 = (slice(a, a + VLEN) for a in (dest, a1, a2))
+
+                def valu(core, mem, sw, mw):
+                    s = core.scratch
+                    sw.append((out, f(s[in1], s[in2])))
+
+                return valu
+        return None
+
+    def decode_load(self, *slot):
+        match slot:
+            case ("load", dest, addr):
+
+                def load(core, mem, sw, mw):
+                    sw.append((dest, mem.item(core.scratch.item(addr))))
+
+                return load
+            case ("load_offset", dest, addr, offset):
+                dest, addr = dest + offset, addr + offset
+
+                def load_offset(core, mem, sw, mw):
+                    sw.append((dest, mem.item(core.scratch.item(addr))))
+
+                return load_offset
+            case ("vload", dest, addr):
+                out = slice(dest, dest + VLEN)
+
+                def vload(core, mem, sw, mw):
+                    a = core.scratch.item(addr)
+                    if a + VLEN > len(mem):
+                        raise IndexError("vload out of range")
+                    sw.append((out, mem[a : a + VLEN].copy()))
+
+                return vload
+            case ("const", dest, val):
+
+                def const(core, mem, sw, mw):
+                    sw.append((dest, val))
+
+                return const
+        return None
+
+    def decode_store(self, *slot):
+        match slot:
+            case ("store", addr, src):
+
+                def store(core, mem, sw, mw):
+                    s = core.scratch
+                    mw.append((s.item(addr), s.item(src)))
+
+                return store
+            case ("vstore", addr, src):
+                vals = slice(src, src + VLEN)
+
+                def vstore(core, mem, sw, mw):
+                    s = core.scratch
+                    a = s.item(addr)
+                    if a + VLEN > len(mem):
+                        raise IndexError("vstore out of range")
+                    mw.append((slice(a, a + VLEN), s[vals].copy()))
+
+                return vstore
+        return None
+
+    def decode_flow(self, *slot):
+        match slot:
+            case ("select", dest, cond, a, b):
+
+                def select(core, mem, sw, mw):
+                    s = core.scratch
+                    sw.append((dest, s.item(a) if s.item(cond) != 0 else s.item(b)))
+
+                return select
+            case ("vselect", dest, cond, a, b):
+                out, c, x, y = (slice(v, v + VLEN) for v in (dest, cond, a, b))
+
+                def vselect(core, mem, sw, mw):
+                    s = core.scratch
+                    sw.append((out, np.where(s[c] != 0, s[x], s[y])))
+
+                return vselect
+            case ("trace_write", val):
+
+                def trace_write(core, mem, sw, mw):
+                    core.trace_buf.append(core.scratch.item(val))
+
+                return trace_write
+            case ("cond_jump", cond, addr):
+
+                def cond_jump(core, mem, sw, mw):
+                    if core.scratch.item(cond) != 0:
+                        core.pc = addr
+
+                return cond_jump
+            case ("cond_jump_rel", cond, offset):
+
+                def cond_jump_rel(core, mem, sw, mw):
+                    if core.scratch.item(cond) != 0:
+                        core.pc += offset
+
+                return cond_jump_rel
+            case ("jump_indirect", addr):
+
+                def jump_indirect(core, mem, sw, mw):
+                    core.pc = core.scratch.item(addr)
+
+                return jump_indirect
+            case ("coreid", dest):
+
+                def coreid(core, mem, sw, mw):
+                    sw.append((dest, core.id))
+
+                return coreid
+        # halt, pause and jump don't touch scratch
+        return super().decode_flow(*slot)
+
+
+@dataclass
+class BatchCore:
+    """One core of every image in a BatchMachine, with arrays over images"""
+
+    id: int
+    # (images, scratch_size) uint32
+    scratch: "np.ndarray"
+    trace_buf: list[list[int]]
+    pc: "np.ndarray"
+    # CoreState values
+    state: "np.ndarray"
+
+
+class BatchGroup:
+    """The images of a core that run the same bundle in a cycle"""
+
+    def __init__(self, core: BatchCore, rows):
+        self.core = core
+        self.rows = rows
+        # For indexing with an array of scratch or memory addresses per image
+        self.rows2 = rows[:, None]
+
+
+class BatchMachine(NumpyMachine):
+    """
+    Runs one program over several memory images at once, like the same
+    kernel on many random inputs, without a Machine and a decoded program
+    per image. Main memory is an (images, words) uint32 array and each
+    core's scratch an (images, scratch_size) one, so a slot is one numpy op
+    over every image. Decoded slots take a BatchGroup in place of a core.
+
+    Each core has a pc and state per image. Images whose pcs agree run each
+    bundle together, and when control flow diverges they're split into
+    groups by pc until they meet again. cycles[i] is the cycle count image i
+    would have had on a Machine of its own, and cycle is the largest.
+
+    Tracing, prints, parallel runs and snapshots aren't supported, and an
+    error in any image stops them all.
+    """
+
+    def __init__(
+        self,
+        mem_dumps: list[list[int]],
+        program: list[Instruction],
+        debug_info: DebugInfo,
+        n_cores: int = 1,
+        scratch_size: int = SCRATCH_SIZE,
+    ):
+        assert np is not None, "BatchMachine needs numpy installed"
+        assert len({len(m) for m in mem_dumps}) == 1, "Images differ in size"
+        Machine.__init__(self, [], program, debug_info, n_cores, scratch_size)
+        n = len(mem_dumps)
+        self.mem = np.array(mem_dumps, dtype=np.uint32)
+        self.cores = [
+            BatchCore(
+                id=i,
+                scratch=np.zeros((n, scratch_size), dtype=np.uint32),
+                trace_buf=[[] for _ in range(n)],
+                pc=np.zeros(n, dtype=np.int64),
+                state=np.full(n, CoreState.RUNNING.value, dtype=np.int8),
+            )
+            for i in range(n_cores)
+        ]
+        self.cycles = np.zeros(n, dtype=np.int64)
+
+    def run(self):
+        if self.decoded_program is not self.program:
+            self.decode()
+        running = CoreState.RUNNING.value
+        for core in self.cores:
+            core.state[core.state == CoreState.PAUSED.value] = running
+        while True:
+            active = np.zeros(len(self.mem), dtype=bool)
+            for core in self.cores:
+                active |= core.state == running
+            if not active.any():
+                break
+            for core in self.cores:
+                rows = np.flatnonzero(core.state == running)
+                pcs = core.pc[rows]
+                ended = pcs >= len(self.program)
+                if ended.any():
+                    core.state[rows[ended]] = CoreState.STOPPED.value
+                    rows, pcs = rows[~ended], pcs[~ended]
+                if not len(rows):
+                    continue
+                if (pcs == pcs[0]).all():
+                    groups = [(int(pcs[0]), rows)]
+                else:
+                    groups = [(int(pc), rows[pcs == pc]) for pc in np.unique(pcs)]
+                for pc, group in groups:
+                    fns = self.decoded[pc]
+                    assert fns is not None, f"Can't batch {self.program[pc]}"
+                    self.pc_counts[pc] += len(group)
+                    core.pc[group] = pc + 1
+                    self.step_decoded(fns, BatchGroup(core, group))
+            self.cycles += active
+            self.cycle += 1
+
+    def step_decoded(self, fns: list[DecodedSlot], group: BatchGroup):
+        mem = self.mem
+        scratch_write = []
+        mem_write = []
+        for fn in fns:
+            fn(group, mem, scratch_write, mem_write)
+        scratch = group.core.scratch
+        for index, val in scratch_write:
+            scratch[index] = val
+        for index, val in mem_write:
+            mem[index] = val
+
+    def decode_valu_group(self, op, group) -> DecodedSlot:
+        def lanes(k):
+            return np.array([slot[k] + i for slot in group for i in range(VLEN)])
+
+        out = lanes(1)
+        if op == "vbroadcast":
+            src = np.repeat([slot[2] for slot in group], VLEN)
+
+            def vbroadcast(g, mem, sw, mw):
+                sw.append(((g.rows2, out), g.core.scratch[g.rows2, src]))
+
+            return vbroadcast
+        f = NP_VALU_OPS[op]
+        in1, in2 = lanes(2), lanes(3)
+
+        def valu(g, mem, sw, mw):
+            s = g.core.scratch
+            sw.append(((g.rows2, out), f(s[g.rows2, in1], s[g.rows2, in2])))
+
+        return valu
+
+    def decode_alu(self, op, dest, a1, a2):
+        if op not in NP_VALU_OPS:
+            return None
+        f = NP_VALU_OPS[op]
+
+        def alu(g, mem, sw, mw):
+            s = g.core.scratch
+            sw.append(((g.rows, dest), f(s[g.rows, a1], s[g.rows, a2])))
+
+        return alu
+
+    def decode_valu(self, *slot):
+        match slot:
+            case ("vbroadcast", dest, src):
+                out = slice(dest, dest + VLEN)
+
+                def vbroadcast(g, mem, sw, mw):
+                    sw.append(((g.rows, out), g.core.scratch[g.rows2, src]))
+
+                return vbroadcast
+            case (op, dest, a1, a2):
+                if op not in NP_VALU_OPS:
+                    return None
+                f = NP_VALU_OPS[op]
+                out, in1, in2 = (slice(a, a + VLEN) for a in (dest, a1, a2))
+
+                def valu(g, mem, sw, mw):
+                    s = g.core.scratch
+                    sw.append(((g.rows, out), f(s[g.rows, in1], s[g.rows, in2])))
+
+                return valu
+        return None
+
+    def decode_load(self, *slot):
+        match slot:
+            case ("load", dest, addr) | ("load_offset", dest, addr, _):
+                if slot[0] == "load_offset":
+                    dest, addr = dest + slot[3], addr + slot[3]
+
+                def load(g, mem, sw, mw):
+                    sw.append(
+                        ((g.rows, dest), mem[g.rows, g.core.scratch[g.rows, addr]])
+                    )
+
+                return load
+            case ("vload", dest, addr):
+                out = slice(dest, dest + VLEN)
+                offsets = np.arange(VLEN)
+
+                def vload(g, mem, sw, mw):
+                    a = g.core.scratch[g.rows2, addr] + offsets
+                    sw.append(((g.rows, out), mem[g.rows2, a]))
+
+                return vload
+            case ("const", dest, val):
+
+                def const(g, mem, sw, mw):
+                    sw.append(((g.rows, dest), val))
+
+                return const
+        return None
+
+    def decode_store(self, *slot):
+        match slot:
+            case ("store", addr, src):
+
+                def store(g, mem, sw, mw):
+                    s = g.core.scratch
+                    mw.append(((g.rows, s[g.rows, addr]), s[g.rows, src]))
+
+                return store
+            case ("vstore", addr, src):
+                vals = slice(src, src + VLEN)
+                offsets = np.arange(VLEN)
+
+                def vstore(g, mem, sw, mw):
+                    s = g.core.scratch
+                    a = s[g.rows2, addr] + offsets
+                    mw.append(((g.rows2, a), s[g.rows, vals]))
+
+                return vstore
+        return None
+
+    def decode_flow(self, *slot):
+        match slot:
+            case ("select", dest, cond, a, b):
+
+                def select(g, mem, sw, mw):
+                    s, r = g.core.scratch, g.rows
+                    sw.append(((r, dest), np.where(s[r, cond] != 0, s[r, a], s[r, b])))
+
+                return select
+            case ("vselect", dest, cond, a, b):
+                out, c, x, y = (slice(v, v + VLEN) for v in (dest, cond, a, b))
+
+                def vselect(g, mem, sw, mw):
+                    s, r = g.core.scratch, g.rows
+                    sw.append(((r, out), np.where(s[r, c] != 0, s[r, x], s[r, y])))
+
+                return vselect
+            case ("halt",):
+
+                def halt(g, mem, sw, mw):
+                    g.core.state[g.rows] = CoreState.STOPPED.value
+
+                return halt
+            case ("pause",):
+
+                def pause(g, mem, sw, mw):
+                    if self.enable_pause:
+                        g.core.state[g.rows] = CoreState.PAUSED.value
+
+                return pause
+            case ("trace_write", val):
+
+                def trace_write(g, mem, sw, mw):
+                    for i, v in zip(g.rows, g.core.scratch[g.rows, val].tolist()):
+                        g.core.trace_buf[i].append(v)
+
+                return trace_write
+            case ("cond_jump", cond, addr):
+
+                def cond_jump(g, mem, sw, mw):
+                    taken = g.rows[g.core.scratch[g.rows, cond] != 0]
+                    g.core.pc[taken] = addr
+
+                return cond_jump
+            case ("cond_jump_rel", cond, offset):
+
+                def cond_jump_rel(g, mem, sw, mw):
+                    taken = g.rows[g.core.scratch[g.rows, cond] != 0]
+                    g.core.pc[taken] += offset
+
+                return cond_jump_rel
+            case ("jump", addr):
+
+                def jump(g, mem, sw, mw):
+                    g.core.pc[g.rows] = addr
+
+                return jump
+            case ("jump_indirect", addr):
+
+                def jump_indirect(g, mem, sw, mw):
+                    g.core.pc[g.rows] = g.core.scratch[g.rows, addr]
+
+                return jump_indirect
+            case ("coreid", dest):
+
+                def coreid(g, mem, sw, mw):
+                    sw.append(((g.rows, dest), g.core.id))
+
+                return coreid
+        return None
+
+
+# Python source for each of ALU_OPS on two operand expressions, wrapped to
+# 32 bits the way Machine does it
+SOURCE_OPS = {
+    op: f"({{}} {op} {{}}) % 4294967296"
+    for op in ["+", "-", "*", "//", "^", "&", "|", "<<", ">>", "%"]
+} | {
+    "cdiv": "(({0} + {1} - 1) // {1}) % 4294967296",
+    "<": "int({} < {})",
+    "==": "int({} == {})",
+}
+
+# Flow ops that end a basic block
+CONTROL_OPS = {"halt", "pause", "jump", "cond_jump", "cond_jump_rel", "jump_indirect"}
+
+# Block functions by program and number of cores, see compile_blocks
+_compiled_blocks: dict[tuple[str, int], dict[int, tuple[Callable, int]]] = {}
+
+
+def block_ranges(program: list[Instruction]) -> list[tuple[int, int]]:
+    """
+    The program's basic blocks as [start, end) ranges: each ends after a
+    bundle with a control flow op or before a jump target
+    """
+    starts = {0, len(program)}
+    for pc, instr in enumerate(program):
+        for slot in instr.get("flow", []):
+            if slot[0] in CONTROL_OPS:
+                starts.add(pc + 1)
+            match slot:
+                case ("jump", target) | ("cond_jump", _, target):
+                    starts.add(target)
+                case ("cond_jump_rel", _, offset):
+                    starts.add(pc + 1 + offset)
+    starts = sorted(s for s in starts if 0 <= s <= len(program))
+    return list(zip(starts, starts[1:]))
+
+
+def block_source(
+    program: list[Instruction], start: int, end: int, n_cores: int, scratch_size: int
+) -> list[str]:
+    """
+    Lines running program[start:end] on cores c0, c1, ... with scratch s0,
+    s1, ... and main memory mem, each bundle on every core in order before
+    the next, like Machine's lockstep.
+
+    Scratch lives in locals for the whole block. A word is read from scratch
+    the first time the block needs it, a write just names the local holding
+    the new value for the bundles after it, and every written word is put
+    back once at the end. Memory reads and writes happen in place, in cycle
+    and core order. Raises ValueError for a slot it can't compile or one
+    that reaches outside scratch.
+    """
+    lines = []
+    # Per core, the local or literal holding each scratch word's value
+    values = [{} for _ in range(n_cores)]
+    n_locals = 0
+
+    def check(addr, n=1):
+        if not 0 <= addr <= scratch_size - n:
+            raise ValueError(f"Scratch address {addr} out of range")
+        return addr
+
+    for pc in range(start, end):
+        for c in range(n_cores):
+            core = values[c]
+
+            def read(addr):
+                if addr not in core:
+                    core[check(addr)] = f"r{c}_{addr}"
+                    lines.append(f"r{c}_{addr} = s{c}[{addr}]")
+                return core[addr]
+
+            def value(expr):
+                nonlocal n_locals
+                n_locals += 1
+                lines.append(f"v{n_locals} = {expr}")
+                return f"v{n_locals}"
+
+            def write(addr, val):
+                scratch_writes.append((check(addr), val))
+
+            def vwrite(addr, vals):
+                check(addr, VLEN)
+                scratch_writes.extend(zip(range(addr, addr + VLEN), vals))
+
+            scratch_writes = []
+            mem_writes = []
+            control = [f"c{c}.pc = {end}"] if pc == end - 1 else []
+            for name, slots in program[pc].items():
+                if name == "debug":
+                    continue
+                for slot in slots:
+                    match name, slot:
+                        case "alu", (op, dest, a1, a2) if op in SOURCE_OPS:
+                            expr = SOURCE_OPS[op].format(read(a1), read(a2))
+                            write(dest, value(expr))
+                        case "valu", ("vbroadcast", dest, src):
+                            vwrite(dest, [read(src)] * VLEN)
+                        case "valu", (op, dest, a1, a2) if op in SOURCE_OPS:
+                            lanes = [(read(a1 + i), read(a2 + i)) for i in range(VLEN)]
+                            vwrite(
+                                dest,
+                                [value(SOURCE_OPS[op].format(x, y)) for x, y in lanes],
+                            )
+                        case "load", ("load", dest, addr):
+                            write(dest, value(f"mem[{read(addr)}]"))
+                        case "load", ("load_offset", dest, addr, offset):
+                            write(dest + offset, value(f"mem[{read(addr + offset)}]"))
+                        case "load", ("vload", dest, addr):
+                            a = read(addr)
+                            vwrite(
+                                dest, [value(f"mem[{a} + {i}]") for i in range(VLEN)]
+                            )
+                        case "load", ("const", dest, val):
+                            write(dest, repr(val))
+                        case "store", ("store", addr, src):
+                            mem_writes.append(f"mem[{read(addr)}] = {read(src)}")
+                        case "store", ("vstore", addr, src):
+                            a = read(addr)
+                            for i in range(VLEN):
+                                mem_writes.append(f"mem[{a} + {i}] = {read(src + i)}")
+                        case "flow", ("select", dest, cond, a, b):
+                            expr = f"{read(a)} if {read(cond)} != 0 else {read(b)}"
+                            write(dest, value(expr))
+                        case "flow", ("vselect", dest, cond, a, b):
+                            lanes = [
+                                (read(cond + i), read(a + i), read(b + i))
+                                for i in range(VLEN)
+                            ]
+                            vwrite(
+                                dest,
+                                [
+                                    value(f"{x} if {k} != 0 else {y}")
+                                    for k, x, y in lanes
+                                ],
+                            )
+                        case "flow", ("coreid", dest):
+                            write(dest, value(f"c{c}.id"))
+                        case "flow", ("trace_write", val):
+                            lines.append(f"c{c}.trace_buf.append({read(val)})")
+                        case "flow", ("halt",):
+                            control.append(f"c{c}.state = STOPPED")
+                        case "flow", ("pause",):
+                            control.append(
+                                f"if machine.enable_pause: c{c}.state = PAUSED"
+                            )
+                        case "flow", ("jump", target):
+                            control.append(f"c{c}.pc = {target}")
+                        case "flow", ("cond_jump", cond, target):
+                            control.append(f"if {read(cond)} != 0: c{c}.pc = {target}")
+                        case "flow", ("cond_jump_rel", cond, offset):
+                            control.append(
+                                f"if {read(cond)} != 0: c{c}.pc = {end + offset}"
+                            )
+                        case "flow", ("jump_indirect", addr):
+                            control.append(f"c{c}.pc = {read(addr)}")
+                        case _:
+                            raise ValueError(f"Can't compile {name} slot {slot}")
+            # The end of the cycle: the last write to each scratch word wins
+            core.update(scratch_writes)
+            lines.extend(mem_writes + control)
+    for c, core in enumerate(values):
+        written = sorted(a for a, v in core.items() if v != f"r{c}_{a}")
+        # Put back runs of consecutive words with one slice assignment
+        while written:
+            n = 1
+            while n < len(written) and written[n] == written[0] + n:
+                n += 1
+            run, written = written[:n], written[n:]
+            vals = ", ".join(core[a] for a in run)
+            lines.append(f"s{c}[{run[0]}:{run[-1] + 1}] = [{vals}]")
+    return lines
+
+
+def compile_blocks(
+    program: list[Instruction], decoded: list, n_cores: int, scratch_size: int
+) -> dict[int, tuple[Callable, int]]:
+    """
+    A function per basic block of the program, with the pc after it, by the
+    block's start. block(machine, cores, mem, pc_counts) runs the block on
+    n_cores cores that are all at its start, see block_source. Blocks with a
+    bundle that doesn't decode or reaches outside scratch are left out, for
+    Machine to run. Cached by the program's hash.
+    """
+    key = hashlib.sha256(repr((program, scratch_size)).encode()).hexdigest()
+    if (key, n_cores) in _compiled_blocks:
+        return _compiled_blocks[key, n_cores]
+    lines = []
+    ranges = []
+    for start, end in block_ranges(program):
+        if any(fns is None for fns in decoded[start:end]):
+            continue
+        try:
+            body = block_source(program, start, end, n_cores, scratch_size)
+        except ValueError:
+            continue
+        cores = ", ".join(f"c{c}" for c in range(n_cores))
+        lines.append(f"def block_{start}(machine, cores, mem, pc_counts):")
+        lines.append(f"    {cores}, = cores")
+        lines.extend(f"    s{c} = c{c}.scratch" for c in range(n_cores))
+        lines.extend(f"    {line}" for line in body)
+        lines.extend(f"    pc_counts[{pc}] += {n_cores}" for pc in range(start, end))
+        ranges.append((start, end))
+    namespace = {"STOPPED": CoreState.STOPPED, "PAUSED": CoreState.PAUSED}
+    name = f"<compiled program {key[:12]} on {n_cores} cores>"
+    exec(compile("\n".join(lines), name, "exec"), namespace)
+    blocks = {start: (namespace[f"block_{start}"], end) for start, end in ranges}
+    _compiled_blocks[key, n_cores] = blocks
+    return blocks
+
+
+class CompiledMachine(Machine):
+    """
+    Machine backend that compiles each basic block of the program to Python
+    source once (see compile_blocks), so a block runs as one call of
+    straight-line code with scratch in locals, instead of a call per slot.
+
+    While every running core is at the start of the same compiled block,
+    the whole block runs at once. Otherwise, e.g. after the cores' control
+    flow diverges, cycles run on Machine's decoded path until they meet at
+    a block again. Tracing, prints and predecode = False run entirely on
+    Machine's path. A block that raises, say on a bad memory address,
+    leaves scratch as it was when the block started.
+    """
+
+    def decode(self):
+        super().decode()
+        # Compiled blocks by how many cores run them, made as they're needed
+        self.blocks = {}
+
+    def run_lockstep(self):
+        if self.prints or self.trace is not None or not self.predecode:
+            return super().run_lockstep()
+        mem = self.mem.own() if isinstance(self.mem, MemImage) else self.mem
+        pc_counts = self.pc_counts
+        while True:
+            running = [c for c in self.cores if c.state == CoreState.RUNNING]
+            if not running:
+                break
+            pc = running[0].pc
+            if len(running) not in self.blocks:
+                self.blocks[len(running)] = compile_blocks(
+                    self.program, self.decoded, len(running), len(running[0].scratch)
+                )
+            block = self.blocks[len(running)].get(pc)
+            if block is None or any(c.pc != pc for c in running):
+                self.lockstep_cycle()
+                continue
+            fn, end = block
+            fn(self, running, mem, pc_counts)
+            self.cycle += end - pc
+
+
+# Simulator backends by name, all with the Machine constructor and API
+BACKENDS = {
+    "python": Machine,
+    "numpy": NumpyMachine,
+    "compiled": CompiledMachine,
+}
 
 
 @dataclass
@@ -405,19 +1922,99 @@ def reference_kernel(t: Tree, inp: Input):
             inp.indices[i] = idx
 
 
-def build_mem_image(t: Tree, inp: Input) -> list[int]:
+class MemImage:
+    """
+    A memory image of 32-bit words kept in an array("I") rather than a list
+    of Python ints, indexed like the list: words, slices as lists, slice
+    assignment and len. copy() shares the words copy-on-write, so a Machine
+    and the reference kernel can start from one image and only pay for a
+    copy of it once they write. save() writes the raw words to a file and
+    load() maps them back in with mmap, read-only until the first write.
+    """
+
+    __slots__ = ("words", "shared")
+
+    def __init__(self, words=(), shared: bool = False):
+        if isinstance(words, (array, memoryview)):
+            self.words = words
+        else:
+            self.words = array("I", words)
+        # Set when another image, or a read-only mapping, has the same words
+        self.shared = shared or isinstance(words, memoryview)
+
+    @classmethod
+    def zeros(cls, n: int) -> "MemImage":
+        return cls(array("I", bytes(4 * n)))
+
+    def own(self) -> array:
+        """The words, copied first if they're shared"""
+        if self.shared:
+            words = array("I")
+            words.frombytes(memoryview(self.words).cast("B"))
+            self.words = words
+            self.shared = False
+        return self.words
+
+    def __copy__(self) -> "MemImage":
+        self.shared = True
+        return MemImage(self.words, shared=True)
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.words[index].tolist()
+        return self.words[index]
+
+    def __setitem__(self, index, val):
+        words = self.own()
+        if isinstance(index, slice) and not isinstance(val, array):
+            val = array("I", val)
+        words[index] = val
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, MemImage):
+            return self.words.tobytes() == other.words.tobytes()
+        if isinstance(other, list):
+            return self.tolist() == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"MemImage({self.tolist()})"
+
+    def __array__(self, dtype=None, copy=None):
+        return np.frombuffer(self.words, dtype=np.uint32)
+
+    def tolist(self) -> list[int]:
+        return self.words.tolist()
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.words)
+
+    @classmethod
+    def load(cls, path: str) -> "MemImage":
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(memoryview(mapped).cast("I"))
+
+
+def build_mem_image(t: Tree, inp: Input) -> MemImage:
     """
     Build a flat memory image of the problem.
     """
     header = 7
-    extra_room = len(t.values) + len(inp.indices) * 2 + VLEN * 2 + 32
-    mem = [0] * (
-        header + len(t.values) + len(inp.indices) + len(inp.values) + extra_room
-    )
     forest_values_p = header
     inp_indices_p = forest_values_p + len(t.values)
     inp_values_p = inp_indices_p + len(inp.values)
     extra_room = inp_values_p + len(inp.values)
+    mem = MemImage.zeros(inp_values_p + len(inp.values))
 
     mem[0] = inp.rounds
     mem[1] = len(t.values)
@@ -460,3 +2057,40 @@ def reference_kernel2(mem: list[int]):
             mem[inp_indices_p + i] = idx
         # use a python generator so it's possible to inspect every step
         yield mem
+
+
+def myhash_np(a):
+    """myhash of every element of a uint32 array"""
+    fns = {
+        "+": operator.add,
+        "^": operator.xor,
+        "<<": operator.lshift,
+        ">>": operator.rshift,
+    }
+    a = np.asarray(a, dtype=np.uint32)
+    for op1, val1, op2, op3, val3 in HASH_STAGES:
+        a = fns[op2](fns[op1](a, np.uint32(val1)), fns[op3](a, np.uint32(val3)))
+    return a
+
+
+def reference_kernel_np(mem: list[int]):
+    """
+    reference_kernel2 doing each round for the whole batch at once with
+    numpy. Yields the memory as a uint32 array updated in place, and leaves
+    mem itself alone.
+    """
+    mem = np.array(mem, dtype=np.uint32)
+    rounds, n_nodes, batch_size = (int(x) for x in mem[:3])
+    forest_values_p, inp_indices_p, inp_values_p = (int(x) for x in mem[4:7])
+    forest = mem[forest_values_p : forest_values_p + n_nodes]
+    indices = mem[inp_indices_p : inp_indices_p + batch_size]
+    values = mem[inp_values_p : inp_values_p + batch_size]
+    yield mem
+    for h in range(rounds):
+        values[:] = myhash_np(values ^ forest[indices])
+        idx = 2 * indices + 1 + (values & 1)
+        indices[:] = np.where(idx >= n_nodes, 0, idx)
+        yield mem
+
+
+REFERENCE_KERNELS = {"python": reference_kernel2, "numpy": reference_kernel_np}
@@ -0,0 +1,261 @@
+"""
+Find the first round where the kernel's memory stops matching the reference
+kernel, and say where by name.
+
+    python snapshot_diff.py --forest-height 10 --rounds 16 --batch-size 1024
+    python snapshot_diff.py --save-dir snaps      # keep a snapshot of every round
+    python snapshot_diff.py --save-dir snaps --start-round 13 --trace
+    python snapshot_diff.py --compare snaps/round13.snap other/round13.snap
+
+The kernel runs a round (pause to pause) at a time against the reference's
+yields, with the machine snapshotted before each round. At the first round
+whose memory differs, the first differing address is reported by its place
+in the memory layout, along with the scratch registers (named from
+DebugInfo.scratch_map) that hold the wrong value. With --save-dir the
+snapshots are written to disk, and --start-round restores one of them so only
+the rounds from there on are simulated again, e.g. with --trace or --prints.
+--compare lists the differences between two snapshots of the same kernel,
+e.g. from before and after a change that broke it.
+"""
+
+import argparse
+import os
+import random
+from bisect import bisect_right
+
+from perf_takehome import KernelBuilder
+from problem import (
+    BACKENDS,
+    N_CORES,
+    REFERENCE_KERNELS,
+    DebugInfo,
+    Input,
+    MachineSnapshot,
+    Tree,
+    build_mem_image,
+)
+
+# Names of the words at the start of memory, see build_mem_image
+HEADER = [
+    "rounds",
+    "n_nodes",
+    "batch_size",
+    "forest_height",
+    "forest_values_p",
+    "inp_indices_p",
+    "inp_values_p",
+]
+
+
+def mem_name(mem: list[int], addr: int) -> str:
+    """Name of a main memory address, given the memory's header"""
+    if addr < len(HEADER):
+        return HEADER[addr]
+    for name, start in [("inp_values", mem[6]), ("inp_indices", mem[5])]:
+        if addr >= start:
+            return f"{name}[{addr - start}]"
+    return f"forest_values[{addr - mem[4]}]"
+
+
+def scratch_name(scratch_map: dict[int, tuple[str, int]], addr: int) -> str:
+    """Name of a scratch address, with the lane for vectors"""
+    bases = sorted(scratch_map)
+    i = bisect_right(bases, addr) - 1
+    if i >= 0:
+        name, length = scratch_map[bases[i]]
+        if addr < bases[i] + length:
+            return name if length == 1 else f"{name}[{addr - bases[i]}]"
+    return f"scratch[{addr}]"
+
+
+def diff_addrs(actual: list[int], expected: list[int], addrs=None) -> list[int]:
+    """Addresses (all of them, or those in addrs) where the two memories differ"""
+    addrs = range(min(len(actual), len(expected))) if addrs is None else addrs
+    return [a for a in addrs if actual[a] != expected[a]]
+
+
+def diff_snapshots(
+    a: MachineSnapshot, b: MachineSnapshot, debug_info: DebugInfo, limit: int = 10
+) -> list[str]:
+    """
+    Differences between two snapshots of the same program: cycle, memory,
+    and each core's pc, state and scratch, up to limit per part
+    """
+    lines = []
+    if a.cycle != b.cycle:
+        lines.append(f"cycle: {a.cycle} != {b.cycle}")
+    for addr in diff_addrs(a.mem, b.mem)[:limit]:
+        lines.append(f"{mem_name(a.mem, addr)}: {a.mem[addr]} != {b.mem[addr]}")
+    for core_a, core_b in zip(a.cores, b.cores):
+        if (core_a.pc, core_a.state) != (core_b.pc, core_b.state):
+            lines.append(
+                f"core {core_a.id}: pc {core_a.pc} {core_a.state.name} != "
+                f"pc {core_b.pc} {core_b.state.name}"
+            )
+        for addr in diff_addrs(core_a.scratch, core_b.scratch)[:limit]:
+            name = scratch_name(debug_info.scratch_map, addr)
+            lines.append(
+                f"core {core_a.id} {name}: "
+                f"{core_a.scratch[addr]} != {core_b.scratch[addr]}"
+            )
+    return lines
+
+
+def describe_divergence(
+    snap: MachineSnapshot,
+    expected: list[int],
+    debug_info: DebugInfo,
+    addrs: list[int],
+) -> list[str]:
+    """
+    Explain where a snapshot's memory differs from the reference's, given
+    the differing addresses
+    """
+    addr = addrs[0]
+    actual = snap.mem[addr]
+    lines = [
+        f"{len(addrs)} addresses differ, first {mem_name(expected, addr)} "
+        f"(mem[{addr}]) is {actual} but the reference has {expected[addr]}"
+    ]
+    for core in snap.cores:
+        holders = [
+            scratch_name(debug_info.scratch_map, i)
+            for i, val in enumerate(core.scratch)
+            if val == actual
+        ]
+        where = ", ".join(holders[:8]) + (", ..." if len(holders) > 8 else "")
+        lines.append(
+            f"core {core.id}: pc {core.pc} {core.state.name}"
+            + (f", {actual} is in {where}" if holders else "")
+        )
+    return lines
+
+
+def snapshot_path(save_dir: str, round_i: int) -> str:
+    return os.path.join(save_dir, f"round{round_i}.snap")
+
+
+def find_divergence(
+    forest_height: int,
+    rounds: int,
+    batch_size: int,
+    seed: int = 123,
+    backend: str = "python",
+    reference: str = "python",
+    save_dir: str | None = None,
+    start_round: int = 0,
+    trace: bool = False,
+    prints: bool = False,
+    values_only: bool = False,
+) -> tuple[int, list[str]] | None:
+    """
+    Run the kernel a round at a time against the reference, snapshotting
+    before each round and saving the snapshots to save_dir if it's given.
+    With start_round the run starts from that round's snapshot in save_dir
+    instead of the beginning. Returns the first round whose memory differs
+    with a description of where, or None if every round matched.
+    """
+    random.seed(seed)
+    forest = Tree.generate(forest_height)
+    inp = Input.generate(forest, batch_size, rounds)
+    mem = build_mem_image(forest, inp)
+
+    kb = KernelBuilder()
+    kb.build_kernel(forest.height, len(forest.values), len(inp.indices), rounds)
+    debug_info = kb.debug_info()
+    machine = BACKENDS[backend](
+        mem, kb.instrs, debug_info, n_cores=N_CORES, trace=trace
+    )
+    machine.prints = prints
+    if start_round:
+        with open(snapshot_path(save_dir, start_round), "rb") as f:
+            machine.restore(f.read())
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+
+    values = range(mem[6], mem[6] + batch_size)
+    for i, ref_mem in enumerate(REFERENCE_KERNELS[reference](mem)):
+        if i < start_round:
+            continue
+        blob = machine.snapshot()
+        if save_dir is not None:
+            with open(snapshot_path(save_dir, i), "wb") as f:
+                f.write(blob)
+        machine.run()
+        addrs = diff_addrs(machine.mem, ref_mem, values if values_only else None)
+        if addrs:
+            snap = MachineSnapshot.from_bytes(machine.snapshot())
+            return i, describe_divergence(snap, ref_mem, debug_info, addrs)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find where the kernel diverges from the reference."
+    )
+    parser.add_argument("--forest-height", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--backend", default="python")
+    parser.add_argument("--reference", default="python")
+    parser.add_argument("--save-dir", help="write the snapshot of each round here")
+    parser.add_argument(
+        "--start-round",
+        type=int,
+        default=0,
+        help="start from this round's snapshot in --save-dir",
+    )
+    parser.add_argument("--trace", action="store_true")
+    parser.add_argument("--prints", action="store_true")
+    parser.add_argument(
+        "--values-only",
+        action="store_true",
+        help="only compare inp_values, the part of memory the tests check",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar="SNAPSHOT",
+        help="diff two snapshots of the kernel for this shape instead",
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        kb = KernelBuilder()
+        n_nodes = 2 ** (args.forest_height + 1) - 1
+        kb.build_kernel(args.forest_height, n_nodes, args.batch_size, args.rounds)
+        snaps = []
+        for path in args.compare:
+            with open(path, "rb") as f:
+                snaps.append(MachineSnapshot.from_bytes(f.read()))
+        lines = diff_snapshots(*snaps, kb.debug_info())
+        print("\n".join(lines) if lines else "The snapshots are the same")
+        return
+
+    found = find_divergence(
+        args.forest_height,
+        args.rounds,
+        args.batch_size,
+        args.seed,
+        args.backend,
+        args.reference,
+        args.save_dir,
+        args.start_round,
+        args.trace,
+        args.prints,
+        args.values_only,
+    )
+    if found is None:
+        print("Every round matches the reference")
+        return
+    i, lines = found
+    print(f"Round {i} diverges from the reference")
+    for line in lines:
+        print(f"  {line}")
+    if args.save_dir is not None:
+        print(f"Rerun from its snapshot with --start-round {i}")
+
+
+if __name__ == "__main__":
+    main()
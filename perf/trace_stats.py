@@ -0,0 +1,258 @@
+"""
+Turn a slot trace into per-engine utilization timelines and a table of where
+the cycles with idle slots went.
+
+    python trace_stats.py trace.json --out trace_counters.json
+    python trace_stats.py trace.json.gz --window 500 --top 20
+    python trace_stats.py trace.json --param unroll_rounds=None --rounds 16
+
+The trace Machine.setup_trace writes has an event per executed slot, too many
+for Perfetto at full scale. This reads it a line at a time and buckets the
+events into windows of --window cycles. --out gets a counter track per engine
+and core whose value is how full the engine's slots were over each window,
+which loads quickly and shows the shape of the run.
+
+Every bundle the trace shows running gets its busiest engine's fill. The
+cycles it wasted are its runs times the fraction of that engine it left
+empty, which is what packing more slots in could win back. Bundles are
+grouped under the last KernelBuilder.labels entry at or before their pc,
+rebuilding the kernel from the shape and --param options like analyze.py,
+so those must match the run that made the trace.
+
+Memory stays bounded by the program's size, not the trace's. Events must be
+in cycle order, as TraceWriter writes them. Bundles with no slots, and cores
+that are paused or halted, leave no events, so they aren't counted.
+"""
+
+import argparse
+import gzip
+import json
+from bisect import bisect_right
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Iterator, TextIO
+
+from autotune import parse_param
+from perf_takehome import KernelBuilder
+from problem import SLOT_LIMITS
+
+
+def read_events(path: str) -> Iterator[dict]:
+    """Yield the events of a trace with one event per line, .gz or not"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        for line in f:
+            line = line.strip().removeprefix("[").removesuffix("]").rstrip(",")
+            if line:
+                yield json.loads(line)
+
+
+@dataclass
+class BundleStats:
+    """How often one bundle ran, over every core, and the slots it used"""
+
+    runs: int = 0
+    slots: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+
+    def fill(self) -> float:
+        """How full the bundle's busiest engine is"""
+        if not self.runs:
+            return 0.0
+        return max(
+            (n / self.runs / SLOT_LIMITS[e] for e, n in self.slots.items()),
+            default=0.0,
+        )
+
+    def idle_cycles(self) -> float:
+        return self.runs * (1 - self.fill())
+
+
+@dataclass
+class TraceSummary:
+    # One past the last cycle with an event
+    cycles: int = 0
+    events: int = 0
+    # Slots per (core, engine) over the whole trace
+    slots: dict[tuple[int, str], int] = field(default_factory=lambda: defaultdict(int))
+    # By pc, empty if the trace doesn't record pcs
+    bundles: dict[int, BundleStats] = field(
+        default_factory=lambda: defaultdict(BundleStats)
+    )
+
+
+class CounterWriter:
+    """
+    Writes counter events as Chrome Trace JSON, one event per line, as the
+    windows they cover are finished
+    """
+
+    def __init__(self, f: TextIO | None):
+        self.f = f
+        self.first = True
+
+    def write(self, event: dict):
+        if self.f is None:
+            return
+        self.f.write(("[\n" if self.first else ",\n") + json.dumps(event))
+        self.first = False
+
+    def close(self):
+        if self.f is not None:
+            self.f.write("[\n]\n" if self.first else "\n]\n")
+
+
+def summarize(
+    events: Iterator[dict], window: int = 100, out: TextIO | None = None
+) -> TraceSummary:
+    """
+    Tally a trace's events, writing a counter event per engine, core and
+    window of cycles to out if it's given
+    """
+    summary = TraceSummary()
+    counters = CounterWriter(out)
+    engines = {}
+    cores = set()
+    current = None
+    in_window = defaultdict(int)
+    last_bundle = None
+
+    def flush(start: int, end: int):
+        for core in sorted(cores):
+            for engine, limit in SLOT_LIMITS.items():
+                n = in_window.pop((core, engine), 0)
+                counters.write(
+                    {
+                        "name": engine,
+                        "ph": "C",
+                        "pid": core,
+                        "ts": start,
+                        "args": {"occupancy": round(n / (limit * (end - start)), 4)},
+                    }
+                )
+
+    for event in events:
+        if event.get("ph") == "M":
+            if event["name"] == "thread_name":
+                engines[event["pid"], event["tid"]] = event["args"]["name"].rsplit(
+                    "-", 1
+                )[0]
+            elif event["name"] == "process_name":
+                cores.add(event["pid"])
+                counters.write(event)
+            continue
+        if event.get("ph") != "X":
+            continue
+        core, ts = event["pid"], event["ts"]
+        engine = engines[core, event["tid"]]
+        cores.add(core)
+        start = ts - ts % window
+        if current is None or start != current:
+            if current is not None:
+                if start < current:
+                    raise ValueError(f"event at cycle {ts} is out of order")
+                flush(current, current + window)
+                if start > current + window:
+                    # Drop the counters to zero over the windows with no events
+                    flush(current + window, start)
+            current = start
+        in_window[core, engine] += 1
+        summary.slots[core, engine] += 1
+        summary.events += 1
+        summary.cycles = max(summary.cycles, ts + 1)
+        pc = event.get("args", {}).get("pc")
+        if pc is not None:
+            bundle = summary.bundles[pc]
+            if last_bundle != (core, ts, pc):
+                bundle.runs += 1
+                last_bundle = (core, ts, pc)
+            bundle.slots[engine] += 1
+    if current is not None:
+        flush(current, summary.cycles)
+    counters.close()
+    return summary
+
+
+def label_of(labels: dict[str, int], pc: int) -> str:
+    """The last label at or before pc"""
+    names = sorted(labels, key=labels.get)
+    i = bisect_right([labels[n] for n in names], pc) - 1
+    return names[i] if i >= 0 else "unlabeled"
+
+
+def hot_spots(
+    summary: TraceSummary, labels: dict[str, int]
+) -> list[tuple[str, int, float, float]]:
+    """
+    (label, bundle runs, idle cycles, busiest engine's fill) for each
+    labeled part of the program, most idle cycles first
+    """
+    runs = defaultdict(int)
+    idle = defaultdict(float)
+    for pc, bundle in summary.bundles.items():
+        label = label_of(labels, pc)
+        runs[label] += bundle.runs
+        idle[label] += bundle.idle_cycles()
+    rows = [(n, runs[n], idle[n], 1 - idle[n] / runs[n]) for n in runs]
+    return sorted(rows, key=lambda row: -row[2])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarize a trace's engine utilization."
+    )
+    parser.add_argument("trace", help="trace.json or trace.json.gz")
+    parser.add_argument("--window", type=int, default=100, help="cycles per window")
+    parser.add_argument("--out", help="write the counter tracks here")
+    parser.add_argument("--top", type=int, default=10, help="bundles to list")
+    parser.add_argument("--forest-height", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="a KernelBuilder option, None for None",
+    )
+    args = parser.parse_args()
+
+    params = {}
+    for arg in args.param:
+        name, (value,) = parse_param(arg)
+        params[name] = value
+    kb = KernelBuilder(**params)
+    n_nodes = 2 ** (args.forest_height + 1) - 1
+    kb.build_kernel(args.forest_height, n_nodes, args.batch_size, args.rounds)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            summary = summarize(read_events(args.trace), args.window, f)
+    else:
+        summary = summarize(read_events(args.trace), args.window)
+
+    cores = sorted({core for core, _ in summary.slots})
+    print(f"{summary.events} slots over {summary.cycles} cycles on {len(cores)} cores")
+    for engine, limit in SLOT_LIMITS.items():
+        n = sum(summary.slots[core, engine] for core in cores)
+        print(f"{engine:>5}: {n / (limit * summary.cycles * len(cores)):.1%} full")
+    if not summary.bundles:
+        print("The trace has no pcs, so there are no hot spots to show")
+        return
+    print("\nIdle cycles by label:")
+    print(f"{'label':<24} {'runs':>8} {'idle':>9} {'fill':>6}")
+    for label, runs, idle, fill in hot_spots(summary, kb.labels):
+        print(f"{label:<24} {runs:>8} {idle:>9.0f} {fill:>6.1%}")
+    print("\nTop bundles by idle cycles:")
+    print(f"{'pc':>6} {'label':<24} {'runs':>8} {'idle':>9} {'fill':>6}")
+    top = sorted(summary.bundles.items(), key=lambda kv: -kv[1].idle_cycles())
+    for pc, bundle in top[: args.top]:
+        print(
+            f"{pc:>6} {label_of(kb.labels, pc):<24} {bundle.runs:>8} "
+            f"{bundle.idle_cycles():>9.0f} {bundle.fill():>6.1%}"
+        )
+    if args.out:
+        print(f"\nWrote the counter tracks to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
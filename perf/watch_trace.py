@@ -1,75 +1,278 @@
+"""
+Serve the latest trace to a Perfetto UI at http://localhost:8000, reopening
+it whenever the simulator writes a new one.
+
+    python watch_trace.py
+    python watch_trace.py --assets ~/perfetto/out/ui/ui/dist   # a local UI build
+    python watch_trace.py --refresh                            # pick up a new UI
+
+The UI's files come from ui.perfetto.dev (or --assets) the first time they're
+asked for and are kept in CACHE_DIR, with the frontend bundle patched once as
+it's stored, so after the first load it works offline. The trace is sent
+gzipped, compressing a plain trace.json once per version of it, with ETags
+and Range support. /events tells the page a new trace is ready with
+server-sent events.
+"""
+
+import argparse
+import gzip
 import http.server
+import mimetypes
 import os
-from datetime import datetime
-import webbrowser
+import re
+import shutil
+import tempfile
+import time
+import urllib.parse
 import urllib.request
+import webbrowser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# The simulator writes either of these, depending on the trace path it's given
+TRACE_FILES = ['trace.json', 'trace.json.gz']
+
+PERFETTO_URL = 'https://ui.perfetto.dev'
+CACHE_DIR = os.path.join(HERE, '.watch_trace_cache')
+
+# Edits to Perfetto's frontend bundle, made once when it's cached
+BUNDLE_PATCHES = [
+    # Fix a bug in Perfetto that they haven't deployed the fix for yet but have fixed internally
+    (b'throw new Error(`EngineProxy ${this.tag} was disposed.`);', b'return null;'),
+    # Auto-expand tracks by default
+    (b'collapsed: true', b'collapsed: false'),
+    (b'collapsed: !hasHeapProfiles', b'collapsed: false'),
+]
+
+# Seconds between /events' checks of the trace, and between keepalives
+POLL_INTERVAL = 0.25
+KEEPALIVE_INTERVAL = 15
+
+mimetypes.add_type('application/wasm', '.wasm')
+mimetypes.add_type('text/javascript', '.js')
+
+
+def trace_file(files=TRACE_FILES):
+    """The most recently written trace"""
+    existing = [f for f in files if os.path.exists(f)]
+    return max(existing, key=os.path.getmtime, default=files[0])
+
+
+def trace_version(path):
+    """Changes whenever the file at path does, None if there's no file"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}'
+
+
+def write_atomic(path, write):
+    """Make path by calling write on a temporary file, then moving it there"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def gzipped(path, cache_dir=CACHE_DIR):
+    """
+    A gzipped copy of the file at path, made the first time it's asked for
+    each version of the file. Copies of older versions are removed.
+    """
+    name = os.path.basename(path)
+    cached = os.path.join(cache_dir, 'traces', f'{name}-{trace_version(path)}.gz')
+    if not os.path.exists(cached):
+
+        def compress(f):
+            # Level 1 is several times faster than the default and nearly as small
+            with open(path, 'rb') as src, gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+
+        write_atomic(cached, compress)
+        for old in os.listdir(os.path.dirname(cached)):
+            if old.startswith(name + '-') and old != os.path.basename(cached):
+                try:
+                    os.remove(os.path.join(os.path.dirname(cached), old))
+                except OSError:
+                    pass
+    return cached
+
+
+def byte_range(header, size):
+    """
+    (start, end) of the bytes a Range header asks for, end exclusive, or
+    None to send everything because there's no single byte range to honor.
+    Raises ValueError if the range starts past the end.
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', (header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        return max(0, size - int(last)), size
+    if last and int(last) < int(first):
+        return None
+    if int(first) >= size:
+        raise ValueError(f'range starts at {first} of {size} bytes')
+    return int(first), min(int(last) + 1, size) if last else size
+
+
+def fetch_asset(source, rel):
+    """A Perfetto UI file from a URL or a local directory"""
+    if re.match(r'https?://', source):
+        with urllib.request.urlopen(f'{source}/{rel}') as response:
+            return response.read()
+    with open(os.path.join(source, rel), 'rb') as f:
+        return f.read()
+
+
+def patch_bundle(data):
+    for old, new in BUNDLE_PATCHES:
+        data = data.replace(old, new)
+    return data
+
 
 # Define a handler class
 class MyHandler(http.server.BaseHTTPRequestHandler):
+    # Where the UI's files come from, a URL or a directory
+    assets = PERFETTO_URL
+    cache_dir = CACHE_DIR
+    trace_files = TRACE_FILES
 
     def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
         try:
-            # Serve a string constant at the index
-            if self.path == '/':
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                with open("watch_trace.html", 'rb') as file:
-                    self.wfile.write(file.read())
-
-            # Stream the contents of 'trace.json' at '/trace.json'
-            elif self.path == '/trace.json':
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                with open('trace.json', 'rb') as file:
-                    while chunk := file.read(8192):
-                        self.wfile.write(chunk)
-
-            # Serve the file modification time of 'trace.json' at '/mtime'
-            elif self.path == '/mtime':
-                mtime = os.path.getmtime('trace.json')
-                last_modified_date = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
-                self.send_response(200)
-                self.send_header('Content-type', 'text/plain')
-                self.end_headers()
-                self.wfile.write(last_modified_date.encode())
-
-            elif self.path.startswith('/perfetto'):
-                proxy_url = 'https://ui.perfetto.dev' + self.path[len('/perfetto'):]
-                print("Proxying request to " + proxy_url)
-                with urllib.request.urlopen(proxy_url) as response:
-                    self.send_response(response.status)
-
-                    self.end_headers()
-                    res = response.read()
-                    if self.path.endswith("frontend_bundle.js"):
-                        print("Activating replacement")
-                        # Fix a bug in Perfetto that they haven't deployed the fix for yet but have fixed internally
-                        res = res.replace(b"throw new Error(`EngineProxy ${this.tag} was disposed.`);", b"return null;")
-                        # Auto-expand tracks by default
-                        res = res.replace(b"collapsed: true", b"collapsed: false")
-                        res = res.replace(b"collapsed: !hasHeapProfiles", b"collapsed: false")
-                    for header in response.headers:
-                        if header == "Content-Length":
-                            self.send_header(header, len(res))
-                        self.send_header(header, response.headers[header])
-                    self.wfile.write(res)
-
+            if path == '/':
+                self.send_file(os.path.join(HERE, 'watch_trace.html'), 'text/html')
+            elif path == '/trace.json':
+                self.send_trace()
+            elif path == '/events':
+                self.send_events()
+            elif path == '/perfetto' or path.startswith('/perfetto/'):
+                self.send_asset(path[len('/perfetto/'):])
             else:
-                self.send_error(404, "File Not Found: {}".format(self.path))
-
+                self.send_error(404, 'File Not Found: {}'.format(self.path))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
         except IOError:
             self.send_error(404, 'File Not Found: {}'.format(self.path))
 
+    def send_file(self, path, content_type, headers=()):
+        """
+        Send a file, or the part of it a Range header asks for, with extra
+        headers as (name, value) pairs
+        """
+        size = os.path.getsize(path)
+        try:
+            span = byte_range(self.headers.get('Range'), size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = span or (0, size)
+        self.send_response(206 if span else 200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if span:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        with open(path, 'rb') as f:
+            if end > start:
+                self.connection.sendfile(f, start, end - start)
+
+    def send_trace(self):
+        """
+        The latest trace, gzipped. A plain trace.json is compressed once per
+        version, so reloads after the first are quick.
+        """
+        path = trace_file(self.trace_files)
+        version = trace_version(path)
+        if version is None:
+            raise FileNotFoundError(path)
+        if not path.endswith('.gz'):
+            path = gzipped(path, self.cache_dir)
+        etag = f'"{version}-gzip"'
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_file(path, 'application/json', [
+            ('Content-Encoding', 'gzip'),
+            ('ETag', etag),
+            ('Cache-Control', 'no-cache'),
+            ('X-Trace-Version', version),
+        ])
+
+    def send_events(self):
+        """
+        Server-sent events with the trace's version, when the page connects
+        and whenever a new trace has been completely written, which is once
+        it's looked the same for a whole poll
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        sent = seen = None
+        last_write = time.monotonic()
+        while True:
+            version = trace_version(trace_file(self.trace_files))
+            if version is not None and version != sent and version == seen:
+                self.wfile.write(f'event: trace\ndata: {version}\n\n'.encode())
+                sent, last_write = version, time.monotonic()
+            elif time.monotonic() - last_write > KEEPALIVE_INTERVAL:
+                self.wfile.write(b': keepalive\n\n')
+                last_write = time.monotonic()
+            seen = version
+            time.sleep(POLL_INTERVAL)
+
+    def send_asset(self, rel):
+        """A Perfetto UI file, fetched and cached the first time"""
+        if not rel or rel.endswith('/'):
+            rel += 'index.html'
+        if '..' in rel.split('/'):
+            self.send_error(403)
+            return
+        cached = os.path.join(self.cache_dir, 'perfetto', rel)
+        if not os.path.exists(cached):
+            print(f'Caching {rel} from {self.assets}')
+            data = fetch_asset(self.assets, rel)
+            if rel.endswith('frontend_bundle.js'):
+                data = patch_bundle(data)
+            write_atomic(cached, lambda f: f.write(data))
+        content_type = mimetypes.guess_type(rel)[0] or 'application/octet-stream'
+        self.send_file(cached, content_type)
+
+
 # Start the server
-def run(server_class=http.server.HTTPServer, handler_class=MyHandler):
-    server_address = ('', 8000)
+def run(port=8000, server_class=http.server.ThreadingHTTPServer, handler_class=MyHandler):
+    server_address = ('', port)
     httpd = server_class(server_address, handler_class)
     print("Starting httpd...")
-    webbrowser.open('http://localhost:8000')
+    webbrowser.open(f'http://localhost:{port}')
     httpd.serve_forever()
 
+
 # Run the server
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser(description='Serve the latest trace to Perfetto.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--assets', default=PERFETTO_URL, help="the Perfetto UI's URL or a directory with a build of it")
+    parser.add_argument('--refresh', action='store_true', help='drop the cached UI files first')
+    args = parser.parse_args()
+    if args.refresh:
+        shutil.rmtree(os.path.join(CACHE_DIR, 'perfetto'), ignore_errors=True)
+    MyHandler.assets = args.assets
+    run(args.port)